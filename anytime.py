@@ -0,0 +1,297 @@
+"""Simulations and searches that answer within a wall-clock budget.
+
+anytime_simulate runs trials in blocks, each drawn from its own seed, until the
+trials are done, the budget runs out or the caller cancels. It returns the estimate
+over the trials completed so far with its 95% confidence interval, and reports
+progress after every chunk of blocks. Chunks grow while there is time and shrink
+to fit what is left, judged by the throughput measured so far, so a chunk is not
+started unless it is expected to finish in time. The trials done are always a
+prefix of the same sequence of blocks, so a run that finishes matches any other
+finished run with the same seed.
+
+anytime_optimize picks the trials per probe so the whole search fits the budget,
+then runs optimize_r_var, stopping between probes when time is up. It returns the
+midpoint of the bracket reached so far, with half its width as the error.
+
+Cancel either from another thread through Budget.cancel:
+
+    budget = Budget(seconds=2)
+    estimate = anytime_simulate(rs, 0.05, budget, on_progress=print)
+    ...
+    budget.cancel.set()  # elsewhere
+"""
+
+import math
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from engine import Backend, SimulationResult
+from retcalc import SearchState, optimize_r_var, simulate_values
+from rettypes import RetirementSettings, RValue
+from shocks import ShockBank
+
+# Trials drawn from one seed; chunks are whole blocks
+BLOCK_TRIALS = 500
+
+# Normal quantile of the two-sided 95% intervals
+Z_95 = 1.959964
+
+
+class Budget:
+    """A deadline on time.monotonic(), from now + seconds or given outright, and a
+    flag to cancel cooperatively. No deadline means no time limit."""
+
+    def __init__(
+        self,
+        seconds: Optional[float] = None,
+        deadline: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
+        if seconds is not None:
+            deadline = time.monotonic() + seconds
+        self.deadline = deadline
+        self.cancel = cancel if cancel is not None else threading.Event()
+
+    def remaining(self) -> float:
+        if self.cancel.is_set():
+            return 0.0
+        if self.deadline is None:
+            return math.inf
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class Progress:
+    """Reported after every chunk of trials or probe. ci_width is the width of the
+    95% interval of a simulation's estimate; low and high bracket a search."""
+
+    def __init__(
+        self,
+        elapsed: float,
+        trials: int,
+        estimate: float,
+        ci_width: Optional[float] = None,
+        low: Optional[float] = None,
+        high: Optional[float] = None,
+    ):
+        self.elapsed = elapsed
+        self.trials = trials
+        self.estimate = estimate
+        self.ci_width = ci_width
+        self.low = low
+        self.high = high
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"Progress({fields})"
+
+
+class Estimate:
+    """Best answer within the budget: value +- error, from trials trials (per probe,
+    for a search). complete is False when the budget or a cancel cut the work short.
+    result holds a simulation's trials, state a search's bracket and probes."""
+
+    def __init__(
+        self,
+        value: float,
+        error: float,
+        trials: int,
+        complete: bool,
+        elapsed: float,
+        result: Optional[SimulationResult] = None,
+        state: Optional[SearchState] = None,
+    ):
+        self.value = value
+        self.error = error
+        self.trials = trials
+        self.complete = complete
+        self.elapsed = elapsed
+        self.result = result
+        self.state = state
+
+
+def tail_interval(values: np.ndarray, pmin: float) -> Tuple[float, float, float]:
+    """The pmin tail value of values (as SimulationResult.tail_value) and the bounds
+    of its 95% order statistic confidence interval"""
+    n = len(values)
+    ordered = np.sort(values)
+    k = n * pmin
+    spread = Z_95 * math.sqrt(n * pmin * (1 - pmin))
+    lower = ordered[max(int(math.floor(k - spread)), 0)]
+    upper = ordered[min(int(math.ceil(k + spread)), n - 1)]
+    return float(ordered[int(k)]), float(lower), float(upper)
+
+
+def block_shocks(
+    retirementSettings: RetirementSettings,
+    seed: np.random.SeedSequence,
+    first: int,
+    blocks: int,
+) -> ShockBank:
+    """Shocks of blocks first, first + 1, ... concatenated"""
+    banks = [
+        ShockBank.for_settings(
+            retirementSettings,
+            BLOCK_TRIALS,
+            np.random.default_rng(
+                np.random.SeedSequence(seed.entropy, spawn_key=(block,))
+            ),
+        )
+        for block in range(first, first + blocks)
+    ]
+    return ShockBank(
+        np.concatenate([bank.inflation for bank in banks]),
+        np.concatenate([bank.returns for bank in banks]),
+        np.concatenate([bank.longevity for bank in banks]),  # type: ignore
+        np.concatenate([bank.regimes for bank in banks]),  # type: ignore
+    )
+
+
+def anytime_simulate(
+    retirementSettings: RetirementSettings,
+    pmin: float,
+    budget: Budget,
+    n: int = 10_000,
+    on_progress: Optional[Callable[[Progress], None]] = None,
+    seed: Optional[int] = None,
+    backend: Backend = Backend.AUTO,
+) -> Estimate:
+    """The pmin tail value over up to n trials (rounded up to whole blocks), as far
+    as budget allows. Always runs at least one block."""
+    start = time.monotonic()
+    seed_sequence = np.random.SeedSequence(seed)
+    total_blocks = -(-n // BLOCK_TRIALS)
+    results = []
+    blocks_done = 0
+    chunk = 1
+    seconds_per_block = 0.0
+    while blocks_done < total_blocks:
+        if blocks_done > 0:
+            remaining = budget.remaining()
+            affordable = (
+                int(remaining / seconds_per_block) if remaining < math.inf else chunk
+            )
+            chunk = min(chunk, affordable, total_blocks - blocks_done)
+            if chunk < 1 and blocks_done == 1 and remaining > 0:
+                # The first block's time includes loading the kernels; time another
+                chunk = 1
+            if chunk < 1:
+                break
+        chunk_start = time.monotonic()
+        shocks = block_shocks(retirementSettings, seed_sequence, blocks_done, chunk)
+        results.append(simulate_values(retirementSettings, shocks.n, shocks, backend))
+        seconds_per_block = (time.monotonic() - chunk_start) / chunk
+        blocks_done += chunk
+        chunk *= 2
+
+        result = SimulationResult(
+            np.concatenate([r.values for r in results]),
+            np.concatenate([r.ruin_years for r in results]),
+            np.concatenate([r.price_index for r in results]),  # type: ignore
+        )
+        results = [result]
+        value, lower, upper = tail_interval(result.current_values(), pmin)
+        if on_progress is not None:
+            on_progress(
+                Progress(time.monotonic() - start, result.n, value, upper - lower)
+            )
+    return Estimate(
+        value,
+        (upper - lower) / 2,
+        result.n,
+        blocks_done == total_blocks,
+        time.monotonic() - start,
+        result=result,
+    )
+
+
+def bracket(state: SearchState, maximize: bool) -> Tuple[float, float]:
+    """(low, high) around the crossing from the probes of an optimize_r_var search;
+    high is inf while the top end of the range is still being searched for"""
+    low = state.low
+    high = math.inf if state.bracketing else state.high
+    for value, margin in state.probes:
+        # As optimize_r_var decides which side of the crossing a probe is on
+        if (margin > 0) ^ maximize:
+            high = min(high, value)
+        else:
+            low = max(low, value)
+    return low, high
+
+
+def anytime_optimize(
+    retirementSettings: RetirementSettings,
+    r_var_to_opt: RValue,
+    maximize: bool,
+    pmin: float,
+    budget: Budget,
+    n: int = 10_000,
+    on_progress: Optional[Callable[[Progress], None]] = None,
+    seed: Optional[int] = None,
+    backend: Backend = Backend.AUTO,
+    min_trials: int = 1000,
+    expected_probes: int = 12,
+) -> Estimate:
+    """optimize_r_var within budget. A pilot simulation times the engine, and each
+    probe then gets as many trials (between min_trials and n) as fit
+    expected_probes probes into the budget, all on one shock bank. Always makes at
+    least one probe. retirementSettings is left unchanged."""
+    start = time.monotonic()
+    rs = retirementSettings.copy()
+    remaining = budget.remaining()
+    if remaining < math.inf:
+        pilot = ShockBank.for_settings(rs, min_trials, seed)
+        pilot_start = time.monotonic()
+        simulate_values(rs, min_trials, pilot, backend)
+        seconds_per_trial = (time.monotonic() - pilot_start) / min_trials
+        affordable = budget.remaining() / expected_probes / seconds_per_trial
+        n = int(min(max(affordable, min_trials), n))
+    shocks = ShockBank.for_settings(rs, n, seed)
+
+    state = SearchState()
+    last_probe = time.monotonic()
+
+    class OutOfTime(Exception):
+        pass
+
+    def on_probe(state: SearchState) -> None:
+        nonlocal last_probe
+        now = time.monotonic()
+        if on_progress is not None:
+            low, high = bracket(state, maximize)
+            estimate = (low + high) / 2 if high < math.inf else low
+            on_progress(Progress(now - start, n, estimate, None, low, high))
+        # Stop unless another probe like the last one fits
+        if budget.remaining() < now - last_probe:
+            raise OutOfTime()
+        last_probe = now
+
+    complete = True
+    try:
+        optimize_r_var(
+            rs,
+            r_var_to_opt,
+            maximize,
+            pmin,
+            shocks,
+            backend,
+            n,
+            state=state,
+            on_probe=on_probe,
+        )
+    except OutOfTime:
+        complete = False
+    low, high = bracket(state, maximize)
+    if complete:
+        # optimize_r_var's answer
+        value, error = high, high - low
+    elif high < math.inf:
+        value, error = (low + high) / 2, (high - low) / 2
+    else:
+        value, error = low, math.inf
+    return Estimate(value, error, n, complete, time.monotonic() - start, state=state)
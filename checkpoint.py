@@ -0,0 +1,102 @@
+"""Checkpoint and resume for long batches of optimize_r_var searches.
+
+Progress is appended to a JSON lines file, one record per completed probe or
+finished search, and flushed to disk as it is written. Re-running the same batch
+against the same file skips finished searches and resumes half-finished ones from
+their last bracket and RNG position, giving the same answers as an uninterrupted
+run."""
+
+import json
+import os
+from typing import Dict, List, Tuple
+
+from retcalc import SearchState, optimize_r_var
+from rettypes import RetirementSettings, RValue
+
+# (key, scenario, r_var_to_opt, maximize, pmin)
+Job = Tuple[str, RetirementSettings, RValue, bool, float]
+
+
+class Checkpoint:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.results: Dict[str, float] = {}
+        self.searches: Dict[str, SearchState] = {}
+        if os.path.isfile(filepath):
+            self._load()
+        self._stream = open(filepath, "a")
+
+    def _load(self) -> None:
+        with open(self.filepath, "rb") as stream:
+            content = stream.read()
+        complete = content[: content.rfind(b"\n") + 1]
+        if len(complete) < len(content):
+            # Drop a record torn by a crash mid-write, so appends start on a fresh line
+            os.truncate(self.filepath, len(complete))
+        for line in complete.decode().splitlines():
+            record = json.loads(line)
+            if record["type"] == "probe":
+                self.searches[record["key"]] = SearchState.from_structured(
+                    record["state"]
+                )
+            elif record["type"] == "result":
+                self.results[record["key"]] = record["value"]
+
+    def _append(self, record: dict) -> None:
+        self._stream.write(json.dumps(record) + "\n")
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+
+    def record_probe(self, key: str, state: SearchState) -> None:
+        self.searches[key] = state
+        self._append({"type": "probe", "key": key, "state": state.to_structured()})
+
+    def record_result(self, key: str, value: float) -> None:
+        self.results[key] = value
+        self._append({"type": "result", "key": key, "value": value})
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def __enter__(self) -> "Checkpoint":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def checkpointed_optimize_r_var(
+    checkpoint: Checkpoint,
+    key: str,
+    retirementSettings: RetirementSettings,
+    r_var_to_opt: RValue,
+    maximize: bool,
+    pmin: float,
+    **kwargs,
+) -> float:
+    """optimize_r_var, recording every probe under key and resuming from the last
+    recorded one. Extra arguments are passed through to optimize_r_var."""
+    if key in checkpoint.results:
+        return checkpoint.results[key]
+    value = optimize_r_var(
+        retirementSettings,
+        r_var_to_opt,
+        maximize,
+        pmin,
+        state=checkpoint.searches.get(key),
+        on_probe=lambda s: checkpoint.record_probe(key, s),
+        **kwargs,
+    )
+    checkpoint.record_result(key, value)
+    return value
+
+
+def optimize_batch(jobs: List[Job], filepath: str, **kwargs) -> Dict[str, float]:
+    """Run every job, checkpointing to filepath. Safe to re-run after a crash."""
+    results: Dict[str, float] = {}
+    with Checkpoint(filepath) as checkpoint:
+        for key, rs, r_var_to_opt, maximize, pmin in jobs:
+            results[key] = checkpointed_optimize_r_var(
+                checkpoint, key, rs, r_var_to_opt, maximize, pmin, **kwargs
+            )
+    return results
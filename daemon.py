@@ -0,0 +1,332 @@
+"""Long-running simulation daemon for interactive front ends.
+
+A fresh `python retcalc.py` pays for interpreter startup, imports, kernel loading
+and shock generation before simulating anything. The daemon pays them once: its
+worker processes load the compiled kernels at startup and keep the shock banks they
+draw, so a request only costs the simulation itself.
+
+Requests are newline-delimited JSON objects over a Unix socket (or a localhost TCP
+port), one response line per request line:
+
+    {"id": 1, "analysis": "simulate", "scenario": {...}, "n": 10000, "seed": 0}
+    {"id": 1, "result": {"ruin_probability": 0.02, "tail_value": ..., ...}}
+
+scenario is a RetirementSettings in its saved YAML structure. Responses echo id and
+may come back out of order when requests are pipelined. Requests for the same
+scenario and parameters that arrive while one is already being computed wait for
+that computation instead of starting their own, so a UI firing duplicate queries
+costs one simulation.
+
+Start it with:
+
+    python daemon.py [SOCKET_PATH]
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import multiprocessing
+import os
+import socket
+import sys
+from typing import Any, Dict, Hashable, Optional, Tuple, Union
+
+import numpy as np
+
+from engine import HAVE_NUMBA, Backend
+from retcalc import optimize_r_var, simulate_values
+from rettypes import *
+from shocks import Sampling, ShockBank
+
+DEFAULT_SOCKET_PATH = "retcalc.sock"
+
+# A Unix socket path or a (host, port) TCP address
+Address = Union[str, Tuple[str, int]]
+
+# Parameters of each analysis and their defaults; anything else is rejected
+ANALYSES: Dict[str, Dict[str, Any]] = {
+    "simulate": {"n": 10_000, "seed": 0, "sampling": "PSEUDO_RANDOM", "pmin": 0.05},
+    "optimize": {
+        "n": 10_000,
+        "seed": 0,
+        "sampling": "PSEUDO_RANDOM",
+        "pmin": 0.05,
+        "rsetting": "EXPENDITURE",
+        "maximize": True,
+    },
+}
+
+# Scalar settings optimize can search over. optimize_r_var doubles its upper bound
+# until the tail crosses, so fractions (which never cross past 1) are left out.
+OPTIMIZABLE = (RSetting.EXPENDITURE, RSetting.EMERGENCY_MIN)
+
+# Worker side: shock banks by (n, steps, assets, seed, sampling), least recent first
+MAX_CACHED_BANKS = 8
+_banks: "OrderedDict[Hashable, ShockBank]" = OrderedDict()
+
+
+def cached_shocks(
+    retirementSettings: RetirementSettings, n: int, seed: int, sampling: Sampling
+) -> ShockBank:
+    key = (
+        n,
+        retirementSettings.steps,
+        len(retirementSettings.asset_distribution.asset_allocations),
+        seed,
+        sampling,
+    )
+    if key in _banks:
+        _banks.move_to_end(key)
+    else:
+        _banks[key] = ShockBank.for_settings(retirementSettings, n, seed, sampling)
+        if len(_banks) > MAX_CACHED_BANKS:
+            _banks.popitem(last=False)
+    return _banks[key]
+
+
+def _warm_up(backend: Backend) -> None:
+    rs = RetirementSettings(
+        40000,
+        (0.03, 0.01),
+        2,
+        0,
+        AssetDistribution(
+            [
+                AssetAllocation(Asset("Cash", 20000, 0.01, 0.001), 0, 20000, 0),
+                AssetAllocation(Asset("Stocks", 600000, 0.08, 0.15), 1, 0, 1),
+            ]
+        ),
+        None,
+    )
+    simulate_values(rs, 2, ShockBank.generate(2, 2, 2, 0), backend)
+
+
+def _init_worker(backend: Backend, threads: Optional[int]) -> None:
+    if HAVE_NUMBA and threads is not None:
+        import numba
+
+        numba.set_num_threads(threads)
+    _warm_up(backend)
+
+
+def run_analysis(
+    retirementSettings: RetirementSettings,
+    analysis: str,
+    params: Dict[str, Any],
+    backend: Backend = Backend.AUTO,
+) -> Dict[str, Any]:
+    """Compute one request; params must hold every parameter of analysis"""
+    n = params["n"]
+    shocks = cached_shocks(
+        retirementSettings, n, params["seed"], Sampling[params["sampling"]]
+    )
+    if analysis == "simulate":
+        result = simulate_values(retirementSettings, n, shocks, backend)
+        values = result.current_values()
+        return {
+            "ruin_probability": result.ruin_probability(),
+            "tail_value": result.tail_value(params["pmin"]),
+            "mean_value": float(values.mean()),
+            "median_value": float(np.median(values)),
+        }
+    else:
+        rvalue = RValue(RSetting[params["rsetting"]])
+        if rvalue.rsetting not in OPTIMIZABLE:
+            raise ValueError(f"cannot optimize {params['rsetting']}")
+        # optimize_r_var moves the setting it searches over in place
+        value = optimize_r_var(
+            retirementSettings.copy(),
+            rvalue,
+            params["maximize"],
+            params["pmin"],
+            shocks,
+            backend,
+            n,
+        )
+        return {"value": value}
+
+
+def parse_request(
+    request: Dict[str, Any],
+) -> Tuple[RetirementSettings, str, Dict[str, Any]]:
+    """The scenario, analysis and complete parameters of a request; raises
+    ValueError if it is malformed"""
+    analysis = request.get("analysis")
+    if analysis not in ANALYSES:
+        raise ValueError(f"unknown analysis {analysis!r}")
+    if "scenario" not in request:
+        raise ValueError("missing scenario")
+    unknown = set(request) - set(ANALYSES[analysis]) - {"id", "analysis", "scenario"}
+    if unknown:
+        raise ValueError(f"unknown parameters {sorted(unknown)}")
+    params = {
+        name: request.get(name, default) for name, default in ANALYSES[analysis].items()
+    }
+    try:
+        retirementSettings = RetirementSettings.from_structured(request["scenario"])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"malformed scenario: {e!r}")
+    return retirementSettings, analysis, params
+
+
+class Daemon:
+    """Serves analysis requests from a pool of warm workers.
+
+    @processes: Worker processes; 0 runs analyses on a thread of the daemon itself.
+    Defaults to one per CPU."""
+
+    def __init__(
+        self,
+        address: Address = DEFAULT_SOCKET_PATH,
+        processes: Optional[int] = None,
+        backend: Backend = Backend.AUTO,
+    ):
+        self.address = address
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.backend = backend
+        self.computed = 0
+        self.coalesced = 0
+        self._in_flight: Dict[
+            Tuple[str, str, tuple], "asyncio.Future[Dict[str, Any]]"
+        ] = {}
+        self._executor: Optional[Executor] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if self.processes == 0:
+            self._executor = ThreadPoolExecutor(1)
+            _warm_up(self.backend)
+        else:
+            # Parallelism comes from the processes when there are several
+            threads = 1 if self.processes > 1 else None
+            self._executor = ProcessPoolExecutor(
+                self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.backend, threads),
+            )
+            # Start every worker now rather than on the first requests
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(self._executor, os.getpid)
+                    for _ in range(self.processes)
+                )
+            )
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self._server = await asyncio.start_unix_server(self._serve, self.address)
+        else:
+            host, port = self.address
+            self._server = await asyncio.start_server(self._serve, host, port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        assert self._server is not None
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def analyze(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """The result of a request, shared with any identical request in flight"""
+        retirementSettings, analysis, params = parse_request(request)
+        # A snapshot, as the settings object itself is handed to the worker
+        key = (
+            json.dumps(retirementSettings.to_structured(), sort_keys=True),
+            analysis,
+            tuple(sorted(params.items())),
+        )
+        future = self._in_flight.get(key)
+        if future is None:
+            self.computed += 1
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                run_analysis,
+                retirementSettings,
+                analysis,
+                params,
+                self.backend,
+            )
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A client that disconnects must not cancel the others' computation
+        return await asyncio.shield(future)
+
+    async def _respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            request_id = request.get("id")
+            response = {"id": request_id, "result": await self.analyze(request)}
+        except Exception as e:
+            response = {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode() + b"\n")
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.create_task(self._respond(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def request(
+    address: Address, analysis: str, scenario: RetirementSettings, **params: Any
+) -> Dict[str, Any]:
+    """Send one request to a running daemon and wait for its result"""
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        message = {"analysis": analysis, "scenario": scenario.to_structured()}
+        message.update(params)
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as stream:
+            response = json.loads(stream.readline())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: python daemon.py [SOCKET_PATH]")
+        sys.exit(1)
+    daemon = Daemon(sys.argv[1] if len(sys.argv) == 2 else DEFAULT_SOCKET_PATH)
+    try:
+        asyncio.run(daemon.serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,312 @@
+"""Coordinator/worker mode for spreading large sweeps across several machines.
+
+The coordinator splits every scenario into (scenario, trial range, seed) chunks and
+hands them to workers over TCP (multiprocessing.connection, authenticated with a
+shared key). Connections exchange pickles, so anyone holding the key can run code
+on the coordinator and its workers: there is no default key, and it should be a
+long random secret. Each chunk draws its own shocks from its seed, so any worker -- or
+several workers -- computing the same chunk produce the same terminal values.
+That makes retries and work stealing safe: chunks lost to a dropped worker are put
+back in the queue, and once the queue is empty idle workers duplicate the oldest
+chunks still in flight; whichever copy finishes first wins.
+
+Start workers on each machine with:
+
+    RETCALC_AUTHKEY=... python distributed.py worker HOST PORT
+"""
+
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import os
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from engine import Backend, SimulationResult
+from retcalc import simulate_values
+from rettypes import RetirementSettings, RValue
+from shocks import ShockBank
+
+
+def authkey_from_env() -> bytes:
+    authkey = os.environ.get("RETCALC_AUTHKEY", "").encode()
+    if not authkey:
+        raise ValueError("Set RETCALC_AUTHKEY to the coordinator's key")
+    return authkey
+
+
+def sweep(
+    retirementSettings: RetirementSettings, rvalue: RValue, values: List[Any]
+) -> List[RetirementSettings]:
+    """One copy of retirementSettings per value along the rvalue axis"""
+    scenarios = []
+    for value in values:
+        scenario = retirementSettings.copy()
+        scenario.update_val(rvalue, lambda _: value)
+        scenarios.append(scenario)
+    return scenarios
+
+
+class Chunk:
+    def __init__(self, chunk_id: int, scenario: int, start: int, stop: int, seed: int):
+        self.chunk_id = chunk_id
+        self.scenario = scenario
+        self.start = start
+        self.stop = stop
+        self.seed = seed
+        self.attempts = 0
+        self.dispatched_at = 0.0
+        # Workers currently running a copy of this chunk
+        self.running: Set[int] = set()
+
+
+def make_chunks(
+    num_scenarios: int, trials: int, chunk_size: int, seed: int
+) -> List[Chunk]:
+    """Chunks of every scenario. Seeds depend only on the trial range, so every
+    scenario of a sweep runs on the same shocks (common random numbers) and
+    differences between them are not sampling noise."""
+    chunks = []
+    for scenario in range(num_scenarios):
+        for index, start in enumerate(range(0, trials, chunk_size)):
+            chunk_seed = np.random.SeedSequence(seed, spawn_key=(index,))
+            chunks.append(
+                Chunk(
+                    len(chunks),
+                    scenario,
+                    start,
+                    min(start + chunk_size, trials),
+                    int(chunk_seed.generate_state(1)[0]),
+                )
+            )
+    return chunks
+
+
+def bank_shape(scenarios: List[RetirementSettings]) -> Tuple[int, int]:
+    """Steps and assets of a shock bank covering every scenario"""
+    return (
+        max(rs.steps for rs in scenarios),
+        max(len(rs.asset_distribution.asset_allocations) for rs in scenarios),
+    )
+
+
+def simulate_chunk(
+    retirementSettings: RetirementSettings,
+    start: int,
+    stop: int,
+    seed: int,
+    shape: Tuple[int, int],
+    backend: Backend = Backend.AUTO,
+) -> SimulationResult:
+    """@shape: (steps, assets) of the bank drawn from seed, the same for every
+    scenario of the run"""
+    shocks = ShockBank.generate(stop - start, *shape, seed)
+    return simulate_values(retirementSettings, stop - start, shocks, backend)
+
+
+class Coordinator:
+    """Serves chunks to workers and merges their results.
+
+    address defaults to an ephemeral localhost port; bind to ("0.0.0.0", port) to
+    accept workers from other machines. authkey must be given to every worker."""
+
+    def __init__(
+        self,
+        scenarios: List[RetirementSettings],
+        trials: int,
+        authkey: bytes,
+        chunk_size: int = 1000,
+        seed: int = 0,
+        address: Tuple[str, int] = ("localhost", 0),
+        max_attempts: int = 3,
+        steal: bool = True,
+    ):
+        if not authkey:
+            raise ValueError("Distributed runs need a non-empty authkey")
+        self.scenarios = scenarios
+        self.trials = trials
+        self.max_attempts = max_attempts
+        self.steal = steal
+        self.chunks = make_chunks(len(scenarios), trials, chunk_size, seed)
+        self.shape = bank_shape(scenarios)
+        self._pending: Deque[Chunk] = deque(self.chunks)
+        self._results: Dict[int, SimulationResult] = {}
+        self._error: Optional[str] = None
+        self._lock = threading.Condition()
+        self._listener = Listener(address, authkey=authkey)
+        self._next_worker_id = 0
+        self.stolen = 0
+        self.retried = 0
+        # Serve workers as soon as the coordinator exists
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._listener.address  # type: ignore
+
+    def _finished(self) -> bool:
+        return self._error is not None or len(self._results) == len(self.chunks)
+
+    def _next_chunk(self, worker_id: int) -> Optional[Chunk]:
+        if self._pending:
+            chunk = self._pending.popleft()
+        elif self.steal:
+            candidates = [
+                c
+                for c in self.chunks
+                if c.running
+                and worker_id not in c.running
+                and c.chunk_id not in self._results
+            ]
+            if not candidates:
+                return None
+            chunk = min(candidates, key=lambda c: c.dispatched_at)
+            self.stolen += 1
+        else:
+            return None
+        chunk.running.add(worker_id)
+        chunk.dispatched_at = time.monotonic()
+        return chunk
+
+    def _lost(self, chunk: Chunk, worker_id: int) -> None:
+        chunk.running.discard(worker_id)
+        if chunk.chunk_id in self._results or chunk.running:
+            return
+        chunk.attempts += 1
+        if chunk.attempts >= self.max_attempts:
+            self._error = f"chunk {chunk.chunk_id} failed {chunk.attempts} times"
+        else:
+            self.retried += 1
+            self._pending.appendleft(chunk)
+        self._lock.notify_all()
+
+    def _serve(self, conn: Connection, worker_id: int) -> None:
+        chunk: Optional[Chunk] = None
+        try:
+            while True:
+                message = conn.recv()
+                with self._lock:
+                    if message[0] == "result":
+                        _, chunk_id, values, ruin_years, price_index = message
+                        assert chunk is not None and chunk.chunk_id == chunk_id
+                        chunk.running.discard(worker_id)
+                        if chunk_id not in self._results:
+                            self._results[chunk_id] = SimulationResult(
+                                values, ruin_years, price_index
+                            )
+                            self._lock.notify_all()
+                        chunk = None
+                    if self._finished():
+                        conn.send(("stop",))
+                        return
+                    chunk = self._next_chunk(worker_id)
+                if chunk is None:
+                    conn.send(("wait", 0.05))
+                else:
+                    conn.send(
+                        (
+                            "chunk",
+                            chunk.chunk_id,
+                            self.scenarios[chunk.scenario],
+                            chunk.start,
+                            chunk.stop,
+                            chunk.seed,
+                            self.shape,
+                        )
+                    )
+        except (EOFError, OSError):
+            if chunk is not None:
+                with self._lock:
+                    self._lost(chunk, worker_id)
+        finally:
+            conn.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                return  # Listener closed
+            with self._lock:
+                worker_id = self._next_worker_id
+                self._next_worker_id += 1
+            threading.Thread(
+                target=self._serve, args=(conn, worker_id), daemon=True
+            ).start()
+
+    def run(self, timeout: Optional[float] = None) -> List[SimulationResult]:
+        """Block until every chunk is done, returning one merged result per scenario
+        with trials in order"""
+        try:
+            with self._lock:
+                if not self._lock.wait_for(self._finished, timeout):
+                    raise TimeoutError("distributed run did not finish in time")
+                if self._error is not None:
+                    raise RuntimeError(self._error)
+            # Give connected workers a moment to collect their stop message
+            time.sleep(0.1)
+        finally:
+            self._listener.close()
+        return self._merge()
+
+    def _merge(self) -> List[SimulationResult]:
+        merged = []
+        for scenario in range(len(self.scenarios)):
+            chunks = sorted(
+                (c for c in self.chunks if c.scenario == scenario),
+                key=lambda c: c.start,
+            )
+            results = [self._results[c.chunk_id] for c in chunks]
+            merged.append(
+                SimulationResult(
+                    np.concatenate([r.values for r in results]),
+                    np.concatenate([r.ruin_years for r in results]),
+                    np.concatenate([r.price_index for r in results]),
+                )
+            )
+        return merged
+
+
+def run_worker(
+    address: Tuple[str, int],
+    authkey: bytes,
+    backend: Backend = Backend.AUTO,
+) -> int:
+    """Process chunks until the coordinator says stop. Returns the number of chunks
+    this worker completed."""
+    completed = 0
+    with Client(address, authkey=authkey) as conn:
+        conn.send(("ready",))
+        while True:
+            message = conn.recv()
+            if message[0] == "stop":
+                return completed
+            elif message[0] == "wait":
+                time.sleep(message[1])
+                conn.send(("ready",))
+            else:
+                _, chunk_id, scenario, start, stop, seed, shape = message
+                result = simulate_chunk(scenario, start, stop, seed, shape, backend)
+                conn.send(
+                    (
+                        "result",
+                        chunk_id,
+                        result.values,
+                        result.ruin_years,
+                        result.price_index,
+                    )
+                )
+                completed += 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "worker":
+        print("Usage: python distributed.py worker HOST PORT")
+        sys.exit(1)
+    run_worker((sys.argv[2], int(sys.argv[3])), authkey_from_env())
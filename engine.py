@@ -0,0 +1,1282 @@
+"""Compiled simulation backend.
+
+Mirrors retcalc.retirement_value and retcalc.rebalance_assets as typed kernels over
+flat arrays. Given the same ShockBank the results are bit-for-bit equal to the pure
+Python engine, so every floating point operation below is kept in the same order as
+the reference implementation."""
+
+import copy
+from enum import Enum
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from mortality import Lifespan
+from rettypes import AllocationMode, CashFlow, RebalancePolicy, RetirementSettings
+from returnmodels import ReturnModel, standardized_returns
+from shocks import ShockBank
+from withdrawal import PolicyState, PolicyStep, WithdrawalPolicy
+
+try:
+    from numba import njit, prange
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+
+# Banks model_shocks keeps per shock bank
+MAX_DERIVED_BANKS = 4
+
+
+class Backend(Enum):
+    AUTO = 1
+    PYTHON = 2
+    COMPILED = 3
+
+
+class Terms(Enum):
+    """Dollars a simulation is accounted in or its results are reported in. REAL
+    dollars are deflated by the path's cumulative inflation since year 0."""
+
+    NOMINAL = 1
+    REAL = 2
+
+
+def step_moments(mean: float, stdev: float, steps_per_year: int) -> Tuple[float, float]:
+    """Mean and stdev of a per-step rate whose compounded product over a year has the
+    given annual mean and stdev (for independent steps)"""
+    if steps_per_year == 1:
+        return mean, stdev
+    m = steps_per_year
+    step_mean = (1 + mean) ** (1 / m) - 1
+    second_moment = ((1 + mean) ** 2 + stdev**2) ** (1 / m)
+    return step_mean, max(second_moment - (1 + step_mean) ** 2, 0.0) ** 0.5
+
+
+def step_moments_jacobian(
+    mean: float, stdev: float, steps_per_year: int
+) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    """((d step mean / d mean, d step mean / d stdev),
+    (d step stdev / d mean, d step stdev / d stdev)) of step_moments"""
+    if steps_per_year == 1:
+        return (1.0, 0.0), (0.0, 1.0)
+    m = steps_per_year
+    _, step_stdev = step_moments(mean, stdev, m)
+    dmean = (1 + mean) ** (1 / m - 1) / m
+    second_moment_base = (1 + mean) ** 2 + stdev**2
+    dsecond = second_moment_base ** (1 / m - 1) / m
+    dvariance_dmean = dsecond * 2 * (1 + mean) - 2 / m * (1 + mean) ** (2 / m - 1)
+    dvariance_dstdev = dsecond * 2 * stdev
+    if step_stdev == 0:
+        return (dmean, 0.0), (0.0, 0.0)
+    return (dmean, 0.0), (
+        dvariance_dmean / (2 * step_stdev),
+        dvariance_dstdev / (2 * step_stdev),
+    )
+
+
+def compile_cash_flows(cash_flows: List[CashFlow]) -> Tuple[np.ndarray, np.ndarray]:
+    """Net indexed (today's dollars) and nominal cash flow of every year. The last
+    entry holds the flows that never end and applies to every later year."""
+    length = max([cf.start if cf.end is None else cf.end for cf in cash_flows] + [0])
+    indexed = np.zeros(length + 1)
+    nominal = np.zeros(length + 1)
+    for cf in cash_flows:
+        flows = indexed if cf.indexed else nominal
+        flows[cf.start : length + 1 if cf.end is None else cf.end] += cf.amount
+    return indexed, nominal
+
+
+class FlatScenario:
+    """Arrays the kernels run on. Returns and inflation are per step; expenditure
+    is the annual rate, spent in steps_per_year equal parts unless a
+    withdrawal_policy decides spending. With a lifespan, t is the longest horizon
+    of any path."""
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        mean_returns: np.ndarray,
+        return_stdevs: np.ndarray,
+        priorities: np.ndarray,
+        minimum_values: np.ndarray,
+        fractions: np.ndarray,
+        expenditure: float,
+        inflation: Tuple[float, float],
+        t: int,
+        expenditure_reduction_frac: Optional[float],
+        steps_per_year: int = 1,
+        rebalance_every: int = 1,
+        rebalance_policy: RebalancePolicy = RebalancePolicy.CALENDAR,
+        rebalance_band: float = 0.05,
+        withdrawal_policy: Optional[WithdrawalPolicy] = None,
+        lifespan: Optional[Lifespan] = None,
+        indexed_flows: Optional[np.ndarray] = None,
+        nominal_flows: Optional[np.ndarray] = None,
+        allocation: AllocationMode = AllocationMode.WATERFALL,
+    ):
+        self.values = values
+        self.mean_returns = mean_returns
+        self.return_stdevs = return_stdevs
+        self.priorities = priorities
+        self.minimum_values = minimum_values
+        self.fractions = fractions
+        self.expenditure = expenditure
+        self.inflation = inflation
+        self.t = t
+        self.expenditure_reduction_frac = expenditure_reduction_frac
+        self.steps_per_year = steps_per_year
+        # Steps between rebalances
+        self.rebalance_every = rebalance_every
+        self.rebalance_policy = rebalance_policy
+        self.rebalance_band = rebalance_band
+        self.withdrawal_policy = withdrawal_policy
+        self.lifespan = lifespan
+        # From compile_cash_flows
+        self.indexed_flows = np.zeros(1) if indexed_flows is None else indexed_flows
+        self.nominal_flows = np.zeros(1) if nominal_flows is None else nominal_flows
+        self.allocation = allocation
+
+    @property
+    def num_assets(self) -> int:
+        return self.values.shape[0]
+
+    @staticmethod
+    def from_retirement_settings(rs: RetirementSettings) -> "FlatScenario":
+        allocs = rs.asset_distribution.asset_allocations
+        m = rs.step_frequency.value
+        returns = [
+            step_moments(float(aa.asset.mean_return), float(aa.asset.return_stdev), m)
+            for aa in allocs
+        ]
+        return FlatScenario(
+            np.array([float(aa.asset.value) for aa in allocs]),
+            np.array([mean for mean, _ in returns]),
+            np.array([stdev for _, stdev in returns]),
+            np.array([aa.priority for aa in allocs], dtype=np.int64),
+            np.array([float(aa.minimum_value) for aa in allocs]),
+            np.array([float(aa.desired_fraction_of_total_assets) for aa in allocs]),
+            float(rs.expenditure),
+            step_moments(float(rs.inflation[0]), float(rs.inflation[1]), m),
+            rs.t,
+            rs.expenditure_reduction_frac,
+            m,
+            m // rs.rebalance_frequency.value,
+            rs.rebalance_policy,
+            float(rs.rebalance_band),
+            rs.withdrawal_policy,
+            rs.lifespan,
+            *compile_cash_flows(rs.cash_flows),
+            rs.asset_distribution.allocation,
+        )
+
+
+class SimulationResult:
+    """Terminal asset values (trials, assets) and the first year each trial could not
+    cover its expenditure (-1 if it never ran out).
+
+    values are nominal. price_index, when known, is each trial's cumulative inflation
+    factor at the end, which in_terms uses to report real values."""
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        ruin_years: np.ndarray,
+        price_index: Optional[np.ndarray] = None,
+    ):
+        self.values = values
+        self.ruin_years = ruin_years
+        self.price_index = price_index
+
+    def in_terms(self, terms: Terms) -> "SimulationResult":
+        """This result with values in @terms dollars"""
+        if terms == Terms.NOMINAL:
+            return self
+        if self.price_index is None:
+            raise ValueError("Real values need the result's price index")
+        return SimulationResult(
+            self.values / self.price_index[:, None], self.ruin_years, self.price_index
+        )
+
+    @property
+    def n(self) -> int:
+        return self.values.shape[0]
+
+    def current_values(self) -> np.ndarray:
+        # Summed column by column to match AssetDistribution.current_value exactly
+        totals = self.values[:, 0].copy()
+        for j in range(1, self.values.shape[1]):
+            totals += self.values[:, j]
+        return totals
+
+    def tail_index(self, pmin: float) -> int:
+        """Trial of the pmin tail path"""
+        order = np.argsort(self.current_values(), kind="stable")
+        return int(order[int(self.n * pmin)])
+
+    def tail_value(self, pmin: float) -> float:
+        """Equivalent to worst_case(runs, pmin).current_value()"""
+        totals = np.sort(self.current_values())
+        return float(totals[int(self.n * pmin)])
+
+    def ruin_probability(self) -> float:
+        return float(np.mean(self.ruin_years >= 0))
+
+
+class BatchResult:
+    """Terminal values of many scenarios simulated together, padded to
+    (scenarios, trials, max assets). Padding columns stay 0, so they add nothing to
+    current values."""
+
+    def __init__(
+        self, values: np.ndarray, ruin_years: np.ndarray, num_assets: np.ndarray
+    ):
+        self.values = values
+        self.ruin_years = ruin_years
+        self.num_assets = num_assets
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+    def result(self, index: int) -> SimulationResult:
+        """Unpadded result of one scenario"""
+        return SimulationResult(
+            self.values[index, :, : self.num_assets[index]].copy(),
+            self.ruin_years[index].copy(),
+        )
+
+    def current_values(self) -> np.ndarray:
+        totals = self.values[:, :, 0].copy()
+        for j in range(1, self.values.shape[2]):
+            totals += self.values[:, :, j]
+        return totals
+
+    def tail_values(self, pmin: float) -> np.ndarray:
+        """SimulationResult.tail_value of every scenario"""
+        totals = np.sort(self.current_values(), axis=1)
+        return totals[:, int(self.values.shape[1] * pmin)]
+
+    def ruin_probabilities(self) -> np.ndarray:
+        return np.mean(self.ruin_years >= 0, axis=1)
+
+
+class PaddedBatch:
+    """Many FlatScenarios stacked into arrays padded to the largest asset count.
+    Scenario i uses the first num_assets[i] asset columns and runs for t[i] years;
+    the rest is masked out."""
+
+    def __init__(self, scenarios: List[FlatScenario]):
+        s = len(scenarios)
+        width = max(flat.num_assets for flat in scenarios)
+        self.num_assets = np.array([f.num_assets for f in scenarios], dtype=np.int64)
+        self.t = np.array([f.t for f in scenarios], dtype=np.int64)
+        self.steps_per_year = np.array(
+            [f.steps_per_year for f in scenarios], dtype=np.int64
+        )
+        self.rebalance_every = np.array(
+            [f.rebalance_every for f in scenarios], dtype=np.int64
+        )
+        self.rebalance_policy = np.array(
+            [f.rebalance_policy.value for f in scenarios], dtype=np.int64
+        )
+        self.rebalance_band = np.array([f.rebalance_band for f in scenarios])
+        self.allocation = np.array(
+            [f.allocation.value for f in scenarios], dtype=np.int64
+        )
+        self.values = np.zeros((s, width))
+        self.mean_returns = np.zeros((s, width))
+        self.return_stdevs = np.zeros((s, width))
+        self.priorities = np.zeros((s, width), dtype=np.int64)
+        self.minimum_values = np.zeros((s, width))
+        self.fractions = np.zeros((s, width))
+        for i, flat in enumerate(scenarios):
+            k = flat.num_assets
+            self.values[i, :k] = flat.values
+            self.mean_returns[i, :k] = flat.mean_returns
+            self.return_stdevs[i, :k] = flat.return_stdevs
+            self.priorities[i, :k] = flat.priorities
+            self.minimum_values[i, :k] = flat.minimum_values
+            self.fractions[i, :k] = flat.fractions
+        self.expenditure = np.array([f.expenditure for f in scenarios])
+        self.inflation = np.array([f.inflation for f in scenarios])
+        self.has_reduction = np.array(
+            [f.expenditure_reduction_frac is not None for f in scenarios]
+        )
+        self.reduction_frac = np.array(
+            [
+                (
+                    0.0
+                    if f.expenditure_reduction_frac is None
+                    else float(f.expenditure_reduction_frac)
+                )
+                for f in scenarios
+            ]
+        )
+        # Padded by repeating each scenario's last year, which applies for ever
+        flows_length = max(len(f.indexed_flows) for f in scenarios)
+        self.indexed_flows = np.array(
+            [
+                np.pad(
+                    f.indexed_flows, (0, flows_length - len(f.indexed_flows)), "edge"
+                )
+                for f in scenarios
+            ]
+        )
+        self.nominal_flows = np.array(
+            [
+                np.pad(
+                    f.nominal_flows, (0, flows_length - len(f.nominal_flows)), "edge"
+                )
+                for f in scenarios
+            ]
+        )
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.values.shape[1]
+
+    @property
+    def asset_mask(self) -> np.ndarray:
+        """(scenarios, max assets), True where a scenario has that asset"""
+        return np.arange(self.width) < self.num_assets[:, None]
+
+    @property
+    def max_t(self) -> int:
+        return int(self.t.max())
+
+    @property
+    def max_steps(self) -> int:
+        return int((self.t * self.steps_per_year).max())
+
+
+class PathState:
+    """State of n simulated paths at a year boundary. Paths can be continued from it,
+    eg. from accumulation straight into retirement.
+
+    price_index is the cumulative inflation factor since year 0 and ruin_years are
+    absolute years (-1 if the path never ran out). policy_state is the per-trial
+    state of a withdrawal policy, None until a policy first runs. end_years is the
+    absolute year each path stops at under a mortality.Lifespan, None until a
+    lifespan first applies."""
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        minimum_values: np.ndarray,
+        expenditure: np.ndarray,
+        price_index: np.ndarray,
+        reduce_expenditure: np.ndarray,
+        ruin_years: np.ndarray,
+        year: int = 0,
+        policy_state: Optional[PolicyState] = None,
+        end_years: Optional[np.ndarray] = None,
+    ):
+        self.values = values
+        self.minimum_values = minimum_values
+        self.expenditure = expenditure
+        self.price_index = price_index
+        self.reduce_expenditure = reduce_expenditure
+        self.ruin_years = ruin_years
+        self.year = year
+        self.policy_state = policy_state
+        self.end_years = end_years
+
+    @property
+    def n(self) -> int:
+        return self.values.shape[0]
+
+    def copy(self) -> "PathState":
+        return PathState(
+            self.values.copy(),
+            self.minimum_values.copy(),
+            self.expenditure.copy(),
+            self.price_index.copy(),
+            self.reduce_expenditure.copy(),
+            self.ruin_years.copy(),
+            self.year,
+            copy.deepcopy(self.policy_state),
+            None if self.end_years is None else self.end_years.copy(),
+        )
+
+    def result(self) -> SimulationResult:
+        return SimulationResult(
+            self.values.copy(), self.ruin_years.copy(), self.price_index.copy()
+        )
+
+    @staticmethod
+    def initial(flat: FlatScenario, n: int) -> "PathState":
+        return PathState(
+            np.tile(flat.values, (n, 1)),
+            np.tile(flat.minimum_values, (n, 1)),
+            np.full(n, flat.expenditure),
+            np.ones(n),
+            np.zeros(n, dtype=np.bool_),
+            np.full(n, -1, dtype=np.int64),
+        )
+
+
+@njit(cache=True)
+def _rebalance(values, priorities, minimum_values, fractions):
+    num_assets = values.shape[0]
+    total_assets = 0.0
+    for j in range(num_assets):
+        total_assets += values[j]
+        values[j] = 0.0
+    if total_assets == 0:
+        return
+    remaining_assets = total_assets
+
+    start = 0
+    pc_total_min_value = 0.0
+    pc_total_fraction = 0.0
+    for i in range(num_assets):
+        pc_total_min_value += minimum_values[i]
+        pc_total_fraction += fractions[i]
+
+        if i + 1 == num_assets or (
+            priorities[start] < priorities[i + 1]
+            and (pc_total_min_value > 0 or pc_total_fraction > 0)
+        ):
+            last_pc = i + 1 == num_assets
+            if last_pc:
+                outstanding_fraction = remaining_assets / total_assets
+            else:
+                outstanding_fraction = pc_total_fraction
+
+            if pc_total_min_value > 0:
+                factor = remaining_assets / pc_total_min_value
+                if 1.0 < factor:
+                    factor = 1.0
+                for j in range(start, i + 1):
+                    values[j] = minimum_values[j] * factor
+                    remaining_assets -= values[j]
+                    if last_pc:
+                        outstanding_fraction -= values[j] / total_assets
+                    else:
+                        share = values[j] / total_assets
+                        if fractions[j] < share:
+                            share = fractions[j]
+                        outstanding_fraction -= share
+
+            if outstanding_fraction > 0:
+                amount_to_allocate = outstanding_fraction * total_assets
+                factor = remaining_assets / amount_to_allocate
+                if 1.0 < factor:
+                    factor = 1.0
+                equal_fraction_if_unallocated = 0.0
+                if last_pc:
+                    if pc_total_fraction == 0:
+                        equal_fraction_if_unallocated = outstanding_fraction / (
+                            i + 1 - start
+                        )
+                    else:
+                        factor /= pc_total_fraction / outstanding_fraction
+
+                for j in range(start, i + 1):
+                    fraction = fractions[j]
+                    if equal_fraction_if_unallocated > fraction:
+                        fraction = equal_fraction_if_unallocated
+                    new_asset_value = fraction * factor * total_assets
+                    if not new_asset_value > values[j]:
+                        new_asset_value = values[j]
+                    remaining_assets -= new_asset_value - values[j]
+                    values[j] = new_asset_value
+
+            start = i + 1
+            pc_total_min_value = 0.0
+            pc_total_fraction = 0.0
+
+        if abs(remaining_assets) < 0.001:
+            break
+
+
+# Policies as plain ints for the kernels
+_BAND = RebalancePolicy.BAND.value
+_NEVER = RebalancePolicy.NEVER.value
+_PROPORTIONAL = AllocationMode.PROPORTIONAL.value
+
+
+@njit(cache=True)
+def _proportional_value(
+    total_assets, total_min_value, total_fraction, minimum_value, fraction, num_assets
+):
+    """One asset's value under AllocationMode.PROPORTIONAL"""
+    if total_assets <= total_min_value:
+        return minimum_value * (total_assets / total_min_value)
+    remaining_assets = total_assets - total_min_value
+    if total_fraction == 0:
+        return minimum_value + remaining_assets / num_assets
+    return minimum_value + fraction * (remaining_assets / total_fraction)
+
+
+@njit(cache=True)
+def _allocate_proportional(values, minimum_values, fractions):
+    """Mirrors allocate_proportional for one trial, in place"""
+    num_assets = values.shape[0]
+    total_assets = 0.0
+    total_min_value = 0.0
+    total_fraction = 0.0
+    for j in range(num_assets):
+        total_assets += values[j]
+        total_min_value += minimum_values[j]
+        total_fraction += fractions[j]
+    if total_assets == 0:
+        for j in range(num_assets):
+            values[j] = 0.0
+        return
+    for j in range(num_assets):
+        values[j] = _proportional_value(
+            total_assets,
+            total_min_value,
+            total_fraction,
+            minimum_values[j],
+            fractions[j],
+            num_assets,
+        )
+
+
+def allocate_proportional(
+    values: np.ndarray, minimum_values: np.ndarray, fractions: np.ndarray
+) -> np.ndarray:
+    """AllocationMode.PROPORTIONAL for every trial at once: values and
+    minimum_values are (trials, assets), fractions (assets,). Returns the new
+    values. Sums run asset by asset so every trial matches _allocate_proportional
+    exactly.
+
+    Simulations only run allocation across trials in the compiled kernels, which
+    rebalance every trial in parallel. The Python reference steps one trial at a
+    time and calls this with a single row, so it gains nothing from the array
+    form."""
+    num_assets = values.shape[1]
+    total_assets = values[:, 0].copy()
+    total_min_value = minimum_values[:, 0].copy()
+    total_fraction = float(fractions[0])
+    for j in range(1, num_assets):
+        total_assets += values[:, j]
+        total_min_value += minimum_values[:, j]
+        total_fraction += float(fractions[j])
+    total_assets = total_assets[:, None]
+    total_min_value = total_min_value[:, None]
+    short = total_assets <= total_min_value
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = minimum_values * (total_assets / total_min_value)
+        remaining_assets = total_assets - total_min_value
+        if total_fraction == 0:
+            topped_up = minimum_values + remaining_assets / num_assets
+        else:
+            topped_up = minimum_values + fractions * (remaining_assets / total_fraction)
+    allocated = np.where(short, scaled, topped_up)
+    allocated[total_assets[:, 0] == 0] = 0.0
+    return allocated
+
+
+@njit(cache=True)
+def _reallocate(values, priorities, minimum_values, fractions, allocation):
+    if allocation == _PROPORTIONAL:
+        _allocate_proportional(values, minimum_values, fractions)
+    else:
+        _rebalance(values, priorities, minimum_values, fractions)
+
+
+@njit(cache=True)
+def _in_band(values, priorities, minimum_values, fractions, band, allocation):
+    """Mirrors retcalc.in_band"""
+    num_assets = values.shape[0]
+    total_assets = 0.0
+    for j in range(num_assets):
+        total_assets += values[j]
+    if total_assets <= 0:
+        return False
+    if allocation == _PROPORTIONAL:
+        total_min_value = 0.0
+        total_fraction = 0.0
+        for j in range(num_assets):
+            total_min_value += minimum_values[j]
+            total_fraction += fractions[j]
+        for j in range(num_assets):
+            target = _proportional_value(
+                total_assets,
+                total_min_value,
+                total_fraction,
+                minimum_values[j],
+                fractions[j],
+                num_assets,
+            )
+            if abs(values[j] - target) / total_assets > band:
+                return False
+        return True
+    for j in range(num_assets):
+        if values[j] < minimum_values[j] * (1 - band):
+            return False
+        if fractions[j] > 0:
+            if abs(values[j] / total_assets - fractions[j]) > band:
+                return False
+        elif priorities[j] < priorities[num_assets - 1] and values[j] > minimum_values[
+            j
+        ] * (1 + band):
+            return False
+    return True
+
+
+@njit(cache=True)
+def _rebalance_due(
+    step,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    values,
+    priorities,
+    minimum_values,
+    fractions,
+):
+    if (step + 1) % rebalance_every != 0 or rebalance_policy == _NEVER:
+        return False
+    if rebalance_policy == _BAND:
+        return not _in_band(
+            values, priorities, minimum_values, fractions, rebalance_band, allocation
+        )
+    return True
+
+
+@njit(cache=True)
+def _cash_flow(indexed_flows, nominal_flows, year, price_index):
+    """Net flow into the portfolio over a year"""
+    if year >= indexed_flows.shape[0]:
+        year = indexed_flows.shape[0] - 1
+    return indexed_flows[year] * price_index + nominal_flows[year]
+
+
+@njit(cache=True)
+def _spend(values, to_spend):
+    """Spend to_spend from the lowest priority assets up. Returns whether it could
+    not be covered."""
+    hit_zero = False
+    for j in range(values.shape[0] - 1, -1, -1):
+        if j == 0:
+            if values[0] < to_spend:
+                hit_zero = True
+            spent = to_spend
+        else:
+            spent = values[j]
+            if to_spend < spent:
+                spent = to_spend
+        values[j] -= spent
+        to_spend -= spent
+    return hit_zero
+
+
+@njit(cache=True)
+def _step(
+    values,
+    minimum_values,
+    to_spend,
+    step,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    inflation_stdev,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    inflation_shocks,
+    return_shocks,
+):
+    """Spend to_spend, then apply one step of returns and rebalancing. Returns the
+    step's inflation factor, whether spending could not be covered and whether any
+    asset returned less than its mean."""
+    num_assets = values.shape[0]
+    inflation_factor = 1 + (inflation_mean + inflation_shocks[step] * inflation_stdev)
+
+    hit_zero = _spend(values, to_spend)
+    for j in range(num_assets):
+        minimum_values[j] *= inflation_factor
+
+    below_mean = False
+    if not hit_zero:
+        for j in range(num_assets):
+            asset_return = mean_returns[j] + return_shocks[step, j] * return_stdevs[j]
+            if asset_return < mean_returns[j]:
+                below_mean = True
+            values[j] *= 1 + asset_return
+        if _rebalance_due(
+            step,
+            rebalance_every,
+            rebalance_policy,
+            rebalance_band,
+            allocation,
+            values,
+            priorities,
+            minimum_values,
+            fractions,
+        ):
+            _reallocate(values, priorities, minimum_values, fractions, allocation)
+    return inflation_factor, hit_zero, below_mean
+
+
+@njit(cache=True)
+def _simulate_trial(
+    values,
+    minimum_values,
+    expenditure,
+    price_index,
+    reduce_expenditure,
+    ruin_year,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    inflation_stdev,
+    t,
+    year_offset,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    inflation_shocks,
+    return_shocks,
+):
+    for step in range(year_offset * steps_per_year, (year_offset + t) * steps_per_year):
+        to_spend = expenditure / steps_per_year
+        if reduce_expenditure and has_reduction:
+            to_spend *= 1 - reduction_frac
+            reduce_expenditure = False
+        to_spend -= (
+            _cash_flow(
+                indexed_flows, nominal_flows, step // steps_per_year, price_index
+            )
+            / steps_per_year
+        )
+        inflation_factor, hit_zero, below_mean = _step(
+            values,
+            minimum_values,
+            to_spend,
+            step,
+            mean_returns,
+            return_stdevs,
+            priorities,
+            fractions,
+            inflation_mean,
+            inflation_stdev,
+            rebalance_every,
+            rebalance_policy,
+            rebalance_band,
+            allocation,
+            inflation_shocks,
+            return_shocks,
+        )
+        if not hit_zero:
+            # If expenditure is negative, we are earning not spending
+            reduce_expenditure = has_reduction and expenditure > 0 and below_mean
+        elif ruin_year < 0:
+            ruin_year = step // steps_per_year
+
+        expenditure *= inflation_factor
+        price_index *= inflation_factor
+
+    return expenditure, price_index, reduce_expenditure, ruin_year
+
+
+@njit(cache=True)
+def _simulate_trial_real(
+    values,
+    minimum_values,
+    expenditure,
+    price_index,
+    reduce_expenditure,
+    ruin_year,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    inflation_stdev,
+    t,
+    year_offset,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    inflation_shocks,
+    return_shocks,
+):
+    """_simulate_trial in real dollars. Values, minimum values and expenditure are
+    deflated once on entry and reinflated on exit; in between expenditure and
+    minimum values are constant and inflation only enters through real returns.
+    Equal to _simulate_trial up to rounding."""
+    num_assets = values.shape[0]
+    for j in range(num_assets):
+        values[j] /= price_index
+        minimum_values[j] /= price_index
+    real_expenditure = expenditure / price_index
+    for step in range(year_offset * steps_per_year, (year_offset + t) * steps_per_year):
+        to_spend = real_expenditure / steps_per_year
+        if reduce_expenditure and has_reduction:
+            to_spend *= 1 - reduction_frac
+            reduce_expenditure = False
+        year = step // steps_per_year
+        if year >= indexed_flows.shape[0]:
+            year = indexed_flows.shape[0] - 1
+        to_spend -= (
+            indexed_flows[year] + nominal_flows[year] / price_index
+        ) / steps_per_year
+        inflation_factor = 1 + (
+            inflation_mean + inflation_shocks[step] * inflation_stdev
+        )
+        price_index *= inflation_factor
+
+        hit_zero = _spend(values, to_spend)
+        below_mean = False
+        if not hit_zero:
+            for j in range(num_assets):
+                asset_return = (
+                    mean_returns[j] + return_shocks[step, j] * return_stdevs[j]
+                )
+                if asset_return < mean_returns[j]:
+                    below_mean = True
+                values[j] *= (1 + asset_return) / inflation_factor
+            if _rebalance_due(
+                step,
+                rebalance_every,
+                rebalance_policy,
+                rebalance_band,
+                allocation,
+                values,
+                priorities,
+                minimum_values,
+                fractions,
+            ):
+                _reallocate(values, priorities, minimum_values, fractions, allocation)
+            # If expenditure is negative, we are earning not spending
+            reduce_expenditure = has_reduction and real_expenditure > 0 and below_mean
+        else:
+            for j in range(num_assets):
+                values[j] /= inflation_factor
+            if ruin_year < 0:
+                ruin_year = step // steps_per_year
+
+    for j in range(num_assets):
+        values[j] *= price_index
+        minimum_values[j] *= price_index
+    return real_expenditure * price_index, price_index, reduce_expenditure, ruin_year
+
+
+@njit(parallel=True, cache=True)
+def _simulate_trials(
+    values,
+    minimum_values,
+    expenditure,
+    price_index,
+    reduce_expenditure,
+    ruin_years,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    inflation_stdev,
+    horizons,
+    year_offset,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    real,
+    inflation_shocks,
+    return_shocks,
+):
+    for i in prange(values.shape[0]):
+        args = (
+            values[i],
+            minimum_values[i],
+            expenditure[i],
+            price_index[i],
+            reduce_expenditure[i],
+            ruin_years[i],
+            mean_returns,
+            return_stdevs,
+            priorities,
+            fractions,
+            inflation_mean,
+            inflation_stdev,
+            horizons[i],
+            year_offset,
+            steps_per_year,
+            rebalance_every,
+            rebalance_policy,
+            rebalance_band,
+            allocation,
+            has_reduction,
+            reduction_frac,
+            indexed_flows,
+            nominal_flows,
+            inflation_shocks[i],
+            return_shocks[i],
+        )
+        if real:
+            trial = _simulate_trial_real(*args)
+        else:
+            trial = _simulate_trial(*args)
+        expenditure[i], price_index[i], reduce_expenditure[i], ruin_years[i] = trial
+
+
+@njit(parallel=True, cache=True)
+def _simulate_batch(
+    values,
+    scratch_minimum_values,
+    ruin_years,
+    num_assets,
+    t,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    initial_values,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    minimum_values,
+    fractions,
+    expenditure,
+    inflation,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    inflation_shocks,
+    return_shocks,
+):
+    n = values.shape[1]
+    # One flat loop over (scenario, trial) keeps every thread busy however the
+    # trials are split between scenarios
+    for flat_index in prange(values.shape[0] * n):
+        s = flat_index // n
+        i = flat_index % n
+        k = num_assets[s]
+        trial_values = values[s, i, :k]
+        trial_minimum_values = scratch_minimum_values[s, i, :k]
+        for j in range(k):
+            trial_values[j] = initial_values[s, j]
+            trial_minimum_values[j] = minimum_values[s, j]
+        _, _, _, ruin_years[s, i] = _simulate_trial(
+            trial_values,
+            trial_minimum_values,
+            expenditure[s],
+            1.0,
+            False,
+            -1,
+            mean_returns[s, :k],
+            return_stdevs[s, :k],
+            priorities[s, :k],
+            fractions[s, :k],
+            inflation[s, 0],
+            inflation[s, 1],
+            t[s],
+            0,
+            steps_per_year[s],
+            rebalance_every[s],
+            rebalance_policy[s],
+            rebalance_band[s],
+            allocation[s],
+            has_reduction[s],
+            reduction_frac[s],
+            indexed_flows[s],
+            nominal_flows[s],
+            inflation_shocks[i],
+            return_shocks[i],
+        )
+
+
+@njit(parallel=True, cache=True)
+def _simulate_step(
+    values,
+    minimum_values,
+    spending,
+    inflation_factors,
+    ruined,
+    below_mean,
+    growth,
+    totals,
+    end_steps,
+    mean_returns,
+    return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    inflation_stdev,
+    step,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    allocation,
+    inflation_shocks,
+    return_shocks,
+):
+    num_assets = values.shape[1]
+    for i in prange(values.shape[0]):
+        if step >= end_steps[i]:
+            inflation_factors[i] = 1.0
+            ruined[i] = False
+            below_mean[i] = False
+            growth[i] = 1.0
+            continue
+        invested = totals[i] - spending[i]
+        inflation_factors[i], ruined[i], below_mean[i] = _step(
+            values[i],
+            minimum_values[i],
+            spending[i],
+            step,
+            mean_returns,
+            return_stdevs,
+            priorities,
+            fractions,
+            inflation_mean,
+            inflation_stdev,
+            rebalance_every,
+            rebalance_policy,
+            rebalance_band,
+            allocation,
+            inflation_shocks[i],
+            return_shocks[i],
+        )
+        total = 0.0
+        for j in range(num_assets):
+            total += values[i, j]
+        totals[i] = total
+        growth[i] = total / invested if invested > 0 else 1.0
+
+
+def run_batch(batch: PaddedBatch, shocks: ShockBank, n: int) -> BatchResult:
+    """Simulate every scenario in batch over the same n shock paths"""
+    assert n <= shocks.n and batch.max_steps <= shocks.t
+    assert batch.width <= shocks.num_assets
+    values = np.zeros((len(batch), n, batch.width))
+    ruin_years = np.full((len(batch), n), -1, dtype=np.int64)
+    _simulate_batch(
+        values,
+        np.empty_like(values),
+        ruin_years,
+        batch.num_assets,
+        batch.t,
+        batch.steps_per_year,
+        batch.rebalance_every,
+        batch.rebalance_policy,
+        batch.rebalance_band,
+        batch.allocation,
+        batch.values,
+        batch.mean_returns,
+        batch.return_stdevs,
+        batch.priorities,
+        batch.minimum_values,
+        batch.fractions,
+        batch.expenditure,
+        batch.inflation,
+        batch.has_reduction,
+        batch.reduction_frac,
+        batch.indexed_flows,
+        batch.nominal_flows,
+        shocks.inflation[:n],
+        shocks.returns[:n],
+    )
+    return BatchResult(values, ruin_years, batch.num_assets.copy())
+
+
+def normal_returns(rs: RetirementSettings) -> bool:
+    """Whether every asset of rs has normal returns"""
+    return all(
+        aa.asset.return_model is None or type(aa.asset.return_model) is ReturnModel
+        for aa in rs.asset_distribution.asset_allocations
+    )
+
+
+def model_shocks(rs: RetirementSettings, shocks: ShockBank) -> ShockBank:
+    """shocks with the return shocks of rs's assets drawn from their return models,
+    so every engine runs them unchanged. The bank itself when every asset is
+    normal. Derived banks are kept on shocks, so a search probing the same bank
+    transforms it once."""
+    if normal_returns(rs):
+        return shocks
+    assets = [aa.asset for aa in rs.asset_distribution.asset_allocations]
+    models = [asset.return_model for asset in assets]
+    moments = [(float(a.mean_return), float(a.return_stdev)) for a in assets]
+    m = rs.step_frequency.value
+    key = ("returns", tuple(models), tuple(moments), rs.regimes, m)
+    if key not in shocks.derived:
+        regimes = None
+        if rs.regimes is not None:
+            if shocks.regimes is None:
+                raise ValueError("Regimes need a shock bank with regime draws")
+            regimes = rs.regimes.paths(shocks.regimes, m)
+        returns = standardized_returns(
+            shocks.returns[:, :, : len(assets)],
+            models,
+            moments,
+            lambda mean, stdev: step_moments(mean, stdev, m),
+            regimes,
+        )
+        if len(shocks.derived) >= MAX_DERIVED_BANKS:
+            del shocks.derived[next(iter(shocks.derived))]
+        shocks.derived[key] = ShockBank(
+            shocks.inflation, returns, shocks.longevity, shocks.regimes
+        )
+    return shocks.derived[key]
+
+
+def horizons(flat: FlatScenario, state: PathState, shocks: ShockBank) -> np.ndarray:
+    """Years each path in state runs for when advanced through flat: flat.t, or
+    fewer once the path's lifespan ends. Lifespans are drawn from the shock bank the
+    first time one applies and stay fixed for the rest of the paths."""
+    if flat.lifespan is not None and state.end_years is None:
+        if shocks.longevity is None:
+            raise ValueError("Lifespans need a shock bank with longevity draws")
+        state.end_years = flat.lifespan.years(shocks.longevity[: state.n])
+    if state.end_years is None:
+        return np.full(state.n, flat.t, dtype=np.int64)
+    return np.clip(state.end_years - state.year, 0, flat.t)
+
+
+def advance(
+    flat: FlatScenario,
+    state: PathState,
+    shocks: ShockBank,
+    accounting: Terms = Terms.NOMINAL,
+) -> None:
+    """Continue every path in state through flat.t more years, in place. Asset
+    parameters, inflation and the reduction rule come from flat; asset values,
+    minimum values and expenditure come from state.
+    @accounting: Dollars to simulate in; state is nominal either way."""
+    assert state.n <= shocks.n
+    assert (state.year + flat.t) * flat.steps_per_year <= shocks.t
+    assert flat.num_assets <= shocks.num_assets
+    if flat.withdrawal_policy is not None:
+        if accounting == Terms.REAL:
+            raise ValueError(
+                "Real-terms accounting does not support withdrawal policies"
+            )
+        _advance_policy(flat, state, shocks)
+        return
+    reduction_frac = flat.expenditure_reduction_frac
+    _simulate_trials(
+        state.values,
+        state.minimum_values,
+        state.expenditure,
+        state.price_index,
+        state.reduce_expenditure,
+        state.ruin_years,
+        flat.mean_returns,
+        flat.return_stdevs,
+        flat.priorities,
+        flat.fractions,
+        flat.inflation[0],
+        flat.inflation[1],
+        horizons(flat, state, shocks),
+        state.year,
+        flat.steps_per_year,
+        flat.rebalance_every,
+        flat.rebalance_policy.value,
+        flat.rebalance_band,
+        flat.allocation.value,
+        reduction_frac is not None,
+        0.0 if reduction_frac is None else float(reduction_frac),
+        flat.indexed_flows,
+        flat.nominal_flows,
+        accounting == Terms.REAL,
+        shocks.inflation[: state.n],
+        shocks.returns[: state.n],
+    )
+    state.year += flat.t
+
+
+def _advance_policy(flat: FlatScenario, state: PathState, shocks: ShockBank) -> None:
+    """advance with spending chosen by flat.withdrawal_policy. All trials move one
+    step at a time so the policy is called once per step on whole trial arrays."""
+    policy = flat.withdrawal_policy
+    assert policy is not None
+    m = flat.steps_per_year
+    n = state.n
+    inflation_factors = np.empty(n)
+    ruined = np.empty(n, dtype=np.bool_)
+    below_mean = np.empty(n, dtype=np.bool_)
+    growth = np.empty(n)
+    end_steps = (state.year + horizons(flat, state, shocks)) * m
+    # Kept up to date by the kernel
+    totals = state.values.sum(axis=1)
+    for step in range(state.year * m, (state.year + flat.t) * m):
+        before = PolicyStep(step, m, state.expenditure, totals)
+        if state.policy_state is None:
+            state.policy_state = policy.start(before)
+        year = min(step // m, len(flat.indexed_flows) - 1)
+        spending = np.ascontiguousarray(
+            policy.spending(before, state.policy_state)
+            - (flat.indexed_flows[year] * state.price_index + flat.nominal_flows[year])
+            / m,
+            dtype=float,
+        )
+        _simulate_step(
+            state.values,
+            state.minimum_values,
+            spending,
+            inflation_factors,
+            ruined,
+            below_mean,
+            growth,
+            totals,
+            end_steps,
+            flat.mean_returns,
+            flat.return_stdevs,
+            flat.priorities,
+            flat.fractions,
+            flat.inflation[0],
+            flat.inflation[1],
+            step,
+            flat.rebalance_every,
+            flat.rebalance_policy.value,
+            flat.rebalance_band,
+            flat.allocation.value,
+            shocks.inflation[:n],
+            shocks.returns[:n],
+        )
+        after = PolicyStep(
+            step, m, state.expenditure, totals, below_mean, growth, ruined
+        )
+        policy.observe(after, state.policy_state)
+        state.ruin_years[ruined & (state.ruin_years < 0)] = step // m
+        state.expenditure *= inflation_factors
+        state.price_index *= inflation_factors
+    state.year += flat.t
+
+
+def run(flat: FlatScenario, shocks: ShockBank, n: int) -> SimulationResult:
+    state = PathState.initial(flat, n)
+    advance(flat, state, shocks)
+    return state.result()
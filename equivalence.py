@@ -0,0 +1,222 @@
+"""Checks that an alternative simulation engine keeps the reference semantics.
+
+The reference runs retcalc.simulate_path (the loop behind retirement_value and
+rebalance_assets) one trial at a time. An Engine either runs on the reference's
+shock bank, and must then agree with it exactly, or draws its own shocks (eg.
+quasi-random sampling or an approximation), and must then agree in distribution:
+the two-sample Kolmogorov-Smirnov statistic of the terminal values must stay below
+its critical value, and the 95% order statistic intervals of selected quantiles
+must overlap. Every comparison also times both sides.
+
+    comparisons = compare_engines(scenarios, [ENGINES["compiled"]], n=2000)
+    print(format_report(comparisons))
+"""
+
+import math
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import engine
+from anytime import tail_interval
+from engine import Backend, FlatScenario, PaddedBatch, PathState, SimulationResult
+from retcalc import simulate_path, simulate_values
+from rettypes import RetirementSettings
+from shocks import Sampling, ShockBank
+
+# Quantiles of the terminal values compared between engines
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95)
+
+# c(alpha) of the asymptotic two-sample Kolmogorov-Smirnov critical value
+KS_COEFFICIENTS = {0.05: 1.358, 0.01: 1.628, 0.001: 1.949}
+
+
+def reference_result(
+    retirementSettings: RetirementSettings, n: int, shocks: ShockBank
+) -> SimulationResult:
+    """Terminal values and ruin years of n trials of the reference implementation"""
+    modelled = engine.model_shocks(retirementSettings, shocks)
+    flat = FlatScenario.from_retirement_settings(retirementSettings)
+    years = engine.horizons(flat, PathState.initial(flat, n), modelled)
+    values = np.empty((n, len(flat.values)))
+    ruin_years = np.empty(n, dtype=np.int64)
+    for trial in range(n):
+        path_rs = retirementSettings.copy()
+        path_rs.t = int(years[trial])
+        rs, ruin_years[trial], _ = simulate_path(path_rs, modelled, trial)
+        allocs = rs.asset_distribution.asset_allocations
+        values[trial] = [aa.asset.value for aa in allocs]
+    return SimulationResult(values, ruin_years)
+
+
+class Engine:
+    """A simulation engine to compare with the reference. run(rs, n, shocks)
+    simulates n trials of rs. Engines with shared=True are given the reference's
+    shock bank; the others are given None and draw their own shocks."""
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[RetirementSettings, int, Optional[ShockBank]], SimulationResult],
+        shared: bool = True,
+    ):
+        self.name = name
+        self.run = run
+        self.shared = shared
+
+
+def _run_batch(
+    rs: RetirementSettings, n: int, shocks: Optional[ShockBank]
+) -> SimulationResult:
+    assert shocks is not None
+    batch = PaddedBatch([FlatScenario.from_retirement_settings(rs)])
+    return engine.run_batch(batch, engine.model_shocks(rs, shocks), n).result(0)
+
+
+ENGINES: Dict[str, Engine] = {
+    "python": Engine(
+        "python", lambda rs, n, shocks: simulate_values(rs, n, shocks, Backend.PYTHON)
+    ),
+    "compiled": Engine(
+        "compiled",
+        lambda rs, n, shocks: simulate_values(rs, n, shocks, Backend.COMPILED),
+    ),
+    "batch": Engine("batch", _run_batch),
+    "sobol": Engine(
+        "sobol",
+        lambda rs, n, _: simulate_values(rs, n, sampling=Sampling.SOBOL),
+        shared=False,
+    ),
+}
+
+
+def ks_statistic(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest distance between the empirical CDFs of samples a and b"""
+    a = np.sort(a)
+    b = np.sort(b)
+    points = np.concatenate((a, b))
+    cdf_a = np.searchsorted(a, points, side="right") / len(a)
+    cdf_b = np.searchsorted(b, points, side="right") / len(b)
+    return float(np.abs(cdf_a - cdf_b).max())
+
+
+def ks_critical(n: int, m: int, alpha: float = 0.001) -> float:
+    """The statistic two samples of sizes n and m from one distribution exceed with
+    probability alpha (asymptotically)"""
+    return KS_COEFFICIENTS[alpha] * math.sqrt((n + m) / (n * m))
+
+
+class Comparison:
+    """An engine against the reference on one scenario.
+
+    exact is whether values and ruin years are identical (None for engines that
+    draw their own shocks). quantiles holds (p, reference interval, engine
+    interval) for each of QUANTILES, as (low, high) 95% bounds."""
+
+    def __init__(
+        self,
+        scenario: str,
+        engine_name: str,
+        n: int,
+        exact: Optional[bool],
+        ks: float,
+        ks_critical: float,
+        quantiles: List[Tuple[float, Tuple[float, float], Tuple[float, float]]],
+        reference_seconds: float,
+        engine_seconds: float,
+    ):
+        self.scenario = scenario
+        self.engine_name = engine_name
+        self.n = n
+        self.exact = exact
+        self.ks = ks
+        self.ks_critical = ks_critical
+        self.quantiles = quantiles
+        self.reference_seconds = reference_seconds
+        self.engine_seconds = engine_seconds
+
+    @property
+    def quantiles_agree(self) -> bool:
+        return all(
+            reference[0] <= other[1] and other[0] <= reference[1]
+            for _, reference, other in self.quantiles
+        )
+
+    @property
+    def passed(self) -> bool:
+        if self.exact is not None:
+            return self.exact
+        return self.ks <= self.ks_critical and self.quantiles_agree
+
+    @property
+    def speedup(self) -> float:
+        return self.reference_seconds / max(self.engine_seconds, 1e-9)
+
+
+def _timed(run: Callable[[], SimulationResult]) -> Tuple[SimulationResult, float]:
+    start = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - start
+
+
+def compare_engines(
+    scenarios: Dict[str, RetirementSettings],
+    engines: Sequence[Engine],
+    n: int = 2000,
+    seed: int = 0,
+    alpha: float = 0.001,
+) -> List[Comparison]:
+    """Compare every engine with the reference on every scenario. The reference
+    runs once per scenario; each engine runs once to warm up (eg. compile) and once
+    timed."""
+    comparisons = []
+    for name, rs in scenarios.items():
+        shocks = ShockBank.for_settings(rs, n, seed)
+        reference, reference_seconds = _timed(lambda: reference_result(rs, n, shocks))
+        reference_values = reference.current_values()
+        for alternative in engines:
+            engine_shocks = shocks if alternative.shared else None
+            alternative.run(rs, min(n, 16), engine_shocks)
+            result, seconds = _timed(lambda: alternative.run(rs, n, engine_shocks))
+            values = result.current_values()
+            exact = None
+            if alternative.shared:
+                exact = np.array_equal(
+                    result.values, reference.values
+                ) and np.array_equal(result.ruin_years, reference.ruin_years)
+            quantiles = []
+            for p in QUANTILES:
+                _, low, high = tail_interval(reference_values, p)
+                _, other_low, other_high = tail_interval(values, p)
+                quantiles.append((p, (low, high), (other_low, other_high)))
+            comparisons.append(
+                Comparison(
+                    name,
+                    alternative.name,
+                    n,
+                    exact,
+                    ks_statistic(reference_values, values),
+                    ks_critical(len(reference_values), len(values), alpha),
+                    quantiles,
+                    reference_seconds,
+                    seconds,
+                )
+            )
+    return comparisons
+
+
+def format_report(comparisons: List[Comparison]) -> str:
+    """One line per comparison: the verdict, how it was reached and the speedup"""
+    lines = [
+        f"{'scenario':<20} {'engine':<10} {'check':<12} {'KS':>7} {'crit':>7}"
+        f" {'speedup':>9}  result"
+    ]
+    for c in comparisons:
+        check = "exact" if c.exact is not None else "distribution"
+        lines.append(
+            f"{c.scenario:<20} {c.engine_name:<10} {check:<12} {c.ks:>7.4f}"
+            f" {c.ks_critical:>7.4f} {c.speedup:>8.1f}x  "
+            + ("pass" if c.passed else "FAIL")
+        )
+    return "\n".join(lines)
@@ -0,0 +1,140 @@
+"""The trade-off between spending, ruin risk and bequest.
+
+spending_frontier simulates one scenario at every candidate expenditure in a
+single batch over one shock bank, so each candidate sees the same market paths
+and the frontier is smooth in expenditure rather than jagged with sampling
+noise. It answers every target at once where optimize_r_var would bisect once per
+pmin:
+
+    frontier = spending_frontier(rs, np.linspace(20000, 80000, 61), pmin=0.05)
+    frontier_print(frontier)
+    frontier.max_expenditure(max_ruin=0.1)
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from engine import Backend
+from retcalc import simulate_batch
+from rettypes import RetirementSettings
+from shocks import Seed, ShockBank
+
+COLUMNS = ("expenditure", "ruin_probability", "tail_value", "median_bequest")
+
+
+class Frontier:
+    """One row per candidate expenditure: the probability of running out, the pmin
+    tail value of the terminal assets and the median bequest. Bequests are
+    terminal assets floored at 0, since a ruined path leaves nothing."""
+
+    def __init__(
+        self,
+        expenditures: np.ndarray,
+        ruin_probabilities: np.ndarray,
+        tail_values: np.ndarray,
+        median_bequests: np.ndarray,
+        pmin: float,
+    ):
+        self.expenditures = expenditures
+        self.ruin_probabilities = ruin_probabilities
+        self.tail_values = tail_values
+        self.median_bequests = median_bequests
+        self.pmin = pmin
+
+    def __len__(self) -> int:
+        return len(self.expenditures)
+
+    def rows(self) -> List[Tuple[float, float, float, float]]:
+        """(expenditure, ruin probability, tail value, median bequest) rows"""
+        return [
+            (float(e), float(r), float(t), float(b))
+            for e, r, t, b in zip(
+                self.expenditures,
+                self.ruin_probabilities,
+                self.tail_values,
+                self.median_bequests,
+            )
+        ]
+
+    def efficient(self) -> np.ndarray:
+        """Whether each row is Pareto efficient: no other row spends at least as
+        much with no more ruin risk and at least the bequest, and is better in one"""
+        spend = self.expenditures
+        ruin = self.ruin_probabilities
+        bequest = self.median_bequests
+        as_good = (
+            (spend[None, :] >= spend[:, None])
+            & (ruin[None, :] <= ruin[:, None])
+            & (bequest[None, :] >= bequest[:, None])
+        )
+        better = (
+            (spend[None, :] > spend[:, None])
+            | (ruin[None, :] < ruin[:, None])
+            | (bequest[None, :] > bequest[:, None])
+        )
+        return ~(as_good & better).any(axis=1)
+
+    def max_expenditure(
+        self, max_ruin: Optional[float] = None, emergency_min: Optional[float] = None
+    ) -> Optional[float]:
+        """Largest candidate expenditure with ruin probability at most max_ruin
+        and tail value at least emergency_min (None if no candidate qualifies)"""
+        ok = np.ones(len(self), dtype=bool)
+        if max_ruin is not None:
+            ok &= self.ruin_probabilities <= max_ruin
+        if emergency_min is not None:
+            ok &= self.tail_values >= emergency_min
+        if not ok.any():
+            return None
+        return float(self.expenditures[ok].max())
+
+    def to_structured(self) -> dict:
+        frontier_obj: dict = {"pmin": self.pmin}
+        for column, values in zip(COLUMNS, zip(*self.rows())):
+            frontier_obj[column] = list(values)
+        return frontier_obj
+
+
+def spending_frontier(
+    retirementSettings: RetirementSettings,
+    expenditures: Sequence[float],
+    pmin: float = 0.05,
+    n: int = 10_000,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    seed: Seed = None,
+) -> Frontier:
+    """retirementSettings simulated at each of expenditures over the same n paths.
+
+    @pmin: Tail probability of the tail values.
+    @shocks: By default drawn for retirementSettings from seed."""
+    expenditures = np.asarray(expenditures, dtype=float)
+    assert expenditures.ndim == 1 and len(expenditures) > 0
+    if shocks is None:
+        shocks = ShockBank.for_settings(retirementSettings, n, seed)
+    assert shocks.fits(retirementSettings, n)
+    scenarios = []
+    for expenditure in expenditures:
+        rs = retirementSettings.copy()
+        rs.expenditure = float(expenditure)
+        scenarios.append(rs)
+    batch = simulate_batch(scenarios, n, shocks, backend)
+    totals = batch.current_values()
+    return Frontier(
+        expenditures,
+        batch.ruin_probabilities(),
+        batch.tail_values(pmin),
+        np.median(np.maximum(totals, 0), axis=1),
+        pmin,
+    )
+
+
+def frontier_print(frontier: Frontier) -> None:
+    efficient = frontier.efficient()
+    print(f"{'Expenditure':>14} {'Ruin':>7} {'Tail value':>16} {'Median bequest':>16}")
+    for (expenditure, ruin, tail, bequest), ok in zip(frontier.rows(), efficient):
+        print(
+            f"${expenditure:>13,.2f} {ruin:>6.1%} ${tail:>15,.2f} ${bequest:>15,.2f}"
+            + ("" if ok else "  (dominated)")
+        )
@@ -0,0 +1,770 @@
+"""Pathwise sensitivities ("Greeks") of terminal values.
+
+Forward mode differentiation of the compiled engine: every path carries, next to its
+asset values, their derivatives with respect to k inputs (expenditure, inflation,
+and each asset's starting value, mean return, return stdev and minimum value). The
+derivatives come out of the same pass as the values, at a cost growing with k far
+slower than the 2 x k extra simulations finite differences would need.
+
+The primal computation is kept identical to engine._simulate_trial and
+engine._rebalance, so values are bit-for-bit equal to simulate_values. Branches
+(min/max, ruin, expenditure reductions) are differentiated along the branch taken,
+which is exact almost everywhere."""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from engine import (
+    FlatScenario,
+    SimulationResult,
+    _cash_flow,
+    _rebalance_due,
+    model_shocks,
+    njit,
+    prange,
+    step_moments_jacobian,
+)
+from rettypes import (
+    AllocationMode,
+    AllocationSetting,
+    AllocationValue,
+    AssetSetting,
+    DistributionSetting,
+    DistributionValue,
+    RetirementSettings,
+    RSetting,
+    RValue,
+)
+from shocks import Seed, ShockBank
+
+# Tangents are only propagated through the priority waterfall
+_WATERFALL = AllocationMode.WATERFALL.value
+
+ASSET_SETTINGS = [
+    AllocationValue(AllocationSetting.ASSET, AssetSetting.VALUE),
+    AllocationValue(AllocationSetting.ASSET, AssetSetting.MEAN_RETURN),
+    AllocationValue(AllocationSetting.ASSET, AssetSetting.RETURN_STDEV),
+    AllocationValue(AllocationSetting.MINIMUM_VALUE, None),
+]
+
+
+class Sensitivity:
+    """A scalar input to differentiate with respect to: an RValue target, plus which
+    half of the inflation (mean, stdev) tuple for RSetting.INFLATION"""
+
+    def __init__(self, rvalue: RValue, component: int = 0):
+        self.rvalue = rvalue
+        self.component = component
+
+    def _asset_target(self) -> Tuple[int, AllocationValue]:
+        dvalue = self.rvalue.dvalue
+        if dvalue is None or dvalue.allocation_value is None:
+            raise ValueError("Only single asset settings have sensitivities")
+        return dvalue.allocation_value
+
+    def label(self, retirementSettings: RetirementSettings) -> str:
+        rsetting = self.rvalue.rsetting
+        if rsetting == RSetting.EXPENDITURE:
+            return "Expenditure"
+        elif rsetting == RSetting.INFLATION:
+            return ["Inflation mean", "Inflation stdev"][self.component]
+        index, avalue = self._asset_target()
+        name = retirementSettings.asset_distribution.asset_allocations[index].asset.name
+        if avalue.allocation_setting == AllocationSetting.MINIMUM_VALUE:
+            return f"{name} minimum value"
+        return (
+            f"{name} "
+            + {
+                AssetSetting.VALUE: "value",
+                AssetSetting.MEAN_RETURN: "mean return",
+                AssetSetting.RETURN_STDEV: "return stdev",
+            }[avalue.asset_setting]
+        )
+
+    def get_val(self, retirementSettings: RetirementSettings) -> float:
+        values = []
+        rs = retirementSettings.copy()
+        rs.update_val(self.rvalue, lambda v: values.append(v) or v)
+        value = values[0]
+        return value[self.component] if isinstance(value, tuple) else value
+
+    @staticmethod
+    def asset(index: int, avalue: AllocationValue) -> "Sensitivity":
+        return Sensitivity(
+            RValue(
+                RSetting.ASSET_DISTRIBUTION,
+                DistributionValue(
+                    DistributionSetting.ASSET_ALLOCATIONS, (index, avalue)
+                ),
+            )
+        )
+
+    @staticmethod
+    def all(retirementSettings: RetirementSettings) -> List["Sensitivity"]:
+        sensitivities = [
+            Sensitivity(RValue(RSetting.EXPENDITURE)),
+            Sensitivity(RValue(RSetting.INFLATION), 0),
+            Sensitivity(RValue(RSetting.INFLATION), 1),
+        ]
+        for index in range(
+            len(retirementSettings.asset_distribution.asset_allocations)
+        ):
+            for avalue in ASSET_SETTINGS:
+                sensitivities.append(Sensitivity.asset(index, avalue))
+        return sensitivities
+
+
+class TangentSeeds:
+    """Initial derivatives of the kernel inputs (per step returns and inflation)
+    with respect to each of k sensitivities (annual figures)"""
+
+    def __init__(
+        self, sensitivities: List[Sensitivity], retirementSettings: RetirementSettings
+    ):
+        k = len(sensitivities)
+        allocs = retirementSettings.asset_distribution.asset_allocations
+        num_assets = len(allocs)
+        m = retirementSettings.step_frequency.value
+        self.values = np.zeros((k, num_assets))
+        self.mean_returns = np.zeros((k, num_assets))
+        self.return_stdevs = np.zeros((k, num_assets))
+        self.minimum_values = np.zeros((k, num_assets))
+        self.expenditure = np.zeros(k)
+        self.inflation_mean = np.zeros(k)
+        self.inflation_stdev = np.zeros(k)
+        for q, sensitivity in enumerate(sensitivities):
+            rsetting = sensitivity.rvalue.rsetting
+            if rsetting == RSetting.EXPENDITURE:
+                self.expenditure[q] = 1
+            elif rsetting == RSetting.INFLATION:
+                jacobian = step_moments_jacobian(*retirementSettings.inflation, m)
+                self.inflation_mean[q] = jacobian[0][sensitivity.component]
+                self.inflation_stdev[q] = jacobian[1][sensitivity.component]
+            elif rsetting == RSetting.ASSET_DISTRIBUTION:
+                index, avalue = sensitivity._asset_target()
+                if avalue.allocation_setting == AllocationSetting.MINIMUM_VALUE:
+                    self.minimum_values[q, index] = 1
+                elif avalue.asset_setting == AssetSetting.VALUE:
+                    self.values[q, index] = 1
+                elif avalue.asset_setting in [
+                    AssetSetting.MEAN_RETURN,
+                    AssetSetting.RETURN_STDEV,
+                ]:
+                    asset = allocs[index].asset
+                    jacobian = step_moments_jacobian(
+                        asset.mean_return, asset.return_stdev, m
+                    )
+                    component = int(avalue.asset_setting == AssetSetting.RETURN_STDEV)
+                    self.mean_returns[q, index] = jacobian[0][component]
+                    self.return_stdevs[q, index] = jacobian[1][component]
+                else:
+                    raise ValueError("Asset setting is not differentiable")
+            else:
+                raise ValueError(f"{rsetting} is not differentiable")
+
+
+# Rows of the per-trial scratch array holding derivatives of intermediate values
+_TOTAL = 0
+_REMAINING = 1
+_PC_MIN = 2
+_OUTSTANDING = 3
+_FACTOR = 4
+_AMOUNT = 5
+_EQUAL = 6
+_INFLATION = 7
+_TO_SPEND = 8
+_PRICE_INDEX = 9
+_SCRATCH_ROWS = 10
+
+
+@njit(cache=True)
+def _quotient(scratch, out, dnum, num, dden, den):
+    """Row out of scratch = d(num / den), given rows dnum and dden"""
+    for q in range(scratch.shape[1]):
+        scratch[out, q] = (scratch[dnum, q] * den - num * scratch[dden, q]) / (
+            den * den
+        )
+
+
+@njit(cache=True)
+def _rebalance_tangents(
+    values, dvalues, priorities, minimum_values, dminimum_values, fractions, scratch
+):
+    num_assets = values.shape[0]
+    k = dvalues.shape[0]
+    for q in range(k):
+        scratch[_TOTAL, q] = 0.0
+    total_assets = 0.0
+    for j in range(num_assets):
+        total_assets += values[j]
+        values[j] = 0.0
+        for q in range(k):
+            scratch[_TOTAL, q] += dvalues[q, j]
+            dvalues[q, j] = 0.0
+    if total_assets == 0:
+        return
+    remaining_assets = total_assets
+    for q in range(k):
+        scratch[_REMAINING, q] = scratch[_TOTAL, q]
+        scratch[_PC_MIN, q] = 0.0
+
+    start = 0
+    pc_total_min_value = 0.0
+    pc_total_fraction = 0.0
+    for i in range(num_assets):
+        pc_total_min_value += minimum_values[i]
+        for q in range(k):
+            scratch[_PC_MIN, q] += dminimum_values[q, i]
+        pc_total_fraction += fractions[i]
+
+        if i + 1 == num_assets or (
+            priorities[start] < priorities[i + 1]
+            and (pc_total_min_value > 0 or pc_total_fraction > 0)
+        ):
+            last_pc = i + 1 == num_assets
+            if last_pc:
+                outstanding_fraction = remaining_assets / total_assets
+                _quotient(
+                    scratch,
+                    _OUTSTANDING,
+                    _REMAINING,
+                    remaining_assets,
+                    _TOTAL,
+                    total_assets,
+                )
+            else:
+                outstanding_fraction = pc_total_fraction
+                for q in range(k):
+                    scratch[_OUTSTANDING, q] = 0.0
+
+            if pc_total_min_value > 0:
+                factor = remaining_assets / pc_total_min_value
+                _quotient(
+                    scratch,
+                    _FACTOR,
+                    _REMAINING,
+                    remaining_assets,
+                    _PC_MIN,
+                    pc_total_min_value,
+                )
+                if 1.0 < factor:
+                    factor = 1.0
+                    for q in range(k):
+                        scratch[_FACTOR, q] = 0.0
+                for j in range(start, i + 1):
+                    values[j] = minimum_values[j] * factor
+                    for q in range(k):
+                        dvalues[q, j] = (
+                            dminimum_values[q, j] * factor
+                            + minimum_values[j] * scratch[_FACTOR, q]
+                        )
+                        scratch[_REMAINING, q] -= dvalues[q, j]
+                    remaining_assets -= values[j]
+                    share = values[j] / total_assets
+                    if last_pc or not fractions[j] < share:
+                        for q in range(k):
+                            scratch[_OUTSTANDING, q] -= (
+                                dvalues[q, j] * total_assets
+                                - values[j] * scratch[_TOTAL, q]
+                            ) / (total_assets * total_assets)
+                    if last_pc:
+                        outstanding_fraction -= values[j] / total_assets
+                    else:
+                        if fractions[j] < share:
+                            share = fractions[j]
+                        outstanding_fraction -= share
+
+            if outstanding_fraction > 0:
+                amount_to_allocate = outstanding_fraction * total_assets
+                for q in range(k):
+                    scratch[_AMOUNT, q] = (
+                        scratch[_OUTSTANDING, q] * total_assets
+                        + outstanding_fraction * scratch[_TOTAL, q]
+                    )
+                factor = remaining_assets / amount_to_allocate
+                _quotient(
+                    scratch,
+                    _FACTOR,
+                    _REMAINING,
+                    remaining_assets,
+                    _AMOUNT,
+                    amount_to_allocate,
+                )
+                if 1.0 < factor:
+                    factor = 1.0
+                    for q in range(k):
+                        scratch[_FACTOR, q] = 0.0
+                equal_fraction_if_unallocated = 0.0
+                for q in range(k):
+                    scratch[_EQUAL, q] = 0.0
+                if last_pc:
+                    if pc_total_fraction == 0:
+                        count = i + 1 - start
+                        equal_fraction_if_unallocated = outstanding_fraction / count
+                        for q in range(k):
+                            scratch[_EQUAL, q] = scratch[_OUTSTANDING, q] / count
+                    else:
+                        ratio = pc_total_fraction / outstanding_fraction
+                        for q in range(k):
+                            dratio = (
+                                -pc_total_fraction
+                                * scratch[_OUTSTANDING, q]
+                                / (outstanding_fraction * outstanding_fraction)
+                            )
+                            scratch[_FACTOR, q] = (
+                                scratch[_FACTOR, q] * ratio - factor * dratio
+                            ) / (ratio * ratio)
+                        factor /= ratio
+
+                for j in range(start, i + 1):
+                    fraction = fractions[j]
+                    use_equal = equal_fraction_if_unallocated > fraction
+                    if use_equal:
+                        fraction = equal_fraction_if_unallocated
+                    new_asset_value = fraction * factor * total_assets
+                    if not new_asset_value > values[j]:
+                        continue
+                    for q in range(k):
+                        dnew = (
+                            (scratch[_EQUAL, q] if use_equal else 0.0)
+                            * factor
+                            * total_assets
+                            + fraction * scratch[_FACTOR, q] * total_assets
+                            + fraction * factor * scratch[_TOTAL, q]
+                        )
+                        scratch[_REMAINING, q] -= dnew - dvalues[q, j]
+                        dvalues[q, j] = dnew
+                    remaining_assets -= new_asset_value - values[j]
+                    values[j] = new_asset_value
+
+            start = i + 1
+            pc_total_min_value = 0.0
+            pc_total_fraction = 0.0
+            for q in range(k):
+                scratch[_PC_MIN, q] = 0.0
+
+        if abs(remaining_assets) < 0.001:
+            break
+
+
+@njit(cache=True)
+def _simulate_trial_tangents(
+    values,
+    dvalues,
+    minimum_values,
+    dminimum_values,
+    expenditure,
+    dexpenditure,
+    mean_returns,
+    dmean_returns,
+    return_stdevs,
+    dreturn_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    dinflation_mean,
+    inflation_stdev,
+    dinflation_stdev,
+    t,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    inflation_shocks,
+    return_shocks,
+    scratch,
+):
+    num_assets = values.shape[0]
+    k = dvalues.shape[0]
+    reduce_expenditure = False
+    ruin_year = -1
+    price_index = 1.0
+    for q in range(k):
+        scratch[_PRICE_INDEX, q] = 0.0
+    for step in range(t * steps_per_year):
+        inflation_factor = 1 + (
+            inflation_mean + inflation_shocks[step] * inflation_stdev
+        )
+        for q in range(k):
+            scratch[_INFLATION, q] = (
+                dinflation_mean[q] + inflation_shocks[step] * dinflation_stdev[q]
+            )
+
+        to_spend = expenditure / steps_per_year
+        for q in range(k):
+            scratch[_TO_SPEND, q] = dexpenditure[q] / steps_per_year
+        if reduce_expenditure and has_reduction:
+            to_spend *= 1 - reduction_frac
+            for q in range(k):
+                scratch[_TO_SPEND, q] *= 1 - reduction_frac
+            reduce_expenditure = False
+        year = step // steps_per_year
+        to_spend -= (
+            _cash_flow(indexed_flows, nominal_flows, year, price_index) / steps_per_year
+        )
+        if year >= indexed_flows.shape[0]:
+            year = indexed_flows.shape[0] - 1
+        for q in range(k):
+            scratch[_TO_SPEND, q] -= (
+                indexed_flows[year] * scratch[_PRICE_INDEX, q] / steps_per_year
+            )
+        hit_zero = False
+        for j in range(num_assets - 1, -1, -1):
+            spend_all = True
+            if j == 0:
+                if values[0] < to_spend:
+                    hit_zero = True
+                spent = to_spend
+            else:
+                spent = values[j]
+                spend_all = to_spend < spent
+                if spend_all:
+                    spent = to_spend
+            for q in range(k):
+                dspent = scratch[_TO_SPEND, q] if spend_all else dvalues[q, j]
+                dvalues[q, j] -= dspent
+                scratch[_TO_SPEND, q] -= dspent
+                dminimum_values[q, j] = (
+                    dminimum_values[q, j] * inflation_factor
+                    + minimum_values[j] * scratch[_INFLATION, q]
+                )
+            values[j] -= spent
+            to_spend -= spent
+            minimum_values[j] *= inflation_factor
+
+        if not hit_zero:
+            below_mean = False
+            for j in range(num_assets):
+                asset_return = (
+                    mean_returns[j] + return_shocks[step, j] * return_stdevs[j]
+                )
+                if asset_return < mean_returns[j]:
+                    below_mean = True
+                for q in range(k):
+                    dreturn = (
+                        dmean_returns[q, j]
+                        + return_shocks[step, j] * dreturn_stdevs[q, j]
+                    )
+                    dvalues[q, j] = (
+                        dvalues[q, j] * (1 + asset_return) + values[j] * dreturn
+                    )
+                values[j] *= 1 + asset_return
+            if _rebalance_due(
+                step,
+                rebalance_every,
+                rebalance_policy,
+                rebalance_band,
+                _WATERFALL,
+                values,
+                priorities,
+                minimum_values,
+                fractions,
+            ):
+                _rebalance_tangents(
+                    values,
+                    dvalues,
+                    priorities,
+                    minimum_values,
+                    dminimum_values,
+                    fractions,
+                    scratch,
+                )
+            # If expenditure is negative, we are earning not spending
+            reduce_expenditure = has_reduction and expenditure > 0 and below_mean
+        elif ruin_year < 0:
+            ruin_year = step // steps_per_year
+
+        for q in range(k):
+            dexpenditure[q] = (
+                dexpenditure[q] * inflation_factor
+                + expenditure * scratch[_INFLATION, q]
+            )
+            scratch[_PRICE_INDEX, q] = (
+                scratch[_PRICE_INDEX, q] * inflation_factor
+                + price_index * scratch[_INFLATION, q]
+            )
+        expenditure *= inflation_factor
+        price_index *= inflation_factor
+
+    return ruin_year
+
+
+@njit(parallel=True, cache=True)
+def _simulate_trials_tangents(
+    values,
+    dvalues,
+    ruin_years,
+    trial_minimum_values,
+    trial_dminimum_values,
+    trial_dexpenditure,
+    scratch,
+    initial_values,
+    seed_values,
+    minimum_values,
+    seed_minimum_values,
+    expenditure,
+    seed_expenditure,
+    mean_returns,
+    seed_mean_returns,
+    return_stdevs,
+    seed_return_stdevs,
+    priorities,
+    fractions,
+    inflation_mean,
+    seed_inflation_mean,
+    inflation_stdev,
+    seed_inflation_stdev,
+    t,
+    steps_per_year,
+    rebalance_every,
+    rebalance_policy,
+    rebalance_band,
+    has_reduction,
+    reduction_frac,
+    indexed_flows,
+    nominal_flows,
+    inflation_shocks,
+    return_shocks,
+):
+    for i in prange(values.shape[0]):
+        values[i] = initial_values
+        dvalues[i] = seed_values
+        trial_minimum_values[i] = minimum_values
+        trial_dminimum_values[i] = seed_minimum_values
+        trial_dexpenditure[i] = seed_expenditure
+        ruin_years[i] = _simulate_trial_tangents(
+            values[i],
+            dvalues[i],
+            trial_minimum_values[i],
+            trial_dminimum_values[i],
+            expenditure,
+            trial_dexpenditure[i],
+            mean_returns,
+            seed_mean_returns,
+            return_stdevs,
+            seed_return_stdevs,
+            priorities,
+            fractions,
+            inflation_mean,
+            seed_inflation_mean,
+            inflation_stdev,
+            seed_inflation_stdev,
+            t,
+            steps_per_year,
+            rebalance_every,
+            rebalance_policy,
+            rebalance_band,
+            has_reduction,
+            reduction_frac,
+            indexed_flows,
+            nominal_flows,
+            inflation_shocks[i],
+            return_shocks[i],
+            scratch[i],
+        )
+
+
+class SensitivityResult(SimulationResult):
+    """SimulationResult plus dvalues (trials, sensitivities, assets): the derivative
+    of each terminal asset value with respect to each sensitivity"""
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        ruin_years: np.ndarray,
+        dvalues: np.ndarray,
+        sensitivities: List[Sensitivity],
+    ):
+        super().__init__(values, ruin_years)
+        self.dvalues = dvalues
+        self.sensitivities = sensitivities
+
+    def current_value_gradients(self) -> np.ndarray:
+        """(trials, sensitivities) derivatives of each path's total value"""
+        return self.dvalues.sum(axis=2)
+
+    def tail_gradient(self, pmin: float, window: Optional[int] = None) -> np.ndarray:
+        """Derivative of tail_value(pmin) with respect to each sensitivity, estimated
+        by averaging the gradients of the paths ranked within window of the tail path
+        (a single path's gradient is noisy where paths cross)"""
+        if window is None:
+            window = max(1, self.n // 200)
+        order = np.argsort(self.current_values(), kind="stable")
+        rank = int(self.n * pmin)
+        nearby = order[max(0, rank - window) : rank + window + 1]
+        return self.current_value_gradients()[nearby].mean(axis=0)
+
+
+def simulate_sensitivities(
+    retirementSettings: RetirementSettings,
+    n: int,
+    sensitivities: Optional[List[Sensitivity]] = None,
+    shocks: Optional[ShockBank] = None,
+    seed: Seed = None,
+) -> SensitivityResult:
+    """simulate_values, also differentiating every path's terminal asset values with
+    respect to sensitivities (all of them by default)"""
+    if retirementSettings.withdrawal_policy is not None:
+        raise ValueError("Sensitivities need fixed spending, not a withdrawal policy")
+    if retirementSettings.lifespan is not None:
+        raise ValueError("Sensitivities need a fixed horizon, not a lifespan")
+    if retirementSettings.asset_distribution.allocation != AllocationMode.WATERFALL:
+        raise ValueError("Sensitivities need the priority waterfall allocation")
+    for aa in retirementSettings.asset_distribution.asset_allocations:
+        model = aa.asset.return_model
+        if model is not None and not model.location_scale:
+            raise ValueError(f"Sensitivities do not support {model.name} returns")
+    if sensitivities is None:
+        sensitivities = Sensitivity.all(retirementSettings)
+    if shocks is None:
+        shocks = ShockBank.for_settings(retirementSettings, n, seed)
+    assert shocks.fits(retirementSettings, n)
+    shocks = model_shocks(retirementSettings, shocks)
+    flat = FlatScenario.from_retirement_settings(retirementSettings)
+    seeds = TangentSeeds(sensitivities, retirementSettings)
+    values = np.empty((n, flat.num_assets))
+    dvalues = np.empty((n, len(sensitivities), flat.num_assets))
+    ruin_years = np.empty(n, dtype=np.int64)
+    reduction_frac = flat.expenditure_reduction_frac
+    _simulate_trials_tangents(
+        values,
+        dvalues,
+        ruin_years,
+        np.empty_like(values),
+        np.empty_like(dvalues),
+        np.empty((n, len(sensitivities))),
+        np.empty((n, _SCRATCH_ROWS, len(sensitivities))),
+        flat.values,
+        seeds.values,
+        flat.minimum_values,
+        seeds.minimum_values,
+        flat.expenditure,
+        seeds.expenditure,
+        flat.mean_returns,
+        seeds.mean_returns,
+        flat.return_stdevs,
+        seeds.return_stdevs,
+        flat.priorities,
+        flat.fractions,
+        flat.inflation[0],
+        seeds.inflation_mean,
+        flat.inflation[1],
+        seeds.inflation_stdev,
+        flat.t,
+        flat.steps_per_year,
+        flat.rebalance_every,
+        flat.rebalance_policy.value,
+        flat.rebalance_band,
+        reduction_frac is not None,
+        0.0 if reduction_frac is None else float(reduction_frac),
+        flat.indexed_flows,
+        flat.nominal_flows,
+        shocks.inflation[:n],
+        shocks.returns[:n],
+    )
+    return SensitivityResult(values, ruin_years, dvalues, sensitivities)
+
+
+def newton_optimize_r_var(
+    retirementSettings: RetirementSettings,
+    r_var_to_opt: RValue,
+    maximize: bool,
+    pmin: float,
+    n: int = 10_000,
+    shocks: Optional[ShockBank] = None,
+    seed: Seed = None,
+    tolerance: float = 100,
+    max_probes: int = 50,
+) -> float:
+    """optimize_r_var using the tail value's slope: Newton steps on the tail margin
+    (tail value - emergency minimum), safeguarded by bisection once the root is
+    bracketed. All probes share one shock bank, so the margin is a deterministic
+    function of the value. Returns a value within tolerance of the root on the
+    side where the margin is non-negative.
+    @r_var_to_opt: Expenditure, emergency minimum, or an asset's value, mean
+    return, return stdev or minimum value."""
+    if shocks is None:
+        shocks = ShockBank.for_settings(retirementSettings, n, seed)
+    rs = retirementSettings.copy()
+    emergency_min = r_var_to_opt.rsetting == RSetting.EMERGENCY_MIN
+    sensitivity = Sensitivity(r_var_to_opt)
+
+    def margin_and_slope(value: float) -> Tuple[float, float]:
+        rs.update_val(r_var_to_opt, lambda _: value)
+        if emergency_min:
+            result = simulate_sensitivities(rs, n, [], shocks)
+            return result.tail_value(pmin) - value, -1.0
+        result = simulate_sensitivities(rs, n, [sensitivity], shocks)
+        margin = result.tail_value(pmin) - rs.emergency_min
+        return margin, float(result.tail_gradient(pmin)[0])
+
+    # Bracket ends: feasible (margin >= 0) and infeasible values seen so far
+    feasible: Optional[float] = None
+    infeasible: Optional[float] = None
+    value = sensitivity.get_val(rs) or tolerance
+    for _ in range(max_probes):
+        margin, slope = margin_and_slope(value)
+        if margin >= 0:
+            feasible = value
+        else:
+            infeasible = value
+        if feasible is not None and infeasible is not None:
+            if abs(feasible - infeasible) <= tolerance:
+                return feasible
+        step = -margin / slope if slope != 0 and np.isfinite(slope) else None
+        if step is not None and abs(step) < tolerance / 2:
+            # Converged: step just past the root to bracket it within tolerance
+            step = float(np.copysign(tolerance / 2, step))
+        next_value = None if step is None else value + step
+        if feasible is not None and infeasible is not None:
+            low, high = sorted((feasible, infeasible))
+            if next_value is None or not low < next_value < high:
+                next_value = (low + high) / 2
+        elif next_value is None:
+            # No slope to follow: move away from the known end like the bracketing
+            # phase of optimize_r_var
+            next_value = value * 2 if (margin >= 0) == maximize else value / 2
+        value = next_value
+    raise RuntimeError(f"Newton search did not converge in {max_probes} probes")
+
+
+def tornado(
+    retirementSettings: RetirementSettings,
+    pmin: float,
+    n: int = 10_000,
+    relative_change: float = 0.1,
+    sensitivities: Optional[List[Sensitivity]] = None,
+    shocks: Optional[ShockBank] = None,
+    seed: Seed = None,
+) -> List[Tuple[str, float]]:
+    """Estimated change in tail_value(pmin) from raising each input by
+    relative_change of its value, largest effect first. One simulation pass."""
+    if sensitivities is None:
+        sensitivities = Sensitivity.all(retirementSettings)
+    result = simulate_sensitivities(retirementSettings, n, sensitivities, shocks, seed)
+    gradient = result.tail_gradient(pmin)
+    report = [
+        (
+            sensitivity.label(retirementSettings),
+            float(gradient[q])
+            * relative_change
+            * abs(sensitivity.get_val(retirementSettings)),
+        )
+        for q, sensitivity in enumerate(sensitivities)
+    ]
+    report.sort(key=lambda row: abs(row[1]), reverse=True)
+    return report
+
+
+def tornado_print(report: List[Tuple[str, float]], width: int = 40) -> None:
+    largest = max([abs(effect) for _, effect in report] + [1e-12])
+    label_width = max(len(label) for label, _ in report)
+    for label, effect in report:
+        bar = "#" * round(abs(effect) / largest * width)
+        sign = "+" if effect >= 0 else "-"
+        print(f"{label:>{label_width}} {sign}${abs(effect):>14,.2f} {bar}")
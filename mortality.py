@@ -0,0 +1,111 @@
+"""Stochastic lifespans drawn from a period life table.
+
+With a Lifespan on RetirementSettings every trial gets its own horizon: the years
+until the last person covered by the plan dies, capped at RetirementSettings.t.
+Horizons come from the uniform longevity draws of the ShockBank, so every engine
+and every probe of an optimization sees the same deaths, and they are all drawn
+up front. A path stops being simulated after its horizon, so its terminal values
+are the estate left at death and ruin means running out before death.
+
+The bundled life_table.csv is a Gompertz-Makeham approximation of a recent US
+period life table (life expectancy at 65 of 18.0 years for men and 20.6 for
+women); any table in the same age,male,female format can be loaded instead."""
+
+from enum import Enum
+from functools import lru_cache
+from os import path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+LIFE_TABLE_FILEPATH = path.join(path.dirname(path.abspath(__file__)), "life_table.csv")
+
+# Lives a ShockBank draws longevity for
+MAX_LIVES = 2
+
+
+class Sex(Enum):
+    MALE = 1
+    FEMALE = 2
+
+
+class LifeTable:
+    """Probability of dying within a year at each age, from age 0; the last age is
+    always fatal."""
+
+    def __init__(self, death_probabilities: Dict[Sex, np.ndarray]):
+        for q in death_probabilities.values():
+            assert q[-1] == 1
+        self.death_probabilities = death_probabilities
+
+    @property
+    def max_age(self) -> int:
+        return len(next(iter(self.death_probabilities.values()))) - 1
+
+    def survival(self, sex: Sex, age: int) -> np.ndarray:
+        """Probability of being alive k years after reaching age, for k = 0, 1, ...
+        up to (and including) the first k that is certainly dead"""
+        q = self.death_probabilities[sex][min(age, self.max_age) :]
+        return np.concatenate(([1.0], np.cumprod(1 - q)))
+
+    def life_expectancy(self, sex: Sex, age: int) -> float:
+        """Expected further years of life, assuming deaths mid-year"""
+        return float(self.survival(sex, age)[1:].sum() + 0.5)
+
+    @staticmethod
+    def load(filepath: str = LIFE_TABLE_FILEPATH) -> "LifeTable":
+        table = np.loadtxt(filepath, delimiter=",", skiprows=1)
+        assert (table[:, 0] == np.arange(len(table))).all(), "ages must be 0, 1, ..."
+        return LifeTable({Sex.MALE: table[:, 1], Sex.FEMALE: table[:, 2]})
+
+
+@lru_cache(maxsize=None)
+def default_life_table() -> LifeTable:
+    return LifeTable.load()
+
+
+class Lifespan:
+    """The people a plan must last for, with their ages at year 0. One person is a
+    single life; two are a joint-survivor plan that lasts until the second death."""
+
+    def __init__(self, ages: List[int], sexes: List[Sex]):
+        assert 1 <= len(ages) <= MAX_LIVES and len(ages) == len(sexes)
+        self.ages = ages
+        self.sexes = sexes
+
+    def years(
+        self, longevity: np.ndarray, life_table: Optional[LifeTable] = None
+    ) -> np.ndarray:
+        """Years each trial lasts, including the year of the last death, from
+        longevity draws of shape (trials, >= number of lives)"""
+        if life_table is None:
+            life_table = default_life_table()
+        years = np.zeros(longevity.shape[0], dtype=np.int64)
+        for i, (age, sex) in enumerate(zip(self.ages, self.sexes)):
+            survival = life_table.survival(sex, age)
+            # Dying in year k leaves survival[k + 1] < u <= survival[k]
+            died = np.searchsorted(-survival[1:], -longevity[:, i], side="right")
+            years = np.maximum(years, died + 1)
+        return years
+
+    def copy(self) -> "Lifespan":
+        return Lifespan(list(self.ages), list(self.sexes))
+
+    @staticmethod
+    def from_structured(lifespan_obj: dict) -> "Lifespan":
+        return Lifespan(
+            list(lifespan_obj["ages"]), [Sex[sex] for sex in lifespan_obj["sexes"]]
+        )
+
+    def to_structured(self) -> dict:
+        return {"ages": list(self.ages), "sexes": [sex.name for sex in self.sexes]}
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, Lifespan)
+            and self.ages == other.ages
+            and self.sexes == other.sexes
+        )
+
+    def __hash__(self) -> int:
+        return hash((tuple(self.ages), tuple(self.sexes)))
@@ -1,9 +1,29 @@
 from os import path, listdir, mkdir
 import random
-from typing import List, Optional, MutableSet, Tuple
-
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+import engine
+from engine import (
+    Backend,
+    BatchResult,
+    FlatScenario,
+    PaddedBatch,
+    PathState,
+    SimulationResult,
+    Terms,
+    allocate_proportional,
+    compile_cash_flows,
+    model_shocks,
+    normal_returns,
+    step_moments,
+)
+from greeks import tornado, tornado_print
 from prompt import choose, takebool, takefloat, takeint
 from rettypes import *
+from shocks import Sampling, Seed, ShockBank
+from store import ScenarioStore
 from yaml_helper import load_yaml, dump_yaml
 
 
@@ -24,7 +44,11 @@ def save_retirement_settings(
 def select_retirement_settings_file() -> Optional[str]:
     if not path.isdir(SAVED_SCENARIOS_DIRNAME):
         mkdir(SAVED_SCENARIOS_DIRNAME)
-    files = [(filename, filename) for filename in listdir(SAVED_SCENARIOS_DIRNAME)]
+    files = [
+        (filename, filename)
+        for filename in sorted(listdir(SAVED_SCENARIOS_DIRNAME))
+        if filename.endswith(".yaml")
+    ]
     if len(files) == 0:
         print("No saved retirement scenarios available")
         return None
@@ -46,6 +70,12 @@ def select_and_load_retirement_settings() -> Optional["RetirementSettings"]:
     return load_retirement_settings(filepath)
 
 
+def load_retirement_settings_dir(dirpath: str) -> List["RetirementSettings"]:
+    """Every saved scenario in dirpath, in filename order. Goes through the
+    directory's ScenarioStore, so unchanged files are not parsed again"""
+    return ScenarioStore(dirpath).load_all()
+
+
 def inflated_val(val: float, r: float, t: int):
     return val * ((1 + r) ** t)
 
@@ -57,31 +87,80 @@ def inflated_payments(payment: float, r: float, t: int) -> float:
     return total
 
 
-def retirement_value(retirementSettings: RetirementSettings) -> RetirementSettings:
+def gauss(mean: float, stdev: float, shock: Optional[float]) -> float:
+    """Draw from N(mean, stdev), or use a pre-drawn standard normal shock"""
+    if shock is None:
+        return random.gauss(mean, stdev)
+    return mean + float(shock) * stdev
+
+
+def retirement_value(
+    retirementSettings: RetirementSettings,
+    shocks: Optional[ShockBank] = None,
+    trial: int = 0,
+) -> RetirementSettings:
     """Main simulation loop.
 
     @expenditure_reduction_frac: Reduce next year's expenditure by this fraction after
     a year where any asset performs worse than its mean return.
-    TODO: Allow for selecting particular assets."""
+    TODO: Allow for selecting particular assets.
+    @shocks: Use row @trial of this shock bank instead of drawing new random values.
+    Assets with a return model always draw from a shock bank."""
+    if shocks is None and not normal_returns(retirementSettings):
+        shocks, trial = ShockBank.for_settings(retirementSettings, 1), 0
+    if shocks is not None:
+        shocks = model_shocks(retirementSettings, shocks)
+    return simulate_path(retirementSettings, shocks, trial)[0]
+
+
+def simulate_path(
+    retirementSettings: RetirementSettings,
+    shocks: Optional[ShockBank] = None,
+    trial: int = 0,
+    year_offset: int = 0,
+    reduce_expenditure: bool = False,
+    price_index: float = 1.0,
+) -> Tuple[RetirementSettings, int, bool]:
+    """retirement_value, also returning the first year expenditure could not be
+    covered (-1 if never) and whether the next step's expenditure is reduced.
+
+    @shocks: Return shocks already drawn from the assets' models (model_shocks).
+    @year_offset, @reduce_expenditure, @price_index: Continue a path from this year
+    of the shock bank, with this pending reduction and cumulative inflation."""
+    if retirementSettings.withdrawal_policy is not None:
+        raise ValueError("Withdrawal policies run on whole trials, use simulate_values")
     new_rs = retirementSettings.copy()
+    allocs = new_rs.asset_distribution.asset_allocations
+    # Returns and inflation scaled to one step; expenditure is spent in m parts
+    m = retirementSettings.step_frequency.value
+    rebalance_every = m // retirementSettings.rebalance_frequency.value
+    inflation = step_moments(*new_rs.inflation, m)
+    returns = [
+        step_moments(aa.asset.mean_return, aa.asset.return_stdev, m) for aa in allocs
+    ]
+
+    indexed_flows, nominal_flows = compile_cash_flows(retirementSettings.cash_flows)
 
-    reduce_expenditure = False
-    while new_rs.t > 0:
-        inflation_s = random.gauss(*new_rs.inflation)
+    ruin_year = -1
+    for step in range(year_offset * m, (year_offset + retirementSettings.t) * m):
+        inflation_s = gauss(
+            *inflation,
+            None if shocks is None else shocks.inflation[trial, step],
+        )
         inflation_factor = 1 + inflation_s
 
-        to_spend = new_rs.expenditure
+        to_spend = new_rs.expenditure / m
         if (
             reduce_expenditure
             and retirementSettings.expenditure_reduction_frac is not None
         ):
             to_spend *= 1 - retirementSettings.expenditure_reduction_frac
             reduce_expenditure = False
+        year = min(step // m, len(indexed_flows) - 1)
+        to_spend -= (indexed_flows[year] * price_index + nominal_flows[year]) / m
         hit_zero = False
-        for ri, asset_alloc in enumerate(
-            reversed(new_rs.asset_distribution.asset_allocations)
-        ):
-            if ri == len(new_rs.asset_distribution.asset_allocations) - 1:
+        for ri, asset_alloc in enumerate(reversed(allocs)):
+            if ri == len(allocs) - 1:
                 if asset_alloc.asset.value < to_spend:
                     hit_zero = True
                 spent = to_spend
@@ -92,29 +171,257 @@ def retirement_value(retirementSettings: RetirementSettings) -> RetirementSettin
             asset_alloc.minimum_value *= inflation_factor
 
         if not hit_zero:
-            for asset_alloc in new_rs.asset_distribution.asset_allocations:
-                asset_return = random.gauss(
-                    asset_alloc.asset.mean_return, asset_alloc.asset.return_stdev
-                )
-                # If expenditure is negative, we are earning not spending
-                reduce_expenditure = (
-                    retirementSettings.expenditure_reduction_frac is not None
-                    and new_rs.expenditure > 0
-                    and asset_return < asset_alloc.asset.mean_return
+            below_mean = False
+            for i, asset_alloc in enumerate(allocs):
+                mean_return, return_stdev = returns[i]
+                asset_return = gauss(
+                    mean_return,
+                    return_stdev,
+                    None if shocks is None else shocks.returns[trial, step, i],
                 )
+                below_mean = below_mean or asset_return < mean_return
                 asset_alloc.asset.value *= 1 + asset_return
-            rebalance_assets(new_rs.asset_distribution.asset_allocations)
+            # If expenditure is negative, we are earning not spending
+            reduce_expenditure = (
+                retirementSettings.expenditure_reduction_frac is not None
+                and new_rs.expenditure > 0
+                and below_mean
+            )
+            if (step + 1) % rebalance_every == 0 and rebalance_due(
+                allocs,
+                retirementSettings.rebalance_policy,
+                retirementSettings.rebalance_band,
+                new_rs.asset_distribution.allocation,
+            ):
+                rebalance_assets(allocs, new_rs.asset_distribution.allocation)
+        elif ruin_year < 0:
+            ruin_year = step // m
 
         new_rs.expenditure *= inflation_factor
-        new_rs.t -= 1
+        price_index *= inflation_factor
+        if (step + 1) % m == 0:
+            new_rs.t -= 1
 
-    return new_rs
+    return new_rs, ruin_year, reduce_expenditure
 
 
 def simulate(
-    retirementSettings: RetirementSettings, n: int
+    retirementSettings: RetirementSettings,
+    n: int,
+    shocks: Optional[ShockBank] = None,
 ) -> List[RetirementSettings]:
-    return [retirement_value(retirementSettings.copy()) for _ in range(n)]
+    return [
+        retirement_value(retirementSettings.copy(), shocks, trial) for trial in range(n)
+    ]
+
+
+def simulate_values(
+    retirementSettings: RetirementSettings,
+    n: int,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    sampling: Sampling = Sampling.PSEUDO_RANDOM,
+    accounting: Terms = Terms.NOMINAL,
+) -> SimulationResult:
+    """Simulate n trials, keeping only terminal asset values and ruin years.
+
+    Backend.AUTO uses the compiled engine when numba is installed and falls back to
+    the pure Python engine otherwise. Both give identical results for the same
+    shocks. @sampling selects how shocks are drawn when none are given.
+    @accounting: See advance_paths. Results are nominal either way; use
+    SimulationResult.in_terms for real values."""
+    if shocks is None:
+        shocks = ShockBank.for_settings(retirementSettings, n, sampling=sampling)
+    assert shocks.fits(retirementSettings, n)
+    state = PathState.initial(
+        FlatScenario.from_retirement_settings(retirementSettings), n
+    )
+    advance_paths(retirementSettings, state, shocks, backend, accounting)
+    return state.result()
+
+
+def advance_paths(
+    retirementSettings: RetirementSettings,
+    state: PathState,
+    shocks: ShockBank,
+    backend: Backend = Backend.AUTO,
+    accounting: Terms = Terms.NOMINAL,
+) -> None:
+    """Continue every path in state through retirementSettings.t more years, in
+    place. Asset values, minimum values and expenditure come from state; everything
+    else from retirementSettings.
+
+    @accounting: Terms.REAL simulates in real dollars, so expenditure and minimum
+    values stay constant instead of being inflated every step. It always runs on
+    the engine kernels and matches nominal accounting up to rounding."""
+    shocks = model_shocks(retirementSettings, shocks)
+    if backend == Backend.AUTO:
+        backend = Backend.COMPILED if engine.HAVE_NUMBA else Backend.PYTHON
+    # Withdrawal policies always step every trial together through the engine
+    if (
+        backend == Backend.COMPILED
+        or retirementSettings.withdrawal_policy is not None
+        or accounting == Terms.REAL
+    ):
+        engine.advance(
+            FlatScenario.from_retirement_settings(retirementSettings),
+            state,
+            shocks,
+            accounting,
+        )
+        return
+
+    m = retirementSettings.step_frequency.value
+    assert (state.year + retirementSettings.t) * m <= shocks.t
+    inflation = step_moments(*retirementSettings.inflation, m)
+    years = engine.horizons(
+        FlatScenario.from_retirement_settings(retirementSettings), state, shocks
+    )
+    for trial in range(state.n):
+        path_rs = path_settings(retirementSettings, state, trial)
+        path_rs.t = int(years[trial])
+        rs, ruin_year, state.reduce_expenditure[trial] = simulate_path(
+            path_rs,
+            shocks,
+            trial,
+            state.year,
+            bool(state.reduce_expenditure[trial]),
+            float(state.price_index[trial]),
+        )
+
+        allocs = rs.asset_distribution.asset_allocations
+        state.values[trial] = [aa.asset.value for aa in allocs]
+        state.minimum_values[trial] = [aa.minimum_value for aa in allocs]
+        state.expenditure[trial] = rs.expenditure
+        if state.ruin_years[trial] < 0:
+            state.ruin_years[trial] = ruin_year
+        for step in range(state.year * m, (state.year + years[trial]) * m):
+            state.price_index[trial] *= 1 + gauss(
+                *inflation, shocks.inflation[trial, step]
+            )
+    state.year += retirementSettings.t
+
+
+def simulate_batch(
+    scenarios: Union[List[RetirementSettings], str],
+    n: int,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+) -> BatchResult:
+    """Simulate many scenarios (or every saved scenario in a directory) in one pass.
+    All scenarios share the same n shock paths, so differences between them are not
+    sampling noise.
+    @shocks: Must cover the longest horizon and largest asset count."""
+    if isinstance(scenarios, str):
+        scenarios = load_retirement_settings_dir(scenarios)
+    batch = PaddedBatch([FlatScenario.from_retirement_settings(rs) for rs in scenarios])
+    if shocks is None:
+        shocks = ShockBank.generate(n, batch.max_steps, batch.width)
+    if backend == Backend.AUTO:
+        backend = Backend.COMPILED if engine.HAVE_NUMBA else Backend.PYTHON
+    # The batch kernel runs every scenario on the same (normal) return shocks
+    stepwise = any(
+        rs.withdrawal_policy is not None
+        or rs.lifespan is not None
+        or not normal_returns(rs)
+        for rs in scenarios
+    )
+    if backend == Backend.COMPILED and not stepwise:
+        return engine.run_batch(batch, shocks, n)
+
+    values = np.zeros((len(batch), n, batch.width))
+    ruin_years = np.empty((len(batch), n), dtype=np.int64)
+    for i, rs in enumerate(scenarios):
+        result = simulate_values(rs, n, shocks, backend)
+        values[i, :, : batch.num_assets[i]] = result.values
+        ruin_years[i] = result.ruin_years
+    return BatchResult(values, ruin_years, batch.num_assets.copy())
+
+
+class Trajectory:
+    """Paths of one scenario with snapshots of their state (asset values, minimum
+    values, expenditure, price index, reduction flags and ruin years) at year
+    boundaries, so another horizon reads or continues them instead of simulating
+    every path from year 0. A snapshot's year is also its position in the shock
+    bank; horizons past the end of the bank extend it from rng.
+
+    Snapshots are kept every @every years, and horizons between them continue the
+    one before. Each snapshot splits the paths' run through the engine, which costs
+    about 15% more for every=5 and 50% more for every=1 on the first run. Changing
+    retirementSettings other than t invalidates them."""
+
+    def __init__(
+        self,
+        retirementSettings: RetirementSettings,
+        shocks: ShockBank,
+        rng: np.random.Generator,
+        n: int,
+        every: int = 5,
+        backend: Backend = Backend.AUTO,
+    ):
+        self.retirementSettings = retirementSettings.copy()
+        self.shocks = shocks
+        self.rng = rng
+        self.every = every
+        self.backend = backend
+        self.snapshots: Dict[int, PathState] = {
+            0: PathState.initial(
+                FlatScenario.from_retirement_settings(retirementSettings), n
+            )
+        }
+
+    @staticmethod
+    def simulate(
+        retirementSettings: RetirementSettings,
+        n: int,
+        seed: Seed = None,
+        every: int = 5,
+        backend: Backend = Backend.AUTO,
+    ) -> "Trajectory":
+        """Simulate n paths through retirementSettings.t years, keeping snapshots"""
+        rng = np.random.default_rng(seed)
+        shocks = ShockBank.for_settings(retirementSettings, n, rng)
+        trajectory = Trajectory(retirementSettings, shocks, rng, n, every, backend)
+        trajectory.state(retirementSettings.t)
+        return trajectory
+
+    @property
+    def t(self) -> int:
+        """Years simulated so far"""
+        return max(self.snapshots)
+
+    def state(self, t: int) -> PathState:
+        """A copy of the paths at the end of year t, continued from the latest
+        snapshot at or before t"""
+        state = self.snapshots[max(year for year in self.snapshots if year <= t)].copy()
+        rs = self.retirementSettings.copy()
+        steps = t * rs.step_frequency.value
+        if steps > self.shocks.t:
+            self.shocks = self.shocks.extended(steps, self.rng)
+        while state.year < t:
+            year = min((state.year // self.every + 1) * self.every, t)
+            rs.t = year - state.year
+            advance_paths(rs, state, self.shocks, self.backend)
+            if year % self.every == 0 and year not in self.snapshots:
+                self.snapshots[year] = state.copy()
+        return state
+
+    def result(self, t: int) -> SimulationResult:
+        """simulate_values with horizon t over the same paths"""
+        return self.state(t).result()
+
+
+def path_settings(
+    retirementSettings: RetirementSettings, state: PathState, trial: int
+) -> RetirementSettings:
+    """Copy of retirementSettings with the asset values, minimum values and
+    expenditure of one path in state"""
+    rs = retirementSettings.copy()
+    for j, aa in enumerate(rs.asset_distribution.asset_allocations):
+        aa.asset.value = float(state.values[trial, j])
+        aa.minimum_value = float(state.minimum_values[trial, j])
+    rs.expenditure = float(state.expenditure[trial])
+    return rs
 
 
 def worst_case(runs: List[RetirementSettings], pmin: float):
@@ -125,51 +432,401 @@ def worst_case(runs: List[RetirementSettings], pmin: float):
     return runs[int(len(runs) * pmin)]
 
 
+def tail_value_estimate(
+    retirementSettings: RetirementSettings,
+    replicates: List[ShockBank],
+    n: int,
+    pmin: float,
+    backend: Backend = Backend.AUTO,
+) -> Tuple[float, float]:
+    """Mean pmin tail value over independently randomized shock banks, and its
+    standard error"""
+    tail_values = np.array(
+        [
+            simulate_values(retirementSettings, n, shocks, backend).tail_value(pmin)
+            for shocks in replicates
+        ]
+    )
+    stderr = tail_values.std(ddof=1) / np.sqrt(len(tail_values))
+    return float(tail_values.mean()), float(stderr)
+
+
+# Searches stop once the crossing is bracketed this tightly
+SEARCH_TOLERANCE = 100
+
+
+def search_converged(low: float, high: float) -> bool:
+    # TODO: Make relative to mid
+    return high - low <= SEARCH_TOLERANCE
+
+
+class SearchState:
+    """Bracket of an optimize_r_var search, with enough information to resume it
+    exactly: the probes made so far and the position of the RNG that draws shocks
+    for the next probe."""
+
+    def __init__(
+        self,
+        low: float = 0,
+        high: float = 100,
+        bracketing: bool = True,
+        probes: Optional[List[Tuple[float, float]]] = None,
+        rng_state: Optional[dict] = None,
+    ):
+        self.low = low
+        self.high = high
+        # Still doubling high to find the top end of the range
+        self.bracketing = bracketing
+        # (value, tail value - emergency_min)
+        self.probes = probes if probes is not None else []
+        self.rng_state = rng_state
+
+    @staticmethod
+    def from_structured(state_obj: dict) -> "SearchState":
+        return SearchState(
+            state_obj["low"],
+            state_obj["high"],
+            state_obj["bracketing"],
+            [tuple(probe) for probe in state_obj["probes"]],  # type: ignore
+            state_obj["rng_state"],
+        )
+
+    def to_structured(self) -> dict:
+        state_obj = {}
+        state_obj["low"] = self.low
+        state_obj["high"] = self.high
+        state_obj["bracketing"] = self.bracketing
+        state_obj["probes"] = [list(probe) for probe in self.probes]
+        state_obj["rng_state"] = self.rng_state
+        return state_obj
+
+
 def optimize_r_var(
     retirementSettings: RetirementSettings,
     r_var_to_opt: RValue,
     maximize: bool,
     pmin: float,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    n: int = 10_000,
+    simulator=None,
+    state: Optional[SearchState] = None,
+    on_probe: Optional[Callable[[SearchState], None]] = None,
+    seed: Seed = None,
+    sampling: Sampling = Sampling.PSEUDO_RANDOM,
 ) -> float:
-    low = 0
-    high = 100
+    """Binary search for the value of r_var_to_opt where the pmin tail value crosses
+    emergency_min.
+
+    @shocks: Reuse this shock bank for every probe (common random numbers). Otherwise
+    each probe draws fresh values.
+    @simulator: Run probes through simulator.simulate_values(rs, n) instead, eg. a
+    sharedmem.ParallelSimulator.
+    @state: Resume a search from this state, which is updated in place.
+    @on_probe: Called with the updated state after every probe.
+    @seed, @sampling: How shocks are drawn for each probe when none are given.
+    Sampling.SOBOL reaches the same accuracy with far fewer trials (n)."""
+    if state is None:
+        state = SearchState()
+    rng = np.random.default_rng(seed)
+    if state.rng_state is not None:
+        rng.bit_generator.state = state.rng_state
+
+    def tail_margin(value: float) -> float:
+        retirementSettings.update_val(r_var_to_opt, lambda _: value)
+        if simulator is not None:
+            result = simulator.simulate_values(retirementSettings, n)
+        else:
+            probe_shocks = shocks
+            if probe_shocks is None:
+                probe_shocks = ShockBank.for_settings(
+                    retirementSettings, n, rng, sampling
+                )
+            result = simulate_values(retirementSettings, n, probe_shocks, backend)
+        margin = result.tail_value(pmin) - retirementSettings.emergency_min
+        state.probes.append((value, margin))
+        state.rng_state = rng.bit_generator.state
+        return margin
 
     # r_val_print(retirementSettings)
     # input()
 
     # Find top end of range
-    retirementSettings.update_val(r_var_to_opt, lambda _: high)
-    while (
-        worst_case(simulate(retirementSettings, 10_000), pmin).current_value()
-        - retirementSettings.emergency_min
-        < 0
-    ) ^ maximize:
-        # TODO: Update low to previous high
-        # r_val_print(retirementSettings)
-        # input()
-        high = high * 2
-        retirementSettings.update_val(r_var_to_opt, lambda _: high)
+    while state.bracketing:
+        if (tail_margin(state.high) < 0) ^ maximize:
+            # TODO: Update low to previous high
+            state.high = state.high * 2
+        else:
+            state.bracketing = False
+        if on_probe is not None:
+            on_probe(state)
 
-    diff = high
-    while diff > 100:  # TODO: Make relative to mid
+    while not search_converged(state.low, state.high):
         # r_val_print(retirementSettings)
         # input()
-        mid = low + (diff / 2)
-        retirementSettings.update_val(r_var_to_opt, lambda _: mid)
-        if (
-            worst_case(simulate(retirementSettings, 10_000), pmin).current_value()
-            - retirementSettings.emergency_min
-            > 0
-        ) ^ maximize:
-            high = mid
+        mid = state.low + ((state.high - state.low) / 2)
+        if (tail_margin(mid) > 0) ^ maximize:
+            state.high = mid
         else:
-            low = mid
-        diff = high - low
+            state.low = mid
+        if on_probe is not None:
+            on_probe(state)
+
+    return state.high
+
+
+def parallel_optimize_r_var(
+    retirementSettings: RetirementSettings,
+    r_var_to_opt: RValue,
+    maximize: bool,
+    pmin: float,
+    simulator,
+    n: int = 10_000,
+    candidates: Optional[int] = None,
+    low: float = 0,
+    high: float = 100,
+) -> float:
+    """optimize_r_var probing several values at once through
+    simulator.simulate_many(settings, n), eg. a sharedmem.ParallelSimulator, where
+    each candidate runs on its own worker over the shared shock bank.
+
+    Bracketing tries high, 2 * high, 4 * high, ... in one round, and each following
+    round splits [low, high] into candidates + 1 equal parts, so the range shrinks
+    by a factor of candidates + 1 per round instead of 2. Like optimize_r_var,
+    returns a value within SEARCH_TOLERANCE of the crossing.
+    @candidates: Values per round, simulator.processes by default."""
+    k = simulator.processes if candidates is None else candidates
+
+    def past_crossing(values: List[float]) -> List[bool]:
+        settings = []
+        for value in values:
+            rs = retirementSettings.copy()
+            rs.update_val(r_var_to_opt, lambda _: value)
+            settings.append(rs)
+        results = simulator.simulate_many(settings, n)
+        return [
+            (result.tail_value(pmin) - rs.emergency_min > 0) ^ maximize
+            for result, rs in zip(results, settings)
+        ]
+
+    def narrow(values: List[float]) -> bool:
+        """Move the bracket onto the first value past the crossing, if any"""
+        nonlocal low, high
+        for value, past in zip(values, past_crossing(values)):
+            if past:
+                high = value
+                return True
+            low = value
+        return False
+
+    # Find top end of range
+    while not narrow([high * 2**i for i in range(k)]):
+        high = low * 2
+
+    while not search_converged(low, high):
+        narrow([low + (high - low) * (i + 1) / (k + 1) for i in range(k)])
 
     return high
 
 
-def rebalance_assets(asset_allocations: List[AssetAllocation]) -> None:
+def start_phase(state: PathState, phase: Phase) -> None:
+    # Phase expenditure is in today's dollars, so inflate it along each path
+    state.expenditure = phase.expenditure * state.price_index
+    state.reduce_expenditure[:] = False
+    state.policy_state = None
+
+
+def advance_phases(
+    scenario: PhasedScenario,
+    state: PathState,
+    shocks: ShockBank,
+    first: int,
+    last: int,
+    backend: Backend = Backend.AUTO,
+) -> None:
+    """Continue every path in state through phases [first, last)"""
+    for index in range(first, last):
+        start_phase(state, scenario.phases[index])
+        advance_paths(scenario.phase_settings(index), state, shocks, backend)
+
+
+def phase_shocks(
+    scenario: PhasedScenario, n: int, seed: Seed = None, sampling=Sampling.PSEUDO_RANDOM
+) -> ShockBank:
+    rs = scenario.settings.copy()
+    rs.t = scenario.t
+    return ShockBank.for_settings(rs, n, seed, sampling)
+
+
+def simulate_phases(
+    scenario: PhasedScenario,
+    n: int,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    last: Optional[int] = None,
+) -> PathState:
+    """Simulate n paths straight through every phase (or the phases before @last)"""
+    if shocks is None:
+        shocks = phase_shocks(scenario, n)
+    flat = FlatScenario.from_retirement_settings(scenario.settings)
+    state = PathState.initial(flat, n)
+    last = len(scenario.phases) if last is None else last
+    advance_phases(scenario, state, shocks, 0, last, backend)
+    return state
+
+
+class PhaseContinuation:
+    """Simulator for optimize_r_var that continues saved paths through one phase of a
+    scenario (described by the RetirementSettings being optimized, with expenditure
+    in today's dollars) and the phases after it."""
+
+    def __init__(
+        self,
+        scenario: PhasedScenario,
+        index: int,
+        state: PathState,
+        shocks: ShockBank,
+        backend: Backend = Backend.AUTO,
+    ):
+        self.scenario = scenario
+        self.index = index
+        self.state = state
+        self.shocks = shocks
+        self.backend = backend
+
+    def simulate_values(
+        self, retirementSettings: RetirementSettings, n: int
+    ) -> SimulationResult:
+        assert n == self.state.n
+        state = self.state.copy()
+        start_phase(
+            state,
+            Phase(
+                retirementSettings.t,
+                retirementSettings.expenditure,
+                retirementSettings.expenditure_reduction_frac,
+            ),
+        )
+        advance_paths(retirementSettings, state, self.shocks, self.backend)
+        advance_phases(
+            self.scenario,
+            state,
+            self.shocks,
+            self.index + 1,
+            len(self.scenario.phases),
+            self.backend,
+        )
+        return state.result()
+
+
+def optimize_phase_var(
+    scenario: PhasedScenario,
+    index: int,
+    r_var_to_opt: RValue,
+    maximize: bool,
+    pmin: float,
+    n: int = 10_000,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    start_state: Optional[PathState] = None,
+    **kwargs,
+) -> float:
+    """optimize_r_var for one phase against the joint path set: the phases before
+    @index are simulated once (or taken from @start_state) and every probe continues
+    those same paths. Asset values at the start of the phase come from the paths, so
+    optimizing them has no effect. Extra arguments are passed through to
+    optimize_r_var."""
+    if shocks is None:
+        shocks = phase_shocks(scenario, n)
+    if start_state is None:
+        start_state = simulate_phases(scenario, n, shocks, backend, last=index)
+    continuation = PhaseContinuation(scenario, index, start_state, shocks, backend)
+    return optimize_r_var(
+        scenario.phase_settings(index),
+        r_var_to_opt,
+        maximize,
+        pmin,
+        n=n,
+        simulator=continuation,
+        **kwargs,
+    )
+
+
+def in_band(
+    asset_allocations: List[AssetAllocation],
+    band: float,
+    allocation: AllocationMode = AllocationMode.WATERFALL,
+) -> bool:
+    """Whether every asset is within band of its targets, so rebalancing can be
+    skipped: its share of the total within band of its desired fraction, its value
+    no less than (1 - band) of its minimum value, and, for assets with no desired
+    fraction ahead of the last priority class, no more than (1 + band) of it.
+    Under AllocationMode.PROPORTIONAL, its share within band of its share after
+    rebalancing."""
+    total_assets = 0.0
+    for aa in asset_allocations:
+        total_assets += aa.asset.value
+    if total_assets <= 0:
+        return False
+    if allocation == AllocationMode.PROPORTIONAL:
+        values = [aa.asset.value for aa in asset_allocations]
+        targets = proportional_values(asset_allocations)
+        return all(
+            abs(value - target) / total_assets <= band
+            for value, target in zip(values, targets)
+        )
+    last_priority = asset_allocations[-1].priority
+    for aa in asset_allocations:
+        if aa.asset.value < aa.minimum_value * (1 - band):
+            return False
+        if aa.desired_fraction_of_total_assets > 0:
+            share = aa.asset.value / total_assets
+            if abs(share - aa.desired_fraction_of_total_assets) > band:
+                return False
+        elif aa.priority < last_priority and aa.asset.value > aa.minimum_value * (
+            1 + band
+        ):
+            return False
+    return True
+
+
+def rebalance_due(
+    asset_allocations: List[AssetAllocation],
+    policy: RebalancePolicy,
+    band: float,
+    allocation: AllocationMode = AllocationMode.WATERFALL,
+) -> bool:
+    if policy == RebalancePolicy.NEVER:
+        return False
+    elif policy == RebalancePolicy.BAND:
+        return not in_band(asset_allocations, band, allocation)
+    return True
+
+
+def proportional_values(asset_allocations: List[AssetAllocation]) -> List[float]:
+    """Asset values after AllocationMode.PROPORTIONAL rebalancing, for one path of
+    the reference implementation"""
+    values = np.array([[aa.asset.value for aa in asset_allocations]], dtype=float)
+    minimum_values = np.array(
+        [[aa.minimum_value for aa in asset_allocations]], dtype=float
+    )
+    fractions = np.array(
+        [aa.desired_fraction_of_total_assets for aa in asset_allocations], dtype=float
+    )
+    return [
+        float(v) for v in allocate_proportional(values, minimum_values, fractions)[0]
+    ]
+
+
+def rebalance_assets(
+    asset_allocations: List[AssetAllocation],
+    allocation: AllocationMode = AllocationMode.WATERFALL,
+) -> None:
+    if allocation == AllocationMode.PROPORTIONAL:
+        for aa, value in zip(asset_allocations, proportional_values(asset_allocations)):
+            aa.asset.value = value
+        return
+
     def get_and_clear_value(asset: Asset):
         value = asset.value
         asset.value = 0
@@ -181,14 +838,16 @@ def rebalance_assets(asset_allocations: List[AssetAllocation]) -> None:
     assert total_assets > 0
     remaining_assets = total_assets
 
-    priority_class: MutableSet[AssetAllocation] = set()
+    # A list rather than a set: iteration order must be deterministic (and equal
+    # allocations must not collapse) for results to be reproducible
+    priority_class: List[AssetAllocation] = []
     priority = None
     pc_total_min_value = 0.0
     pc_total_fraction = 0.0
     for i, asset_alloc in enumerate(asset_allocations):
         if priority is None:
             priority = asset_alloc.priority
-        priority_class.add(asset_alloc)
+        priority_class.append(asset_alloc)
         pc_total_min_value += asset_alloc.minimum_value
         pc_total_fraction += asset_alloc.desired_fraction_of_total_assets
 
@@ -251,7 +910,7 @@ def rebalance_assets(asset_allocations: List[AssetAllocation]) -> None:
                     aa.asset.value = new_asset_value
 
             # Reset priority class
-            priority_class = set()
+            priority_class = []
             priority = None
             pc_total_min_value = 0.0
             pc_total_fraction = 0.0
@@ -265,6 +924,13 @@ def rebalance_assets(asset_allocations: List[AssetAllocation]) -> None:
     assert abs(total_assets - sum([a.asset.value for a in asset_allocations])) < 0.001
 
 
+def search_progress_print(state: SearchState):
+    if state.bracketing:
+        print(f"  Above ${state.high / 2:,.2f}")
+    else:
+        print(f"  Between ${state.low:,.2f} and ${state.high:,.2f}")
+
+
 def rsettings_print(retirementSettings: RetirementSettings):
     print(f"expenditure: ${retirementSettings.expenditure:,.2f}")
     print("Asset distribution:")
@@ -422,26 +1088,52 @@ def safe_ret_expenditure_prompt():
         0,
         1,
     )
-    print("Simulating 10,000 possible scenarios...")
-    runs = simulate(current_state, 10_000)
-    result_setting = worst_case(runs, wcp)
-
-    retwealth = result_setting.current_value()
-    print(f"Estimated new worth at end of earning years: ${retwealth:,.2f}")
-
     print()
     t = takeint("Enter estimated whole number of years of retirement", lbound=1)
 
+    # Every path continues from its own end of earning years into retirement
+    scenario = PhasedScenario(
+        current_state,
+        [
+            Phase(
+                current_state.t,
+                current_state.expenditure,
+                current_state.expenditure_reduction_frac,
+            ),
+            Phase(t, 0, current_state.expenditure_reduction_frac),
+        ],
+    )
+    print()
+    print("Simulating 10,000 possible scenarios...")
+    shocks = phase_shocks(scenario, 10_000)
+    earning_state = simulate_phases(scenario, 10_000, shocks, last=1)
+    earning_result = earning_state.result()
+    tail_index = earning_result.tail_index(wcp)
+    retwealth = earning_result.current_values()[tail_index]
+    print(f"Estimated new worth at end of earning years: ${retwealth:,.2f}")
+
     print()
     print("Binary searching possible retirement scenarios 10,000 times each...")
-    retirement_start = result_setting.copy()
-    retirement_start.expenditure = 0
-    retirement_start.t = t
-    maxexp = optimize_r_var(retirement_start, RValue(RSetting.EXPENDITURE), True, wcp)
-    print(f"Maximum safe yearly expenditure in retirement: ${maxexp:,.2f}")
+    maxexp = optimize_phase_var(
+        scenario,
+        1,
+        RValue(RSetting.EXPENDITURE),
+        True,
+        wcp,
+        shocks=shocks,
+        start_state=earning_state,
+    )
+    print(
+        f"Maximum safe yearly expenditure in retirement: ${maxexp:,.2f} "
+        + "in today's dollars"
+    )
 
     print()
     if takebool("Save retirement scenario to disk?"):
+        # Start of retirement along the tail path, in that path's dollars
+        retirement_start = path_settings(current_state, earning_state, tail_index)
+        retirement_start.expenditure = maxexp * earning_state.price_index[tail_index]
+        retirement_start.t = t
         save_retirement_settings(retirement_start)
 
 
@@ -518,6 +1210,7 @@ def savings_required_for_expenditure_prompt():
         ),  # type: ignore
         False,
         wcp,
+        on_probe=search_progress_print,
     )
     print(f"Minimum safe equity savings for retirement: ${maxexp:,.2f}")
 
@@ -532,6 +1225,27 @@ def rewrite_retirement_scenario_prompt():
                 save_retirement_settings(retirement_scenario, scenario_file)
 
 
+def sensitivity_report_prompt():
+    retirement_scenario = select_and_load_retirement_settings()
+    if retirement_scenario is None:
+        return
+    wcp = takefloat(
+        "Enter tail probability for Monte Carlo simulation "
+        + "(<0.5=worse than average result)",
+        0,
+        1,
+    )
+    try:
+        report = tornado(retirement_scenario, wcp)
+    except ValueError as e:
+        # Scenarios outside the differentiable model (eg. withdrawal policies)
+        print(f"No sensitivity report: {e}")
+        return
+    print()
+    print("Change in tail value from raising each input by 10%:")
+    tornado_print(report)
+
+
 if __name__ == "__main__":
     # rs = retirement_value(RetirementSettings(100, 0, 0, 0, (0.04, .02), (0, 0), 65, 0,
     #     [AssetAllocation(Asset("eme", 1000, 0, 0), 0, 0, 0),
@@ -546,6 +1260,7 @@ if __name__ == "__main__":
             savings_required_for_expenditure_prompt,
         ),
         ("Rewrite retirement scenario", rewrite_retirement_scenario_prompt),
+        ("Sensitivity report", sensitivity_report_prompt),
     ]
     prompt_fn = choose(prompt_fns)
     if prompt_fn:
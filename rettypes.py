@@ -1,6 +1,10 @@
 from enum import Enum
 from typing import Any, Callable, List, Optional, Tuple
 
+from mortality import Lifespan
+from returnmodels import RegimeSwitching, ReturnModel
+from withdrawal import WithdrawalPolicy
+
 
 class AssetSetting(Enum):
     NAME = 1
@@ -11,15 +15,28 @@ class AssetSetting(Enum):
 
 class Asset:
     def __init__(
-        self, name: str, value: float, mean_return: float, return_stdev: float
+        self,
+        name: str,
+        value: float,
+        mean_return: float,
+        return_stdev: float,
+        return_model: Optional[ReturnModel] = None,
     ):
         self.name: str = name
         self.value: float = value
         self.mean_return: float = mean_return
         self.return_stdev: float = return_stdev
+        # Distribution of the returns, normal if None
+        self.return_model: Optional[ReturnModel] = return_model
 
     def copy(self) -> "Asset":
-        return Asset(self.name, self.value, self.mean_return, self.return_stdev)
+        return Asset(
+            self.name,
+            self.value,
+            self.mean_return,
+            self.return_stdev,
+            self.return_model,
+        )
 
     def update_val(self, asset_setting: AssetSetting, op: Callable[[Any], Any]):
         if asset_setting == AssetSetting.NAME:
@@ -37,7 +54,11 @@ class Asset:
         value = assetObj["value"]
         mean_return = assetObj["mean_return"]
         return_stdev = assetObj["return_stdev"]
-        return Asset(name, value, mean_return, return_stdev)
+        if "return_model" in assetObj:
+            return_model = ReturnModel.from_structured(assetObj["return_model"])
+        else:
+            return_model = None
+        return Asset(name, value, mean_return, return_stdev, return_model)
 
     def to_structured(self) -> dict:
         assetObj = {}
@@ -45,6 +66,8 @@ class Asset:
         assetObj["value"] = self.value
         assetObj["mean_return"] = self.mean_return
         assetObj["return_stdev"] = self.return_stdev
+        if self.return_model is not None:
+            assetObj["return_model"] = self.return_model.to_structured()
         return assetObj
 
     def __eq__(self, other: object) -> bool:
@@ -54,10 +77,19 @@ class Asset:
             and self.value == other.value
             and self.mean_return == other.mean_return
             and self.return_stdev == other.return_stdev
+            and self.return_model == other.return_model
         )
 
     def __hash__(self) -> int:
-        return hash((self.name, self.value, self.mean_return, self.return_stdev))
+        return hash(
+            (
+                self.name,
+                self.value,
+                self.mean_return,
+                self.return_stdev,
+                self.return_model,
+            )
+        )
 
 
 class AllocationSetting(Enum):
@@ -174,10 +206,24 @@ class DistributionValue:
         self.allocation_value = allocation_value
 
 
+class AllocationMode(Enum):
+    # Priority classes in turn: minimum values, then desired fractions
+    WATERFALL = 1
+    # Every asset gets its minimum value (all pro rata if the total falls short),
+    # and the rest is split in proportion to the desired fractions (equally if
+    # none are set), in closed form
+    PROPORTIONAL = 2
+
+
 class AssetDistribution:
-    def __init__(self, asset_allocations: List[AssetAllocation]):
+    def __init__(
+        self,
+        asset_allocations: List[AssetAllocation],
+        allocation: AllocationMode = AllocationMode.WATERFALL,
+    ):
         asset_allocations.sort(key=lambda a: a.priority)
         self.asset_allocations = asset_allocations
+        self.allocation = allocation
 
     def update_val(self, dvalue: DistributionValue, op: Callable[[Any], Any]):
         dsetting = dvalue.distribution_setting
@@ -189,7 +235,9 @@ class AssetDistribution:
                 self.asset_allocations[index].update_val(avalue, op)
 
     def copy(self) -> "AssetDistribution":
-        return AssetDistribution([aa.copy() for aa in self.asset_allocations])
+        return AssetDistribution(
+            [aa.copy() for aa in self.asset_allocations], self.allocation
+        )
 
     @staticmethod
     def from_structured(distribution_obj: dict) -> "AssetDistribution":
@@ -197,27 +245,108 @@ class AssetDistribution:
             AssetAllocation.from_structured(aa)
             for aa in distribution_obj["asset_allocations"]
         ]
-        return AssetDistribution(asset_allocations)
+        allocation = AllocationMode[
+            distribution_obj.get("allocation", AllocationMode.WATERFALL.name)
+        ]
+        return AssetDistribution(asset_allocations, allocation)
 
     def to_structured(self) -> dict:
         distribution_obj = {}
         distribution_obj["asset_allocations"] = [
             aa.to_structured() for aa in self.asset_allocations
         ]
+        distribution_obj["allocation"] = self.allocation.name
         return distribution_obj
 
     def __eq__(self, other: object) -> bool:
-        return isinstance(other, AssetDistribution) and set(
-            self.asset_allocations
-        ) == set(other.asset_allocations)
+        return (
+            isinstance(other, AssetDistribution)
+            and set(self.asset_allocations) == set(other.asset_allocations)
+            and self.allocation == other.allocation
+        )
 
     def __hash__(self) -> int:
-        return hash(frozenset(self.asset_allocations))
+        return hash((frozenset(self.asset_allocations), self.allocation))
 
     def current_value(self) -> float:
         return sum([aa.asset.value for aa in self.asset_allocations])
 
 
+class Frequency(Enum):
+    """Steps per year"""
+
+    ANNUAL = 1
+    QUARTERLY = 4
+    MONTHLY = 12
+
+
+class RebalancePolicy(Enum):
+    # Rebalance on every rebalance step
+    CALENDAR = 1
+    # Only rebalance when some asset has drifted out of its tolerance band
+    BAND = 2
+    NEVER = 3
+
+
+class CashFlow:
+    """Money paid into (amount > 0, eg. a pension or contributions) or out of
+    (amount < 0, eg. a mortgage or college costs) the portfolio every year from year
+    start up to, but not including, year end (None for ever). Years count from the
+    start of the simulation. Indexed amounts are in today's dollars and grow with
+    inflation along each path; the others are fixed nominal amounts."""
+
+    def __init__(
+        self,
+        name: str,
+        amount: float,
+        start: int = 0,
+        end: Optional[int] = None,
+        indexed: bool = True,
+    ):
+        assert end is None or start < end
+        self.name = name
+        self.amount = amount
+        self.start = start
+        self.end = end
+        self.indexed = indexed
+
+    def copy(self) -> "CashFlow":
+        return CashFlow(self.name, self.amount, self.start, self.end, self.indexed)
+
+    @staticmethod
+    def from_structured(flow_obj: dict) -> "CashFlow":
+        return CashFlow(
+            flow_obj["name"],
+            flow_obj["amount"],
+            flow_obj.get("start", 0),
+            flow_obj.get("end"),
+            flow_obj.get("indexed", True),
+        )
+
+    def to_structured(self) -> dict:
+        flow_obj = {}
+        flow_obj["name"] = self.name
+        flow_obj["amount"] = self.amount
+        flow_obj["start"] = self.start
+        if self.end is not None:
+            flow_obj["end"] = self.end
+        flow_obj["indexed"] = self.indexed
+        return flow_obj
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, CashFlow)
+            and self.name == other.name
+            and self.amount == other.amount
+            and self.start == other.start
+            and self.end == other.end
+            and self.indexed == other.indexed
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.amount, self.start, self.end, self.indexed))
+
+
 class RSetting(Enum):
     EXPENDITURE = 1
     INFLATION = 5
@@ -242,6 +371,14 @@ class RetirementSettings:
         emergency_min: float,
         asset_distribution: AssetDistribution,
         expenditure_reduction_frac: Optional[float],
+        step_frequency: Frequency = Frequency.ANNUAL,
+        rebalance_frequency: Frequency = Frequency.ANNUAL,
+        rebalance_policy: RebalancePolicy = RebalancePolicy.CALENDAR,
+        rebalance_band: float = 0.05,
+        withdrawal_policy: Optional[WithdrawalPolicy] = None,
+        lifespan: Optional[Lifespan] = None,
+        cash_flows: Optional[List[CashFlow]] = None,
+        regimes: Optional[RegimeSwitching] = None,
     ):
         self.expenditure = expenditure
         self.inflation = inflation
@@ -249,6 +386,29 @@ class RetirementSettings:
         self.emergency_min = emergency_min
         self.asset_distribution = asset_distribution
         self.expenditure_reduction_frac = expenditure_reduction_frac
+        # Expenditure, returns and inflation stay annual figures; the engines scale
+        # them to each step. Assets are rebalanced rebalance_frequency times a year.
+        # expenditure_reduction_frac works per step: a step in which any asset
+        # returns less than its mean cuts the next step's spending, so with monthly
+        # steps a bad month cuts the following month, not the following year.
+        assert step_frequency.value % rebalance_frequency.value == 0
+        self.step_frequency = step_frequency
+        self.rebalance_frequency = rebalance_frequency
+        # Under RebalancePolicy.BAND an asset is in band while its share of the
+        # total is within rebalance_band of its desired fraction, and its value is
+        # within rebalance_band (relative) of its minimum value
+        self.rebalance_policy = rebalance_policy
+        self.rebalance_band = rebalance_band
+        # Decides spending at each step instead of spending expenditure evenly (and
+        # instead of expenditure_reduction_frac)
+        self.withdrawal_policy = withdrawal_policy
+        # Each path ends after the last death instead of running all t years, which
+        # becomes the longest possible horizon
+        self.lifespan = lifespan
+        # On top of expenditure
+        self.cash_flows = [] if cash_flows is None else cash_flows
+        # Market regimes followed by assets with a returnmodels.Regime model
+        self.regimes = regimes
 
     def update_val(self, rvalue: RValue, op: Callable[[Any], Any]) -> None:
         rsetting = rvalue.rsetting
@@ -285,6 +445,11 @@ class RetirementSettings:
     def current_value(self) -> float:
         return self.asset_distribution.current_value()
 
+    @property
+    def steps(self) -> int:
+        """Simulation steps over all t years"""
+        return self.t * self.step_frequency.value
+
     def copy(self) -> "RetirementSettings":
         return RetirementSettings(
             self.expenditure,
@@ -293,6 +458,14 @@ class RetirementSettings:
             self.emergency_min,
             self.asset_distribution.copy(),
             self.expenditure_reduction_frac,
+            self.step_frequency,
+            self.rebalance_frequency,
+            self.rebalance_policy,
+            self.rebalance_band,
+            self.withdrawal_policy,
+            None if self.lifespan is None else self.lifespan.copy(),
+            [cf.copy() for cf in self.cash_flows],
+            None if self.regimes is None else self.regimes.copy(),
         )
 
     @staticmethod
@@ -318,6 +491,27 @@ class RetirementSettings:
         else:
             expenditure_reduction_frac = None
 
+        if "withdrawal_policy" in ret_obj:
+            withdrawal_policy = WithdrawalPolicy.from_structured(
+                ret_obj["withdrawal_policy"]
+            )
+        else:
+            withdrawal_policy = None
+
+        if "lifespan" in ret_obj:
+            lifespan = Lifespan.from_structured(ret_obj["lifespan"])
+        else:
+            lifespan = None
+
+        cash_flows = [
+            CashFlow.from_structured(cf) for cf in ret_obj.get("cash_flows", [])
+        ]
+
+        if "regimes" in ret_obj:
+            regimes = RegimeSwitching.from_structured(ret_obj["regimes"])
+        else:
+            regimes = None
+
         return RetirementSettings(
             expenditure,
             inflation,
@@ -325,6 +519,16 @@ class RetirementSettings:
             emergency_min,
             asset_distribution,
             expenditure_reduction_frac,
+            Frequency[ret_obj.get("step_frequency", Frequency.ANNUAL.name)],
+            Frequency[ret_obj.get("rebalance_frequency", Frequency.ANNUAL.name)],
+            RebalancePolicy[
+                ret_obj.get("rebalance_policy", RebalancePolicy.CALENDAR.name)
+            ],
+            ret_obj.get("rebalance_band", 0.05),
+            withdrawal_policy,
+            lifespan,
+            cash_flows,
+            regimes,
         )
 
     def to_structured(self) -> dict:
@@ -334,6 +538,20 @@ class RetirementSettings:
         ret_obj["t"] = self.t
         ret_obj["emergency_min"] = self.emergency_min
         ret_obj["asset_distribution"] = self.asset_distribution.to_structured()
+        if self.expenditure_reduction_frac is not None:
+            ret_obj["expenditure_reduction_frac"] = self.expenditure_reduction_frac
+        if self.withdrawal_policy is not None:
+            ret_obj["withdrawal_policy"] = self.withdrawal_policy.to_structured()
+        if self.lifespan is not None:
+            ret_obj["lifespan"] = self.lifespan.to_structured()
+        if self.cash_flows:
+            ret_obj["cash_flows"] = [cf.to_structured() for cf in self.cash_flows]
+        if self.regimes is not None:
+            ret_obj["regimes"] = self.regimes.to_structured()
+        ret_obj["step_frequency"] = self.step_frequency.name
+        ret_obj["rebalance_frequency"] = self.rebalance_frequency.name
+        ret_obj["rebalance_policy"] = self.rebalance_policy.name
+        ret_obj["rebalance_band"] = self.rebalance_band
         return ret_obj
 
     def __eq__(self, other: object) -> bool:
@@ -344,6 +562,15 @@ class RetirementSettings:
             and self.t == other.t
             and self.emergency_min == other.emergency_min
             and self.asset_distribution == other.asset_distribution
+            and self.expenditure_reduction_frac == other.expenditure_reduction_frac
+            and self.step_frequency == other.step_frequency
+            and self.rebalance_frequency == other.rebalance_frequency
+            and self.rebalance_policy == other.rebalance_policy
+            and self.rebalance_band == other.rebalance_band
+            and self.withdrawal_policy == other.withdrawal_policy
+            and self.lifespan == other.lifespan
+            and self.cash_flows == other.cash_flows
+            and self.regimes == other.regimes
         )
 
     def __hash__(self) -> int:
@@ -354,5 +581,112 @@ class RetirementSettings:
                 self.t,
                 self.emergency_min,
                 self.asset_distribution,
+                self.expenditure_reduction_frac,
+                self.step_frequency,
+                self.rebalance_frequency,
+                self.rebalance_policy,
+                self.rebalance_band,
+                self.withdrawal_policy,
+                self.lifespan,
+                tuple(self.cash_flows),
+                self.regimes,
             )
         )
+
+
+class Phase:
+    """One stage of a PhasedScenario, eg. accumulation or retirement.
+
+    expenditure is in today's (year 0) dollars; each path inflates it by its own
+    realized inflation. Negative expenditure is a contribution."""
+
+    def __init__(
+        self,
+        t: int,
+        expenditure: float,
+        expenditure_reduction_frac: Optional[float] = None,
+    ):
+        self.t = t
+        self.expenditure = expenditure
+        self.expenditure_reduction_frac = expenditure_reduction_frac
+
+    def copy(self) -> "Phase":
+        return Phase(self.t, self.expenditure, self.expenditure_reduction_frac)
+
+    @staticmethod
+    def from_structured(phase_obj: dict) -> "Phase":
+        return Phase(
+            phase_obj["t"],
+            phase_obj["expenditure"],
+            phase_obj.get("expenditure_reduction_frac"),
+        )
+
+    def to_structured(self) -> dict:
+        phase_obj = {}
+        phase_obj["t"] = self.t
+        phase_obj["expenditure"] = self.expenditure
+        if self.expenditure_reduction_frac is not None:
+            phase_obj["expenditure_reduction_frac"] = self.expenditure_reduction_frac
+        return phase_obj
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, Phase)
+            and self.t == other.t
+            and self.expenditure == other.expenditure
+            and self.expenditure_reduction_frac == other.expenditure_reduction_frac
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.t, self.expenditure, self.expenditure_reduction_frac))
+
+
+class PhasedScenario:
+    """Consecutive phases simulated along the same paths, so retirement starts from
+    the full distribution of accumulation outcomes. Assets, inflation and
+    emergency_min come from settings; settings.t, expenditure and
+    expenditure_reduction_frac are replaced by each phase's."""
+
+    def __init__(self, settings: RetirementSettings, phases: List[Phase]):
+        self.settings = settings
+        self.phases = phases
+
+    @property
+    def t(self) -> int:
+        return sum([phase.t for phase in self.phases])
+
+    def phase_settings(self, index: int) -> RetirementSettings:
+        phase = self.phases[index]
+        rs = self.settings.copy()
+        rs.t = phase.t
+        rs.expenditure = phase.expenditure
+        rs.expenditure_reduction_frac = phase.expenditure_reduction_frac
+        return rs
+
+    def copy(self) -> "PhasedScenario":
+        return PhasedScenario(
+            self.settings.copy(), [phase.copy() for phase in self.phases]
+        )
+
+    @staticmethod
+    def from_structured(scenario_obj: dict) -> "PhasedScenario":
+        return PhasedScenario(
+            RetirementSettings.from_structured(scenario_obj["settings"]),
+            [Phase.from_structured(p) for p in scenario_obj["phases"]],
+        )
+
+    def to_structured(self) -> dict:
+        scenario_obj = {}
+        scenario_obj["settings"] = self.settings.to_structured()
+        scenario_obj["phases"] = [phase.to_structured() for phase in self.phases]
+        return scenario_obj
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, PhasedScenario)
+            and self.settings == other.settings
+            and self.phases == other.phases
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.settings, tuple(self.phases)))
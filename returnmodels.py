@@ -0,0 +1,308 @@
+"""Return models decide the distribution of an asset's returns.
+
+Every engine computes a step's return as mean + shock * stdev from the per-step
+moments of the asset. A model keeps that form by turning the shock bank's
+standard normal shocks into standardized shocks of its own distribution (zero
+mean and unit variance, unless the model moves the mean), for all trials and
+steps at once. The kernels then run unchanged whatever the model, and a shock
+below zero is still a return below the asset's mean.
+
+Models are selected per asset in scenario YAML as
+return_model: {type: <name>, <parameter>: <value>, ...}; assets without one are
+normal. REGIME models follow the Markov chain of the scenario's regimes, which is
+shared by all its assets:
+
+    regimes:
+      transition: [[0.9, 0.1], [0.4, 0.6]]  # bull, bear
+    asset_distribution:
+      - asset: {name: Stocks, ..., return_model: {type: REGIME,
+                means: [0.11, -0.05], stdevs: [0.12, 0.25]}}
+"""
+
+import functools
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+try:
+    from scipy.special import ndtr, stdtrit
+except ImportError:
+    stdtrit = None
+
+# Annual (mean, stdev) to per-step (mean, stdev), as engine.step_moments
+Moments = Callable[[float, float], Tuple[float, float]]
+
+# Student-t quantiles are interpolated up to this many standard deviations of the
+# normal shock and computed exactly beyond
+T_TABLE_MAX = 8.0
+T_TABLE_POINTS = 1 << 13
+
+
+class ReturnModel:
+    """Normal returns, like assets without a model. Subclasses override
+    standardize; params lists the constructor arguments that are saved to YAML.
+    location_scale is whether returns stay mean + shock * stdev for shocks that do
+    not depend on the mean and stdev, which pathwise sensitivities rely on."""
+
+    name = "NORMAL"
+    params: tuple = ()
+    location_scale = True
+
+    def standardize(
+        self,
+        shocks: np.ndarray,
+        mean: float,
+        stdev: float,
+        moments: Moments,
+        regimes: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Shocks under this model from standard normal shocks (trials, steps).
+
+        @mean, @stdev: The asset's annual figures.
+        @moments: Scales annual figures to one step of the scenario.
+        @regimes: The regime of every trial and step, when the scenario has them."""
+        return shocks
+
+    def to_structured(self) -> dict:
+        model_obj = {"type": self.name}
+        for param in self.params:
+            value = getattr(self, param)
+            model_obj[param] = list(value) if isinstance(value, tuple) else value
+        return model_obj
+
+    @staticmethod
+    def from_structured(model_obj: dict) -> "ReturnModel":
+        model_obj = dict(model_obj)
+        return MODELS[model_obj.pop("type")](**model_obj)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            type(other) is type(self)
+            and self.to_structured() == other.to_structured()  # type: ignore
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.name,) + tuple(getattr(self, p) for p in self.params))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_structured()})"
+
+
+MODELS: Dict[str, Type[ReturnModel]] = {}
+
+
+def register_model(cls: Type[ReturnModel]) -> Type[ReturnModel]:
+    """Class decorator making a model selectable by its name"""
+    MODELS[cls.name] = cls
+    return cls
+
+
+register_model(ReturnModel)
+
+
+@functools.lru_cache(maxsize=None)
+def _t_table(dof: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantiles at T_TABLE_POINTS evenly spaced magnitudes of the normal shock, and
+    the slope to the next point"""
+    grid = np.linspace(0, T_TABLE_MAX, T_TABLE_POINTS + 1)
+    table = -stdtrit(dof, ndtr(-grid))
+    return table[:-1], np.diff(table)
+
+
+def t_quantiles(shocks: np.ndarray, dof: float) -> np.ndarray:
+    """Student-t quantiles with dof degrees of freedom at the normal CDF of shocks.
+    The tails are taken from the lower side, where the CDF does not round to 1."""
+    if stdtrit is None:
+        raise ImportError("Student-t returns require scipy")
+    magnitudes = np.abs(shocks)
+    table, slopes = _t_table(dof)
+    # Linear interpolation on the even grid, without np.interp's binary search
+    position = np.minimum(magnitudes, T_TABLE_MAX) * (T_TABLE_POINTS / T_TABLE_MAX)
+    index = np.minimum(position.astype(np.int64), T_TABLE_POINTS - 1)
+    quantiles = table[index] + (position - index) * slopes[index]
+    beyond = magnitudes > T_TABLE_MAX
+    if beyond.any():
+        quantiles[beyond] = -stdtrit(dof, ndtr(-magnitudes[beyond]))
+    return np.copysign(quantiles, shocks)
+
+
+def at_most_total_loss(
+    standardized: np.ndarray, step_mean: float, step_stdev: float
+) -> np.ndarray:
+    """standardized, in place, with shocks floored at a return of -100%. Fat tails
+    would otherwise lose more than everything a few times in a thousand steps."""
+    if step_stdev > 0:
+        np.maximum(standardized, (-1 - step_mean) / step_stdev, out=standardized)
+    return standardized
+
+
+@register_model
+class StudentT(ReturnModel):
+    """Student-t returns with dof degrees of freedom, scaled to the asset's stdev
+    and floored at a total loss. Each normal shock is mapped to the t quantile at
+    the same probability, so scenarios differing only in the model still share
+    their random numbers."""
+
+    name = "STUDENT_T"
+    params = ("dof",)
+
+    def __init__(self, dof: float):
+        # The variance is infinite otherwise
+        if not dof > 2:
+            raise ValueError("Student-t returns need more than 2 degrees of freedom")
+        self.dof = dof
+
+    def standardize(self, shocks, mean, stdev, moments, regimes=None):
+        standardized = t_quantiles(shocks, self.dof)
+        standardized *= math.sqrt((self.dof - 2) / self.dof)
+        return at_most_total_loss(standardized, *moments(mean, stdev))
+
+
+@register_model
+class Lognormal(ReturnModel):
+    """Returns whose growth factor 1 + return is lognormal with the asset's mean
+    and stdev at every step, so a step can lose at most everything"""
+
+    name = "LOGNORMAL"
+    location_scale = False
+
+    def standardize(self, shocks, mean, stdev, moments, regimes=None):
+        step_mean, step_stdev = moments(mean, stdev)
+        if step_stdev == 0:
+            return np.zeros_like(shocks)
+        sigma2 = math.log1p((step_stdev / (1 + step_mean)) ** 2)
+        mu = math.log1p(step_mean) - sigma2 / 2
+        returns = np.expm1(mu + math.sqrt(sigma2) * shocks)
+        return (returns - step_mean) / step_stdev
+
+
+@register_model
+class Regime(ReturnModel):
+    """Normal returns with the annual mean and stdev of the regime each trial is in,
+    by regime of the scenario's RegimeSwitching, floored at a total loss. The asset's
+    own mean_return and return_stdev are its long run figures: shocks are
+    standardized by them, and expenditure reductions still follow years below
+    mean_return."""
+
+    name = "REGIME"
+    params = ("means", "stdevs")
+    location_scale = False
+
+    def __init__(self, means: Sequence[float], stdevs: Sequence[float]):
+        if len(means) != len(stdevs):
+            raise ValueError("A regime model needs a mean and a stdev per regime")
+        self.means = tuple(means)
+        self.stdevs = tuple(stdevs)
+
+    def standardize(self, shocks, mean, stdev, moments, regimes=None):
+        if regimes is None:
+            raise ValueError("Regime returns need the scenario's regimes")
+        step_mean, step_stdev = moments(mean, stdev)
+        if step_stdev == 0:
+            raise ValueError("Regime returns need a positive return_stdev")
+        regime_moments = [moments(m, s) for m, s in zip(self.means, self.stdevs)]
+        if regimes.max() >= len(regime_moments):
+            raise ValueError("A regime model needs a mean and a stdev per regime")
+        regime_means = np.array([m for m, _ in regime_moments])
+        regime_stdevs = np.array([s for _, s in regime_moments])
+        returns = regime_means[regimes] + regime_stdevs[regimes] * shocks
+        return at_most_total_loss(
+            (returns - step_mean) / step_stdev, *moments(mean, stdev)
+        )
+
+
+class RegimeSwitching:
+    """A Markov chain of market regimes (eg. bull and bear, or bull, bear and
+    crash) shared by every asset of a scenario. Each trial starts in a regime drawn
+    from initial (by default the chain's stationary distribution) and moves at
+    every year start with the probabilities of its regime's row of transition."""
+
+    def __init__(
+        self,
+        transition: Sequence[Sequence[float]],
+        initial: Optional[Sequence[float]] = None,
+    ):
+        matrix = np.array(transition, dtype=float)
+        k = len(matrix)
+        if k < 2 or matrix.shape != (k, k):
+            raise ValueError("Regime transitions must be a square matrix of 2+ rows")
+        if (matrix < 0).any() or not np.allclose(matrix.sum(axis=1), 1):
+            raise ValueError("Every row of regime transitions must sum to 1")
+        if initial is not None and len(initial) != k:
+            raise ValueError("Initial regime probabilities need one entry per regime")
+        self.transition = tuple(tuple(float(p) for p in row) for row in transition)
+        self.initial = None if initial is None else tuple(initial)
+
+    @property
+    def num_regimes(self) -> int:
+        return len(self.transition)
+
+    def stationary(self) -> np.ndarray:
+        """Long run share of years spent in each regime"""
+        k = self.num_regimes
+        system = np.vstack((np.array(self.transition).T - np.eye(k), np.ones(k)))
+        target = np.zeros(k + 1)
+        target[k] = 1
+        return np.linalg.lstsq(system, target, rcond=None)[0]
+
+    def paths(self, uniforms: np.ndarray, steps_per_year: int) -> np.ndarray:
+        """The regime of every trial and step, from uniform draws (trials, steps).
+        Only the draws at year starts are used; all trials move together, one year
+        at a time."""
+        n, steps = uniforms.shape
+        k = self.num_regimes
+        start = self.stationary() if self.initial is None else self.initial
+        cumulative = np.cumsum(np.array(self.transition), axis=1)
+        year_starts = uniforms[:, ::steps_per_year]
+        years = np.empty(year_starts.shape, dtype=np.int64)
+        regime = np.searchsorted(np.cumsum(start), year_starts[:, 0], side="right")
+        years[:, 0] = np.minimum(regime, k - 1)
+        for year in range(1, years.shape[1]):
+            # Rows summing to just under 1 could otherwise step past the last regime
+            regime = (year_starts[:, year, None] >= cumulative[years[:, year - 1]]).sum(
+                axis=1
+            )
+            years[:, year] = np.minimum(regime, k - 1)
+        return np.repeat(years, steps_per_year, axis=1)[:, :steps]
+
+    def to_structured(self) -> dict:
+        regimes_obj: dict = {"transition": [list(row) for row in self.transition]}
+        if self.initial is not None:
+            regimes_obj["initial"] = list(self.initial)
+        return regimes_obj
+
+    @staticmethod
+    def from_structured(regimes_obj: dict) -> "RegimeSwitching":
+        return RegimeSwitching(regimes_obj["transition"], regimes_obj.get("initial"))
+
+    def copy(self) -> "RegimeSwitching":
+        return RegimeSwitching(self.transition, self.initial)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, RegimeSwitching)
+            and self.transition == other.transition
+            and self.initial == other.initial
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.transition, self.initial))
+
+
+def standardized_returns(
+    shocks: np.ndarray,
+    models: List[Optional[ReturnModel]],
+    moments: List[Tuple[float, float]],
+    step_moments: Moments,
+    regimes: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Return shocks (trials, steps, assets) under each asset's model (None for
+    normal), given each asset's annual (mean, stdev)"""
+    standardized = np.empty_like(shocks)
+    for i, model in enumerate(models):
+        model = ReturnModel() if model is None else model
+        standardized[:, :, i] = model.standardize(
+            shocks[:, :, i], *moments[i], step_moments, regimes
+        )
+    return standardized
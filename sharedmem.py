@@ -0,0 +1,289 @@
+"""Zero-copy data plane for multi-process simulation.
+
+The shock bank is written to shared memory once; worker processes attach to it
+read-only and write terminal values and ruin years straight into preallocated shared
+result arrays, so neither the shocks nor per-trial results are ever pickled. The
+parent process owns every segment and unlinks them when the simulator is closed,
+including when a worker dies mid-run."""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import engine
+from engine import Backend, SimulationResult
+from retcalc import simulate_values
+from rettypes import RetirementSettings
+from shocks import ShockBank
+
+# (segment name, shape, dtype) -- enough for another process to attach
+SharedArraySpec = Tuple[str, Tuple[int, ...], str]
+
+
+class SharedArray:
+    def __init__(self, shm: SharedMemory, shape: Tuple[int, ...], dtype: str):
+        self.shm = shm
+        self.array: np.ndarray = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @property
+    def spec(self) -> SharedArraySpec:
+        return (self.shm.name, self.array.shape, self.array.dtype.str)
+
+    def close(self) -> None:
+        # Views into the buffer must be released before the mapping can close
+        self.array = None  # type: ignore
+        self.shm.close()
+
+    @staticmethod
+    def create(shape: Tuple[int, ...], dtype: str) -> "SharedArray":
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        return SharedArray(SharedMemory(create=True, size=size), shape, dtype)
+
+    @staticmethod
+    def copy_of(array: np.ndarray) -> "SharedArray":
+        shared = SharedArray.create(array.shape, array.dtype.str)
+        shared.array[...] = array
+        return shared
+
+    @staticmethod
+    def attach(spec: SharedArraySpec, readonly: bool = False) -> "SharedArray":
+        name, shape, dtype = spec
+        shared = SharedArray(SharedMemory(name=name), shape, dtype)
+        if readonly:
+            shared.array.flags.writeable = False
+        return shared
+
+
+# Worker side: attachments are cached per process so each segment is mapped once
+_attached: Dict[str, SharedArray] = {}
+
+
+def _attach_cached(spec: SharedArraySpec, readonly: bool) -> np.ndarray:
+    if spec[0] not in _attached:
+        _attached[spec[0]] = SharedArray.attach(spec, readonly)
+    return _attached[spec[0]].array
+
+
+def _init_worker() -> None:
+    if engine.HAVE_NUMBA:
+        # Parallelism comes from the processes; avoid oversubscribing threads
+        import numba
+
+        numba.set_num_threads(1)
+
+
+def _simulate_chunk(
+    retirementSettings: RetirementSettings,
+    inflation_spec: SharedArraySpec,
+    returns_spec: SharedArraySpec,
+    longevity_spec: Optional[SharedArraySpec],
+    regimes_spec: Optional[SharedArraySpec],
+    values_spec: SharedArraySpec,
+    ruin_years_spec: SharedArraySpec,
+    price_index_spec: SharedArraySpec,
+    start: int,
+    stop: int,
+    backend: Backend,
+    slot: Optional[int] = None,
+) -> None:
+    """Simulate trials [start, stop) into the shared results, or into @slot of the
+    per-candidate results"""
+    shocks = ShockBank(
+        _attach_cached(inflation_spec, True)[start:stop],
+        _attach_cached(returns_spec, True)[start:stop],
+        (
+            None
+            if longevity_spec is None
+            else _attach_cached(longevity_spec, True)[start:stop]
+        ),
+        (
+            None
+            if regimes_spec is None
+            else _attach_cached(regimes_spec, True)[start:stop]
+        ),
+    )
+    result = simulate_values(retirementSettings, stop - start, shocks, backend)
+    num_assets = result.values.shape[1]
+    values = _attach_cached(values_spec, False)
+    ruin_years = _attach_cached(ruin_years_spec, False)
+    price_index = _attach_cached(price_index_spec, False)
+    if slot is not None:
+        values, ruin_years = values[slot], ruin_years[slot]
+        price_index = price_index[slot]
+    values[start:stop, :num_assets] = result.values
+    ruin_years[start:stop] = result.ruin_years
+    price_index[start:stop] = result.price_index
+
+
+class ParallelSimulator:
+    """Runs simulate_values across worker processes over one shared shock bank.
+
+    Use as a context manager (or call close) so the shared segments are always
+    unlinked:
+
+        with ParallelSimulator(shocks, processes=8) as simulator:
+            optimize_r_var(rs, rvar, True, 0.05, simulator=simulator)
+    """
+
+    def __init__(
+        self,
+        shocks: ShockBank,
+        processes: Optional[int] = None,
+        backend: Backend = Backend.AUTO,
+    ):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backend = backend
+        self.n = shocks.n
+        self.t = shocks.t
+        self.num_assets = shocks.num_assets
+        self._segments: List[SharedArray] = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+        try:
+            self._inflation = self._add(SharedArray.copy_of(shocks.inflation))
+            self._returns = self._add(SharedArray.copy_of(shocks.returns))
+            self._longevity = (
+                None
+                if shocks.longevity is None
+                else self._add(SharedArray.copy_of(shocks.longevity))
+            )
+            self._regimes = (
+                None
+                if shocks.regimes is None
+                else self._add(SharedArray.copy_of(shocks.regimes))
+            )
+            self._values = self._add(
+                SharedArray.create((self.n, self.num_assets), "<f8")
+            )
+            self._ruin_years = self._add(SharedArray.create((self.n,), "<i8"))
+            self._price_index = self._add(SharedArray.create((self.n,), "<f8"))
+            # One result slot per process for simulate_many, created on first use
+            self._slot_values: Optional[SharedArray] = None
+            self._slot_ruin_years: Optional[SharedArray] = None
+            self._slot_price_index: Optional[SharedArray] = None
+            self._executor = ProcessPoolExecutor(
+                self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def _add(self, segment: SharedArray) -> SharedArray:
+        self._segments.append(segment)
+        return segment
+
+    def segment_names(self) -> List[str]:
+        return [segment.shm.name for segment in self._segments]
+
+    def fits(self, retirementSettings: RetirementSettings, n: int) -> bool:
+        return (
+            n <= self.n
+            and retirementSettings.steps <= self.t
+            and len(retirementSettings.asset_distribution.asset_allocations)
+            <= self.num_assets
+        )
+
+    def _specs(self) -> Tuple[Optional[SharedArraySpec], ...]:
+        return (
+            self._inflation.spec,
+            self._returns.spec,
+            None if self._longevity is None else self._longevity.spec,
+            None if self._regimes is None else self._regimes.spec,
+        )
+
+    def simulate_many(
+        self, settings: List[RetirementSettings], n: int
+    ) -> List[SimulationResult]:
+        """Simulate each of settings over the same n trials, one whole simulation per
+        worker at a time, eg. the candidates of one round of a parallel search"""
+        assert self._executor is not None, "simulator is closed"
+        assert all(self.fits(rs, n) for rs in settings)
+        if self._slot_values is None:
+            shape = (self.processes, self.n)
+            self._slot_values = self._add(
+                SharedArray.create(shape + (self.num_assets,), "<f8")
+            )
+            self._slot_ruin_years = self._add(SharedArray.create(shape, "<i8"))
+            self._slot_price_index = self._add(SharedArray.create(shape, "<f8"))
+        assert self._slot_ruin_years is not None
+        assert self._slot_price_index is not None
+        results = []
+        for first in range(0, len(settings), self.processes):
+            wave = settings[first : first + self.processes]
+            futures = [
+                self._executor.submit(
+                    _simulate_chunk,
+                    rs,
+                    *self._specs(),
+                    self._slot_values.spec,
+                    self._slot_ruin_years.spec,
+                    self._slot_price_index.spec,
+                    0,
+                    n,
+                    self.backend,
+                    slot,
+                )
+                for slot, rs in enumerate(wave)
+            ]
+            for slot, (rs, future) in enumerate(zip(wave, futures)):
+                future.result()
+                num_assets = len(rs.asset_distribution.asset_allocations)
+                results.append(
+                    SimulationResult(
+                        self._slot_values.array[slot, :n, :num_assets].copy(),
+                        self._slot_ruin_years.array[slot, :n].copy(),
+                        self._slot_price_index.array[slot, :n].copy(),
+                    )
+                )
+        return results
+
+    def simulate_values(
+        self, retirementSettings: RetirementSettings, n: int
+    ) -> SimulationResult:
+        assert self._executor is not None, "simulator is closed"
+        assert self.fits(retirementSettings, n)
+        chunk = -(-n // self.processes)
+        futures = [
+            self._executor.submit(
+                _simulate_chunk,
+                retirementSettings,
+                *self._specs(),
+                self._values.spec,
+                self._ruin_years.spec,
+                self._price_index.spec,
+                start,
+                min(start + chunk, n),
+                self.backend,
+            )
+            for start in range(0, n, chunk)
+        ]
+        for future in futures:
+            # Re-raises worker exceptions, including BrokenProcessPool on a crash
+            future.result()
+
+        num_assets = len(retirementSettings.asset_distribution.asset_allocations)
+        # Copy out: the shared buffers are reused by the next call
+        return SimulationResult(
+            self._values.array[:n, :num_assets].copy(),
+            self._ruin_years.array[:n].copy(),
+            self._price_index.array[:n].copy(),
+        )
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for segment in self._segments:
+            segment.shm.unlink()
+            segment.close()
+        self._segments = []
+
+    def __enter__(self) -> "ParallelSimulator":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,162 @@
+from enum import Enum
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+from mortality import MAX_LIVES
+from rettypes import RetirementSettings
+
+try:
+    from scipy.special import ndtri
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+# Anything np.random.default_rng accepts; a Generator is used (and advanced) as is
+Seed = Union[None, int, np.random.Generator]
+
+
+class Sampling(Enum):
+    PSEUDO_RANDOM = 1
+    # Scrambled Sobol sequence mapped through the inverse normal CDF (needs scipy)
+    SOBOL = 2
+
+
+class ShockBank:
+    """Pre-drawn standard normal shocks shared between simulation engines.
+
+    inflation has shape (trials, steps) and returns has shape (trials, steps, assets);
+    a step is a year unless settings use a finer step frequency. Asset columns follow
+    the (priority sorted) order of AssetDistribution.asset_allocations.
+
+    longevity holds uniform draws of shape (trials, MAX_LIVES) that decide when
+    each person of a mortality.Lifespan dies, and regimes uniform draws of shape
+    (trials, steps) that move the market regimes of returnmodels.RegimeSwitching."""
+
+    def __init__(
+        self,
+        inflation: np.ndarray,
+        returns: np.ndarray,
+        longevity: Optional[np.ndarray] = None,
+        regimes: Optional[np.ndarray] = None,
+    ):
+        assert inflation.ndim == 2 and returns.ndim == 3
+        assert inflation.shape == returns.shape[:2]
+        assert longevity is None or longevity.shape == (inflation.shape[0], MAX_LIVES)
+        assert regimes is None or regimes.shape == inflation.shape
+        self.inflation = inflation
+        self.returns = returns
+        self.longevity = longevity
+        self.regimes = regimes
+        # Banks derived from this one (see engine.model_shocks), by what they were
+        # derived for
+        self.derived: Dict[Any, "ShockBank"] = {}
+
+    @property
+    def n(self) -> int:
+        return self.inflation.shape[0]
+
+    @property
+    def t(self) -> int:
+        return self.inflation.shape[1]
+
+    @property
+    def num_assets(self) -> int:
+        return self.returns.shape[2]
+
+    def fits(self, retirementSettings: RetirementSettings, n: int) -> bool:
+        return (
+            n <= self.n
+            and retirementSettings.steps <= self.t
+            and len(retirementSettings.asset_distribution.asset_allocations)
+            <= self.num_assets
+        )
+
+    def extended(self, t: int, seed: Seed = None) -> "ShockBank":
+        """This bank with pseudo-random steps appended up to t steps. Existing steps
+        are kept, so paths simulated on this bank continue exactly on the new one."""
+        assert t >= self.t
+        rng = np.random.default_rng(seed)
+        extra = t - self.t
+        return ShockBank(
+            np.concatenate(
+                (self.inflation, rng.standard_normal((self.n, extra))), axis=1
+            ),
+            np.concatenate(
+                (self.returns, rng.standard_normal((self.n, extra, self.num_assets))),
+                axis=1,
+            ),
+            self.longevity,
+            (
+                None
+                if self.regimes is None
+                else np.concatenate((self.regimes, rng.random((self.n, extra))), axis=1)
+            ),
+        )
+
+    @staticmethod
+    def generate(n: int, t: int, num_assets: int, seed: Seed = None) -> "ShockBank":
+        rng = np.random.default_rng(seed)
+        inflation = rng.standard_normal((n, t))
+        returns = rng.standard_normal((n, t, num_assets))
+        # Drawn last so the other shocks do not depend on them
+        longevity = rng.random((n, MAX_LIVES))
+        regimes = rng.random((n, t))
+        return ShockBank(inflation, returns, longevity, regimes)
+
+    @staticmethod
+    def sobol(n: int, t: int, num_assets: int, seed: Seed = None) -> "ShockBank":
+        """Quasi-random shocks: one scrambled Sobol point per trial over the
+        (steps x (inflation + assets)) dimensions. Dimensions are ordered step by
+        step, so the best distributed leading dimensions drive the early steps.
+        n should be a power of 2 to keep the sequence balanced."""
+        if qmc is None:
+            raise ImportError("Sobol sampling requires scipy")
+        sampler = qmc.Sobol(t * (num_assets + 1), scramble=True, seed=seed)
+        if n & (n - 1) == 0:
+            points = sampler.random_base2(n.bit_length() - 1)
+        else:
+            points = sampler.random(n)
+        # Keep the inverse CDF finite
+        eps = np.finfo(float).eps
+        shocks = ndtri(np.clip(points, eps, 1 - eps)).reshape(n, t, num_assets + 1)
+        rng = np.random.default_rng(seed)
+        longevity = rng.random((n, MAX_LIVES))
+        regimes = rng.random((n, t))
+        return ShockBank(
+            np.ascontiguousarray(shocks[:, :, 0]),
+            np.ascontiguousarray(shocks[:, :, 1:]),
+            longevity,
+            regimes,
+        )
+
+    @staticmethod
+    def for_settings(
+        retirementSettings: RetirementSettings,
+        n: int,
+        seed: Seed = None,
+        sampling: Sampling = Sampling.PSEUDO_RANDOM,
+    ) -> "ShockBank":
+        generate = ShockBank.sobol if sampling == Sampling.SOBOL else ShockBank.generate
+        return generate(
+            n,
+            retirementSettings.steps,
+            len(retirementSettings.asset_distribution.asset_allocations),
+            seed,
+        )
+
+    @staticmethod
+    def replicates(
+        retirementSettings: RetirementSettings,
+        n: int,
+        replicates: int,
+        seed: Seed = None,
+        sampling: Sampling = Sampling.SOBOL,
+    ) -> List["ShockBank"]:
+        """Independently randomized banks, for error estimates of quasi-random
+        results (the trials within one Sobol bank are not independent)"""
+        rng = np.random.default_rng(seed)
+        return [
+            ShockBank.for_settings(retirementSettings, n, rng, sampling)
+            for _ in range(replicates)
+        ]
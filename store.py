@@ -0,0 +1,275 @@
+"""Indexed store of saved scenarios with a binary cache next to the YAML files.
+
+The YAML files stay the source of truth. The store keeps, in a .store directory
+beside them, an index with each file's metadata (name, asset count, horizon,
+content hash, mtime, size and tags) and a pickled copy of each scenario in its
+normalized structured form, keyed by content hash. refresh only reads files whose
+mtime or size changed and only parses files whose content hash changed, so
+opening a store of tens of thousands of unchanged scenarios parses no YAML at all.
+Scenarios are materialized from the cache on first use."""
+
+import hashlib
+import json
+import os
+from os import path
+import pickle
+from typing import Dict, Iterable, List, Optional
+
+from yaml import YAMLError
+
+from rettypes import RetirementSettings
+from yaml_helper import dump_yaml, load_yaml, parse_yaml
+
+STORE_DIRNAME = ".store"
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+
+
+class ScenarioEntry:
+    """Index metadata of one saved scenario file"""
+
+    def __init__(
+        self,
+        filename: str,
+        num_assets: int,
+        t: int,
+        content_hash: str,
+        mtime: float,
+        size: int,
+        tags: Optional[List[str]] = None,
+    ):
+        self.filename = filename
+        self.num_assets = num_assets
+        self.t = t
+        self.content_hash = content_hash
+        self.mtime = mtime
+        self.size = size
+        self.tags = tags if tags is not None else []
+
+    @property
+    def name(self) -> str:
+        return self.filename[: -len(".yaml")]
+
+    @staticmethod
+    def from_structured(entry_obj: dict) -> "ScenarioEntry":
+        return ScenarioEntry(
+            entry_obj["filename"],
+            entry_obj["num_assets"],
+            entry_obj["t"],
+            entry_obj["content_hash"],
+            entry_obj["mtime"],
+            entry_obj["size"],
+            entry_obj["tags"],
+        )
+
+    def to_structured(self) -> dict:
+        return {
+            "filename": self.filename,
+            "num_assets": self.num_assets,
+            "t": self.t,
+            "content_hash": self.content_hash,
+            "mtime": self.mtime,
+            "size": self.size,
+            "tags": self.tags,
+        }
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class ScenarioStore:
+    """Every *.yaml scenario in dirpath. Scenario files may carry a list of tags
+    under a top-level tags key, which RetirementSettings itself ignores.
+
+    The index and cache are rewritten atomically after every refresh that changed
+    them. When the directory is read-only the store still works, but re-parses
+    changed files every time it is opened. Files that fail to parse are left out
+    and listed in errors with the reason."""
+
+    def __init__(self, dirpath: str, refresh: bool = True):
+        self.dirpath = dirpath
+        self.store_dirpath = path.join(dirpath, STORE_DIRNAME)
+        self.entries: Dict[str, ScenarioEntry] = {}
+        # Why each file left out by the last refresh could not be read
+        self.errors: Dict[str, str] = {}
+        # Unpickled structured scenarios by content hash, filled lazily
+        self._structured: Dict[str, dict] = {}
+        self._read_index()
+        if refresh:
+            self.refresh()
+
+    def _index_filepath(self) -> str:
+        return path.join(self.store_dirpath, INDEX_FILENAME)
+
+    def _cache_filepath(self, content_hash: str) -> str:
+        return path.join(self.store_dirpath, content_hash + ".pickle")
+
+    def _read_index(self) -> None:
+        try:
+            with open(self._index_filepath()) as stream:
+                index_obj = json.load(stream)
+        except (OSError, ValueError):
+            return
+        if index_obj.get("version") != INDEX_VERSION:
+            return
+        self.entries = {
+            entry_obj["filename"]: ScenarioEntry.from_structured(entry_obj)
+            for entry_obj in index_obj["entries"]
+        }
+
+    def _write(self, filepath: str, data: bytes) -> None:
+        os.makedirs(self.store_dirpath, exist_ok=True)
+        temp_filepath = filepath + ".tmp"
+        with open(temp_filepath, "wb") as stream:
+            stream.write(data)
+        os.replace(temp_filepath, filepath)
+
+    def _write_index(self) -> None:
+        index_obj = {
+            "version": INDEX_VERSION,
+            "entries": [entry.to_structured() for entry in self.entries.values()],
+        }
+        self._write(self._index_filepath(), json.dumps(index_obj).encode())
+
+    def _compile(self, filename: str, content: bytes, stat: os.stat_result) -> None:
+        """Parse a new or changed file into its entry and cache"""
+        digest = content_hash(content)
+        # The content that was hashed, not the file, which may have changed since
+        scenario_obj = parse_yaml(content)
+        tags = [str(tag) for tag in scenario_obj.pop("tags", None) or []]
+        rs = RetirementSettings.from_structured(scenario_obj)
+        self.entries[filename] = ScenarioEntry(
+            filename,
+            len(rs.asset_distribution.asset_allocations),
+            rs.t,
+            digest,
+            stat.st_mtime,
+            stat.st_size,
+            tags,
+        )
+        # Normalized, so loading it back skips the legacy format branches
+        self._structured[digest] = rs.to_structured()
+        if not path.isfile(self._cache_filepath(digest)):
+            self._write(
+                self._cache_filepath(digest),
+                pickle.dumps(self._structured[digest], pickle.HIGHEST_PROTOCOL),
+            )
+
+    def refresh(self) -> None:
+        """Bring the index and cache in sync with the YAML files"""
+        changed = False
+        self.errors = {}
+        filenames = sorted(
+            filename
+            for filename in os.listdir(self.dirpath)
+            if filename.endswith(".yaml")
+        )
+        for filename in set(self.entries) - set(filenames):
+            del self.entries[filename]
+            changed = True
+        for filename in filenames:
+            stat = os.stat(path.join(self.dirpath, filename))
+            entry = self.entries.get(filename)
+            if (
+                entry is not None
+                and entry.mtime == stat.st_mtime
+                and entry.size == stat.st_size
+            ):
+                continue
+            with open(path.join(self.dirpath, filename), "rb") as stream:
+                content = stream.read()
+            if entry is not None and entry.content_hash == content_hash(content):
+                # Touched but unchanged
+                entry.mtime = stat.st_mtime
+            else:
+                try:
+                    self._compile(filename, content, stat)
+                except (
+                    OSError,
+                    YAMLError,
+                    AttributeError,
+                    KeyError,
+                    TypeError,
+                    ValueError,
+                ) as e:
+                    entry = self.entries.get(filename)
+                    # Parsed but not cached (read-only store) keeps its new entry
+                    if entry is None or entry.content_hash != content_hash(content):
+                        self.entries.pop(filename, None)
+                        self.errors[filename] = f"{type(e).__name__}: {e}"
+            changed = True
+        # Keep entries in filename order, like load_retirement_settings_dir
+        self.entries = {
+            filename: self.entries[filename]
+            for filename in filenames
+            if filename in self.entries
+        }
+        if changed:
+            try:
+                self._write_index()
+                self._collect_garbage()
+            except OSError:
+                pass
+
+    def _collect_garbage(self) -> None:
+        used = {entry.content_hash + ".pickle" for entry in self.entries.values()}
+        for filename in os.listdir(self.store_dirpath):
+            if filename.endswith(".pickle") and filename not in used:
+                os.remove(path.join(self.store_dirpath, filename))
+
+    def _structured_of(self, entry: ScenarioEntry) -> dict:
+        digest = entry.content_hash
+        if digest not in self._structured:
+            try:
+                with open(self._cache_filepath(digest), "rb") as stream:
+                    self._structured[digest] = pickle.load(stream)
+            except OSError:
+                # Read-only store: fall back to the source
+                scenario_obj = load_yaml(path.join(self.dirpath, entry.filename))
+                scenario_obj.pop("tags", None)
+                self._structured[digest] = scenario_obj
+        return self._structured[digest]
+
+    def load(self, filename: str) -> RetirementSettings:
+        """A fresh RetirementSettings for filename, materialized from the cache"""
+        if not filename.endswith(".yaml"):
+            filename += ".yaml"
+        return RetirementSettings.from_structured(
+            self._structured_of(self.entries[filename])
+        )
+
+    def load_all(
+        self, entries: Optional[Iterable[ScenarioEntry]] = None
+    ) -> List[RetirementSettings]:
+        """Every scenario (or those of entries), in filename order"""
+        if entries is None:
+            entries = self.entries.values()
+        return [self.load(entry.filename) for entry in entries]
+
+    def with_tag(self, tag: str) -> List[ScenarioEntry]:
+        return [entry for entry in self.entries.values() if tag in entry.tags]
+
+    def with_hash(self, content_hash: str) -> List[ScenarioEntry]:
+        """Entries whose file content has this hash (duplicates share one)"""
+        return [
+            entry
+            for entry in self.entries.values()
+            if entry.content_hash == content_hash
+        ]
+
+    def save(
+        self,
+        filename: str,
+        retirementSettings: RetirementSettings,
+        tags: Optional[List[str]] = None,
+    ) -> ScenarioEntry:
+        """Write a scenario file with tags and index it straight away"""
+        if not filename.endswith(".yaml"):
+            filename += ".yaml"
+        scenario_obj = retirementSettings.to_structured()
+        if tags:
+            scenario_obj["tags"] = list(tags)
+        dump_yaml(scenario_obj, path.join(self.dirpath, filename))
+        self.refresh()
+        return self.entries[filename]
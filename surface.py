@@ -0,0 +1,240 @@
+"""Precomputed tail value response surface for quick "what if I spend X for T years"
+answers against a fixed asset mix.
+
+Tail values and ruin probabilities are simulated once over a grid of expenditure x
+starting value, with every grid point using the same shock bank. Each grid point
+is advanced one year at a time, so every horizon from 1 to max_t comes out of a
+single pass. Lookups interpolate bilinearly between grid points at the exact
+horizon, which takes microseconds instead of a full simulation."""
+
+from bisect import bisect_right
+import json
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from engine import Backend, FlatScenario, PathState
+from retcalc import advance_paths, simulate_values
+from rettypes import RetirementSettings
+from shocks import Seed, ShockBank
+
+SURFACE_SUFFIX = ".surface.npz"
+
+
+def surface_path(scenario_filepath: str) -> str:
+    """Where the surface of a saved scenario is stored, next to the scenario"""
+    if scenario_filepath.endswith(".yaml"):
+        scenario_filepath = scenario_filepath[: -len(".yaml")]
+    return scenario_filepath + SURFACE_SUFFIX
+
+
+def mix_key(retirementSettings: RetirementSettings) -> str:
+    """Everything a surface depends on except its axes: expenditure, horizon and the
+    total starting value (asset values are reduced to fractions of the total, unless
+    it is 0)"""
+    ret_obj = retirementSettings.to_structured()
+    del ret_obj["expenditure"], ret_obj["t"]
+    ret_obj["expenditure_reduction_frac"] = (
+        retirementSettings.expenditure_reduction_frac
+    )
+    total = retirementSettings.current_value()
+    if total != 0:
+        for aa in ret_obj["asset_distribution"]["asset_allocations"]:
+            aa["asset"]["value"] = round(aa["asset"]["value"] / total, 12)
+    return json.dumps(ret_obj, sort_keys=True)
+
+
+def scaled_settings(
+    retirementSettings: RetirementSettings, expenditure: float, t: int, value: float
+) -> RetirementSettings:
+    """Copy of retirementSettings spending expenditure for t years, with every asset
+    scaled so the total starting value is value. A scenario starting with nothing
+    has no mix to scale, so it can only keep a total of 0."""
+    rs = retirementSettings.copy()
+    rs.expenditure = expenditure
+    rs.t = t
+    total = retirementSettings.current_value()
+    if total == 0:
+        if value != 0:
+            raise ValueError("Cannot scale a scenario with no starting value")
+        return rs
+    scale = value / total
+    for aa in rs.asset_distribution.asset_allocations:
+        aa.asset.value *= scale
+    return rs
+
+
+def _bracket(axis: List[float], x: float) -> Tuple[int, float]:
+    """Index i and weight w such that x = (1 - w) * axis[i] + w * axis[i + 1]"""
+    if not axis[0] <= x <= axis[-1]:
+        raise ValueError(f"{x} is outside the surface grid [{axis[0]}, {axis[-1]}]")
+    i = min(bisect_right(axis, x) - 1, len(axis) - 2)
+    return i, (x - axis[i]) / (axis[i + 1] - axis[i])
+
+
+class ResponseSurface:
+    """tail_values and ruin_probabilities have shape (expenditures, max_t, values);
+    index [e, t - 1, v] holds the result of spending expenditures[e] for t years
+    starting from a total of values[v].
+
+    Tail values are made monotone (non-increasing in expenditure, non-decreasing in
+    starting value) so interpolated lookups and max_expenditure are well behaved.
+    Likewise ruin probabilities never fall with expenditure or horizon, nor rise with
+    starting value.
+    error_bound is the largest difference between a lookup and a direct simulation
+    over the same shocks seen when the surface was built."""
+
+    def __init__(
+        self,
+        key: str,
+        expenditures: np.ndarray,
+        values: np.ndarray,
+        tail_values: np.ndarray,
+        ruin_probabilities: np.ndarray,
+        pmin: float,
+        n: int,
+        error_bound: float,
+    ):
+        assert len(expenditures) >= 2 and len(values) >= 2
+        self.key = key
+        self.expenditures = expenditures
+        self.values = values
+        self.tail_values = tail_values
+        self.ruin_probabilities = ruin_probabilities
+        self.pmin = pmin
+        self.n = n
+        self.error_bound = error_bound
+        # Plain lists bisect much faster than numpy arrays for single lookups
+        self._expenditures = [float(e) for e in expenditures]
+        self._values = [float(v) for v in values]
+
+    @property
+    def max_t(self) -> int:
+        return self.tail_values.shape[1]
+
+    def matches(self, retirementSettings: RetirementSettings) -> bool:
+        return self.key == mix_key(retirementSettings)
+
+    def _interpolate(
+        self, grid: np.ndarray, expenditure: float, t: int, value: float
+    ) -> float:
+        if not 1 <= t <= self.max_t:
+            raise ValueError(f"t={t} is outside the surface horizon 1..{self.max_t}")
+        e, we = _bracket(self._expenditures, expenditure)
+        v, wv = _bracket(self._values, value)
+        plane = grid[:, t - 1]
+        low = (1 - wv) * plane[e, v] + wv * plane[e, v + 1]
+        high = (1 - wv) * plane[e + 1, v] + wv * plane[e + 1, v + 1]
+        return float((1 - we) * low + we * high)
+
+    def tail_value(self, expenditure: float, t: int, value: float) -> float:
+        return self._interpolate(self.tail_values, expenditure, t, value)
+
+    def ruin_probability(self, expenditure: float, t: int, value: float) -> float:
+        return self._interpolate(self.ruin_probabilities, expenditure, t, value)
+
+    def max_expenditure(self, t: int, value: float, emergency_min: float = 0) -> float:
+        """Largest expenditure on the grid's range whose tail value stays at or above
+        emergency_min, the lookup equivalent of optimize_r_var on EXPENDITURE"""
+        column = [
+            self.tail_value(e, t, value) - emergency_min for e in self._expenditures
+        ]
+        if column[0] < 0:
+            return self._expenditures[0]
+        for i in range(1, len(column)):
+            if column[i] < 0:
+                # Tail value is linear in expenditure between grid points
+                low, high = self._expenditures[i - 1], self._expenditures[i]
+                return low + (high - low) * column[i - 1] / (column[i - 1] - column[i])
+        return self._expenditures[-1]
+
+    def save(self, filepath: str) -> None:
+        np.savez_compressed(
+            filepath,
+            key=np.array(self.key),
+            expenditures=self.expenditures,
+            values=self.values,
+            tail_values=self.tail_values.astype(np.float32),
+            ruin_probabilities=self.ruin_probabilities.astype(np.float32),
+            pmin=self.pmin,
+            n=self.n,
+            error_bound=self.error_bound,
+        )
+
+    @staticmethod
+    def load(filepath: str) -> "ResponseSurface":
+        with np.load(filepath) as data:
+            return ResponseSurface(
+                str(data["key"]),
+                data["expenditures"],
+                data["values"],
+                data["tail_values"].astype(float),
+                data["ruin_probabilities"].astype(float),
+                float(data["pmin"]),
+                int(data["n"]),
+                float(data["error_bound"]),
+            )
+
+    @staticmethod
+    def build(
+        retirementSettings: RetirementSettings,
+        expenditures: Sequence[float],
+        values: Sequence[float],
+        max_t: Optional[int] = None,
+        pmin: float = 0.05,
+        n: int = 10_000,
+        shocks: Optional[ShockBank] = None,
+        seed: Seed = None,
+        backend: Backend = Backend.AUTO,
+        validation_points: int = 20,
+    ) -> "ResponseSurface":
+        """Simulate the grid, then measure the error bound against direct simulation
+        at validation_points random off-grid points.
+        @expenditures, @values: Increasing grid axes.
+        @max_t: Longest horizon, retirementSettings.t by default."""
+        expenditures = np.array(expenditures, dtype=float)
+        values = np.array(values, dtype=float)
+        max_t = retirementSettings.t if max_t is None else max_t
+        if shocks is None:
+            rs = retirementSettings.copy()
+            rs.t = max_t
+            shocks = ShockBank.for_settings(rs, n, seed)
+        tail_values = np.empty((len(expenditures), max_t, len(values)))
+        ruin_probabilities = np.empty_like(tail_values)
+        for e, expenditure in enumerate(expenditures):
+            for v, value in enumerate(values):
+                # Advancing a year at a time continues the same paths, so year t
+                # is exactly a t year simulation
+                rs = scaled_settings(retirementSettings, expenditure, 1, value)
+                state = PathState.initial(FlatScenario.from_retirement_settings(rs), n)
+                for year in range(max_t):
+                    advance_paths(rs, state, shocks, backend)
+                    result = state.result()
+                    tail_values[e, year, v] = result.tail_value(pmin)
+                    ruin_probabilities[e, year, v] = result.ruin_probability()
+        tail_values = np.minimum.accumulate(tail_values, axis=0)
+        tail_values = np.maximum.accumulate(tail_values, axis=2)
+        ruin_probabilities = np.maximum.accumulate(ruin_probabilities, axis=0)
+        ruin_probabilities = np.maximum.accumulate(ruin_probabilities, axis=1)
+        ruin_probabilities = np.minimum.accumulate(ruin_probabilities, axis=2)
+
+        surface = ResponseSurface(
+            mix_key(retirementSettings),
+            expenditures,
+            values,
+            tail_values,
+            ruin_probabilities,
+            pmin,
+            n,
+            0.0,
+        )
+        rng = np.random.default_rng(seed)
+        for _ in range(validation_points):
+            expenditure = rng.uniform(expenditures[0], expenditures[-1])
+            value = rng.uniform(values[0], values[-1])
+            t = int(rng.integers(1, max_t + 1))
+            rs = scaled_settings(retirementSettings, expenditure, t, value)
+            direct = simulate_values(rs, n, shocks, backend).tail_value(pmin)
+            error = abs(surface.tail_value(expenditure, t, value) - direct)
+            surface.error_bound = max(surface.error_bound, error)
+        return surface
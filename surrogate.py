@@ -0,0 +1,286 @@
+"""Surrogate-assisted search over several settings at once.
+
+optimize_r_var bisects one RValue with a full simulation per probe. surrogate_optimize
+instead searches a box of Variables, eg. expenditure, horizon and an equity fraction,
+for the settings that maximize a cheap objective of their values while the pmin
+tail value stays above emergency_min. A Gaussian process fitted to the tail
+margins simulated so far (with each simulation's own sampling error as noise)
+predicts the margin everywhere in the box, and the next settings simulated are
+the candidates with the largest expected improvement: the gain in objective over
+the best settings known to be safe, times the probability of being safe. The
+search stops once that expectation is negligible, typically after a few tens of
+simulations, and answers with simulated (never predicted) settings whose margin
+is positive with 95% confidence.
+
+    variables = [Variable(RValue(RSetting.EXPENDITURE), 20000, 80000),
+                 Variable(RValue(RSetting.T), 20, 40, integer=True)]
+    result = surrogate_optimize(rs, variables, lambda v: v[0] + 1000 * v[1], 0.05)
+"""
+
+import math
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from anytime import Z_95, tail_interval
+from engine import Backend
+from retcalc import simulate_values
+from rettypes import RetirementSettings, RValue
+from shocks import Seed, ShockBank
+
+# Length scales (on the unit box) and signal variances (of standardized margins)
+# the Gaussian process chooses between by marginal likelihood
+LENGTH_SCALES = np.geomspace(0.05, 4, 20)
+SIGNAL_VARIANCES = (0.25, 1.0, 4.0)
+
+_erf = np.frompyfunc(math.erf, 1, 1)
+
+
+def normal_cdf(x: np.ndarray) -> np.ndarray:
+    return 0.5 * (1 + _erf(np.asarray(x) / math.sqrt(2)).astype(float))
+
+
+class Variable:
+    """A setting searched over [low, high]. Integer settings (eg. RSetting.T) are
+    rounded to whole numbers."""
+
+    def __init__(self, rvalue: RValue, low: float, high: float, integer: bool = False):
+        assert low < high
+        self.rvalue = rvalue
+        self.low = low
+        self.high = high
+        self.integer = integer
+
+    def value(self, unit: float) -> float:
+        """The value at unit in [0, 1] along the range"""
+        value = float(self.low + unit * (self.high - self.low))
+        return float(round(value)) if self.integer else value
+
+    def unit(self, value: float) -> float:
+        return (value - self.low) / (self.high - self.low)
+
+
+def apply_values(
+    retirementSettings: RetirementSettings,
+    variables: Sequence[Variable],
+    values: Sequence[float],
+) -> RetirementSettings:
+    """Copy of retirementSettings with every variable set to its value"""
+    rs = retirementSettings.copy()
+    for variable, value in zip(variables, values):
+        if variable.integer:
+            value = int(value)
+        rs.update_val(variable.rvalue, lambda _: value)
+    return rs
+
+
+class Evaluation:
+    """One simulation: the pmin tail value minus emergency_min at values, with the
+    bounds of its 95% confidence interval"""
+
+    def __init__(
+        self,
+        values: Tuple[float, ...],
+        objective: float,
+        margin: float,
+        lower: float,
+        upper: float,
+    ):
+        self.values = values
+        self.objective = objective
+        self.margin = margin
+        self.lower = lower
+        self.upper = upper
+
+    @property
+    def safe(self) -> bool:
+        """Whether the margin is positive with 95% confidence"""
+        return self.lower >= 0
+
+    @property
+    def noise(self) -> float:
+        """Standard error of the margin"""
+        return (self.upper - self.lower) / (2 * Z_95)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"Evaluation({fields})"
+
+
+class GaussianProcess:
+    """Regression of y on points of the unit box with a squared exponential kernel,
+    a constant mean and a known noise variance per point. The length scale and
+    signal variance maximize the marginal likelihood over a grid."""
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, noise: np.ndarray):
+        self.x = x
+        self.mean = float(y.mean())
+        self.scale = float(y.std()) or 1.0
+        z = (y - self.mean) / self.scale
+        # A little jitter keeps the kernel matrix positive definite
+        noise = noise / self.scale**2 + 1e-8
+        distances = ((x[:, None, :] - x[None, :, :]) ** 2).sum(axis=2)
+        best = -math.inf
+        for length_scale in LENGTH_SCALES:
+            correlation = np.exp(-distances / (2 * length_scale**2))
+            for signal in SIGNAL_VARIANCES:
+                try:
+                    cholesky = np.linalg.cholesky(signal * correlation + np.diag(noise))
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, z))
+                likelihood = -z @ alpha / 2 - np.log(np.diag(cholesky)).sum()
+                if likelihood > best:
+                    best = likelihood
+                    self.length_scale = length_scale
+                    self.signal = signal
+                    self.cholesky = cholesky
+                    self.alpha = alpha
+
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Mean and standard deviation of y at points x"""
+        distances = ((x[:, None, :] - self.x[None, :, :]) ** 2).sum(axis=2)
+        cross = self.signal * np.exp(-distances / (2 * self.length_scale**2))
+        mean = self.mean + self.scale * (cross @ self.alpha)
+        v = np.linalg.solve(self.cholesky, cross.T)
+        variance = np.maximum(self.signal - (v**2).sum(axis=0), 1e-12)
+        return mean, self.scale * np.sqrt(variance)
+
+
+class SurrogateResult:
+    """The best safe evaluation (None if no simulated settings were safe), its
+    settings, and every evaluation in the order made"""
+
+    def __init__(
+        self,
+        best: Optional[Evaluation],
+        settings: Optional[RetirementSettings],
+        evaluations: List[Evaluation],
+        converged: bool,
+    ):
+        self.best = best
+        self.settings = settings
+        self.evaluations = evaluations
+        # False when max_evaluations ran out first
+        self.converged = converged
+
+
+def latin_hypercube(points: int, dims: int, rng: np.random.Generator) -> np.ndarray:
+    """points spread over the unit box, one in every 1 / points slice of each
+    dimension"""
+    strata = np.array([rng.permutation(points) for _ in range(dims)]).T
+    return (strata + rng.random((points, dims))) / points
+
+
+def surrogate_optimize(
+    retirementSettings: RetirementSettings,
+    variables: Sequence[Variable],
+    objective: Callable[[Tuple[float, ...]], float],
+    pmin: float,
+    shocks: Optional[ShockBank] = None,
+    backend: Backend = Backend.AUTO,
+    n: int = 10_000,
+    max_evaluations: int = 40,
+    initial: Optional[int] = None,
+    tolerance: float = 0.001,
+    candidates: int = 2000,
+    seed: Seed = None,
+    on_evaluation: Optional[Callable[[Evaluation], None]] = None,
+) -> SurrogateResult:
+    """Values of variables maximizing objective(values) subject to the pmin tail
+    value exceeding emergency_min with 95% confidence.
+
+    @shocks: Every simulation runs on this bank (common random numbers); by default
+    one drawn for the longest horizon the variables allow.
+    @initial: Simulations spread over the box before the surrogate takes over, by
+    default 2 per variable + 1.
+    @tolerance: Stop once no candidate is expected to improve the objective by more
+    than this fraction of the best objective so far.
+    @candidates: Random points the expected improvement is maximized over each
+    round; half of them are drawn close to the best settings so far.
+    @on_evaluation: Called after every simulation."""
+    rng = np.random.default_rng(seed)
+    dims = len(variables)
+    if shocks is None:
+        widest = apply_values(
+            retirementSettings, variables, [v.high for v in variables]
+        )
+        longest = max(widest, retirementSettings, key=lambda rs: rs.steps)
+        shocks = ShockBank.for_settings(longest, n, rng)
+
+    def values_at(unit: np.ndarray) -> Tuple[float, ...]:
+        return tuple(v.value(u) for v, u in zip(variables, unit))
+
+    def unit_of(values: Tuple[float, ...]) -> np.ndarray:
+        return np.array([v.unit(x) for v, x in zip(variables, values)])
+
+    units: List[np.ndarray] = []
+    evaluations: List[Evaluation] = []
+
+    def evaluate(values: Tuple[float, ...]) -> None:
+        rs = apply_values(retirementSettings, variables, values)
+        result = simulate_values(rs, n, shocks, backend)
+        tail, lower, upper = tail_interval(result.current_values(), pmin)
+        evaluation = Evaluation(
+            values,
+            objective(values),
+            tail - rs.emergency_min,
+            lower - rs.emergency_min,
+            upper - rs.emergency_min,
+        )
+        units.append(unit_of(values))
+        evaluations.append(evaluation)
+        if on_evaluation is not None:
+            on_evaluation(evaluation)
+
+    for unit in latin_hypercube(initial or 2 * dims + 1, dims, rng):
+        evaluate(values_at(unit))
+
+    converged = False
+    while len(evaluations) < max_evaluations:
+        safe = [e for e in evaluations if e.safe]
+        gp = GaussianProcess(
+            np.array(units),
+            np.array([e.margin for e in evaluations]),
+            np.array([e.noise for e in evaluations]) ** 2,
+        )
+        pool = rng.random((candidates, dims))
+        if safe:
+            best_unit = units[evaluations.index(max(safe, key=lambda e: e.objective))]
+            near = best_unit + 0.05 * rng.standard_normal((candidates // 2, dims))
+            pool[: candidates // 2] = np.clip(near, 0, 1)
+        # Snapped to the values that would be simulated (eg. whole years), leaving
+        # out settings simulated already
+        pool_values = [values_at(unit) for unit in pool]
+        pool = np.array([unit_of(values) for values in pool_values])
+        seen = np.array(units)
+        fresh = np.abs(pool[:, None, :] - seen[None, :, :]).sum(axis=2).min(axis=1) > 0
+        if not fresh.any():
+            converged = True
+            break
+        pool_values = [values for values, f in zip(pool_values, fresh) if f]
+        mean, stdev = gp.predict(pool[fresh])
+        # Safe means clearing the margin's own sampling error, not just zero
+        required = Z_95 * float(np.median([e.noise for e in evaluations]))
+        p_safe = normal_cdf((mean - required) / stdev)
+        if not safe:
+            evaluate(pool_values[int(np.argmax(p_safe))])
+            continue
+        best = max(e.objective for e in safe)
+        objectives = np.array([objective(values) for values in pool_values])
+        improvement = np.maximum(objectives - best, 0) * p_safe
+        if improvement.max() <= tolerance * max(abs(best), 1.0):
+            converged = True
+            break
+        evaluate(pool_values[int(np.argmax(improvement))])
+
+    safe = [e for e in evaluations if e.safe]
+    if not safe:
+        return SurrogateResult(None, None, evaluations, converged)
+    best_evaluation = max(safe, key=lambda e: e.objective)
+    return SurrogateResult(
+        best_evaluation,
+        apply_values(retirementSettings, variables, best_evaluation.values),
+        evaluations,
+        converged,
+    )
@@ -0,0 +1,111 @@
+import math
+import unittest
+
+import numpy as np
+
+from anytime import *
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+class AnytimeSimulateTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.rs.expenditure = 50000
+
+    def test_complete_run_matches_simulate_values(self):
+        progress = []
+        estimate = anytime_simulate(self.rs, 0.05, Budget(), 5000, progress.append,
+                                    seed=3)
+        self.assertTrue(estimate.complete)
+        self.assertEqual(estimate.trials, 5000)
+        shocks = block_shocks(self.rs, np.random.SeedSequence(3), 0, 10)
+        expected = simulate_values(self.rs, 5000, shocks)
+        self.assertTrue(np.array_equal(estimate.result.values, expected.values))
+        self.assertEqual(estimate.value, expected.tail_value(0.05))
+
+        self.assertEqual([p.trials for p in progress], [500, 1500, 3500, 5000])
+        self.assertEqual(progress[-1].estimate, estimate.value)
+        self.assertEqual(progress[-1].ci_width, 2 * estimate.error)
+        self.assertLess(progress[-1].ci_width, progress[0].ci_width)
+
+    def test_interval_covers_estimate(self):
+        values = np.random.default_rng(1).standard_normal(10000)
+        value, lower, upper = tail_interval(values, 0.05)
+        self.assertLess(lower, value)
+        self.assertLess(value, upper)
+        self.assertAlmostEqual(value, -1.645, delta=0.05)
+
+    def test_expired_budget_runs_one_block(self):
+        estimate = anytime_simulate(self.rs, 0.05, Budget(seconds=0), seed=3)
+        self.assertFalse(estimate.complete)
+        self.assertEqual(estimate.trials, BLOCK_TRIALS)
+        self.assertGreater(estimate.error, 0)
+
+    def test_cancel(self):
+        budget = Budget()
+        progress = []
+
+        def cancel_after_two(p: Progress):
+            progress.append(p)
+            if len(progress) == 2:
+                budget.cancel.set()
+
+        estimate = anytime_simulate(self.rs, 0.05, budget, on_progress=cancel_after_two,
+                                    seed=3)
+        self.assertFalse(estimate.complete)
+        self.assertEqual(estimate.trials, 3 * BLOCK_TRIALS)
+        self.assertEqual(len(progress), 2)
+
+    def test_deadline(self):
+        estimate = anytime_simulate(self.rs, 0.05, Budget(seconds=0.5), 10_000_000)
+        self.assertFalse(estimate.complete)
+        # Chunks are sized to the throughput so far, so the overrun is small
+        self.assertLess(estimate.elapsed, 1.0)
+        self.assertGreater(estimate.trials, BLOCK_TRIALS)
+
+
+class AnytimeOptimizeTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.rvalue = RValue(RSetting.EXPENDITURE)
+
+    def test_complete_run_matches_optimize_r_var(self):
+        progress = []
+        estimate = anytime_optimize(self.rs, self.rvalue, True, 0.05, Budget(), 1000,
+                                    progress.append, seed=2)
+        self.assertTrue(estimate.complete)
+        self.assertEqual(estimate.trials, 1000)
+        expected = optimize_r_var(self.rs.copy(), self.rvalue, True, 0.05,
+                                  ShockBank.for_settings(self.rs, 1000, 2), n=1000)
+        self.assertEqual(estimate.value, expected)
+        self.assertLessEqual(estimate.error, 100)
+        self.assertEqual(len(progress), len(estimate.state.probes))
+        self.assertEqual(progress[0].high, math.inf)
+        self.assertEqual((progress[-1].low, progress[-1].high),
+                         bracket(estimate.state, True))
+        # Left unchanged
+        self.assertEqual(self.rs, create_waterfall_settings(0.1))
+
+    def test_cancel_while_bracketing(self):
+        budget = Budget()
+        estimate = anytime_optimize(self.rs, self.rvalue, True, 0.05, budget, 1000,
+                                    lambda p: budget.cancel.set(), seed=2)
+        self.assertFalse(estimate.complete)
+        self.assertEqual(len(estimate.state.probes), 1)
+        # 100 was safe, so the answer is at least 100
+        self.assertEqual(estimate.value, 100)
+        self.assertEqual(estimate.error, math.inf)
+
+    def test_budget_sets_trials(self):
+        # Compiled first, so compilation does not count against the budget
+        simulate_values(self.rs, 10)
+        estimate = anytime_optimize(self.rs, self.rvalue, True, 0.05,
+                                    Budget(seconds=1), 10_000_000, seed=2)
+        self.assertGreaterEqual(estimate.trials, 1000)
+        self.assertLess(estimate.trials, 10_000_000)
+        # Stops before a probe that would not fit
+        self.assertLess(estimate.elapsed, 1.1)
+        low, high = bracket(estimate.state, True)
+        self.assertLessEqual(low, estimate.value)
+        self.assertLessEqual(estimate.value, high)
@@ -0,0 +1,56 @@
+from os import path
+import tempfile
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from test.test_engine import create_complex_settings, create_waterfall_settings
+
+
+def create_scenarios() -> List[RetirementSettings]:
+    short = create_waterfall_settings(0.1)
+    short.t = 12
+    two_assets = create_waterfall_settings()
+    two_assets.asset_distribution.asset_allocations.pop(0)
+    two_assets.t = 45
+    return [create_waterfall_settings(), short, create_complex_settings(), two_assets]
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.scenarios = create_scenarios()
+        self.shocks = ShockBank.generate(100, 45, 5, seed=1)
+
+    def test_matches_individual_runs(self):
+        batch = simulate_batch(self.scenarios, 100, self.shocks)
+        tail_values = batch.tail_values(0.05)
+        for i, rs in enumerate(self.scenarios):
+            result = simulate_values(rs, 100, self.shocks)
+            self.assertTrue(np.array_equal(batch.result(i).values, result.values))
+            self.assertTrue(np.array_equal(batch.result(i).ruin_years,
+                                           result.ruin_years))
+            self.assertEqual(tail_values[i], result.tail_value(0.05))
+
+    def test_backends_equal(self):
+        compiled = simulate_batch(self.scenarios, 100, self.shocks, Backend.COMPILED)
+        python = simulate_batch(self.scenarios, 100, self.shocks, Backend.PYTHON)
+        self.assertTrue(np.array_equal(compiled.values, python.values))
+        self.assertTrue(np.array_equal(compiled.ruin_years, python.ruin_years))
+
+    def test_padding(self):
+        batch = PaddedBatch([FlatScenario.from_retirement_settings(rs)
+                             for rs in self.scenarios])
+        self.assertEqual(batch.width, 5)
+        self.assertEqual(batch.max_t, 45)
+        self.assertEqual(list(batch.asset_mask[3]), [True, True, False, False, False])
+        result = simulate_batch(self.scenarios, 100, self.shocks)
+        self.assertTrue((result.values[3, :, 2:] == 0).all())
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            for i, rs in enumerate(self.scenarios):
+                save_retirement_settings(rs, path.join(dirpath, f"{i}.yaml"))
+            from_dir = simulate_batch(dirpath, 100, self.shocks)
+        self.assertTrue(np.array_equal(
+            from_dir.values, simulate_batch(self.scenarios, 100, self.shocks).values))
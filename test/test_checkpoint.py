@@ -0,0 +1,95 @@
+from os import path
+import tempfile
+import unittest
+
+from checkpoint import *
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+class Killed(Exception):
+    pass
+
+
+class KilledAfter(Checkpoint):
+    """Dies after persisting a number of probes, like a process killed mid-batch"""
+
+    def __init__(self, filepath: str, probes: int):
+        super().__init__(filepath)
+        self.remaining = probes
+
+    def record_probe(self, key: str, state: SearchState) -> None:
+        super().record_probe(key, state)
+        self.remaining -= 1
+        if self.remaining == 0:
+            raise Killed()
+
+
+def create_jobs() -> List[Job]:
+    rs = create_waterfall_settings()
+    poorer = rs.copy()
+    poorer.asset_distribution.asset_allocations[2].asset.value = 300000
+    return [("rich", rs, RValue(RSetting.EXPENDITURE), True, 0.05),
+            ("poor", poorer, RValue(RSetting.EXPENDITURE), True, 0.05)]
+
+
+def run_jobs(checkpoint: Checkpoint) -> Dict[str, float]:
+    return {key: checkpointed_optimize_r_var(checkpoint, key, rs.copy(), rvar,
+                                             maximize, pmin, n=200,
+                                             seed=1)
+            for key, rs, rvar, maximize, pmin in create_jobs()}
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filepath = path.join(self.dir.name, "batch.jsonl")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def uninterrupted(self) -> Dict[str, float]:
+        with Checkpoint(path.join(self.dir.name, "reference.jsonl")) as checkpoint:
+            return run_jobs(checkpoint)
+
+    def test_resume_matches_uninterrupted(self):
+        reference = self.uninterrupted()
+        # Die mid-way through the second search
+        with KilledAfter(self.filepath, 20) as checkpoint:
+            with self.assertRaises(Killed):
+                run_jobs(checkpoint)
+        with Checkpoint(self.filepath) as checkpoint:
+            self.assertEqual(list(checkpoint.results), ["rich"])
+            resumed_probes = len(checkpoint.searches["poor"].probes)
+            self.assertGreater(resumed_probes, 0)
+            self.assertEqual(run_jobs(checkpoint), reference)
+
+    def test_resume_after_torn_record(self):
+        reference = self.uninterrupted()
+        with KilledAfter(self.filepath, 3) as checkpoint:
+            with self.assertRaises(Killed):
+                run_jobs(checkpoint)
+        with open(self.filepath, "a") as stream:
+            stream.write('{"type": "probe", "key": "ri')
+        with Checkpoint(self.filepath) as checkpoint:
+            self.assertEqual(len(checkpoint.searches["rich"].probes), 3)
+            self.assertEqual(run_jobs(checkpoint), reference)
+        # The file is still readable after appending past the torn record
+        with Checkpoint(self.filepath) as checkpoint:
+            self.assertEqual(set(checkpoint.results), {"rich", "poor"})
+
+    def test_optimize_batch_skips_completed(self):
+        jobs = create_jobs()[:1]
+        first = optimize_batch(jobs, self.filepath, n=200, seed=1)
+        with open(self.filepath) as stream:
+            records = len(stream.readlines())
+        self.assertEqual(optimize_batch(jobs, self.filepath, n=200, seed=1), first)
+        with open(self.filepath) as stream:
+            self.assertEqual(len(stream.readlines()), records)
+
+    def test_search_state_structured(self):
+        state = SearchState(100, 200, False, [(100, -1.5), (200, 3.0)],
+                            {"bit_generator": "PCG64"})
+        restored = SearchState.from_structured(state.to_structured())
+        self.assertEqual(restored.to_structured(), state.to_structured())
+        self.assertEqual(restored.probes, state.probes)
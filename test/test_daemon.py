@@ -0,0 +1,172 @@
+import asyncio
+import json
+from os import path
+import tempfile
+import threading
+import unittest
+
+from daemon import *
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+async def send(address: str, *requests: dict) -> List[dict]:
+    reader, writer = await asyncio.open_unix_connection(address)
+    for request in requests:
+        writer.write(json.dumps(request).encode() + b"\n")
+    writer.write_eof()
+    responses = [json.loads(line) async for line in reader]
+    writer.close()
+    return responses
+
+
+def simulate_request(rs: RetirementSettings, **params) -> dict:
+    request = {"analysis": "simulate", "scenario": rs.to_structured(), "n": 500}
+    request.update(params)
+    return request
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.address = path.join(self.tempdir.name, "retcalc.sock")
+        self.rs = create_waterfall_settings(0.1)
+        self.rs.expenditure = 50000
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_daemon(self, client, processes=0):
+        """Run client(daemon) against a started in-process daemon"""
+        async def run():
+            daemon = Daemon(self.address, processes)
+            await daemon.start()
+            try:
+                return await client(daemon)
+            finally:
+                await daemon.close()
+        return asyncio.run(run())
+
+    def test_simulate(self):
+        async def client(daemon):
+            return await send(self.address, simulate_request(self.rs, id=7, seed=3))
+        [response] = self.run_daemon(client)
+        self.assertEqual(response["id"], 7)
+        result = simulate_values(self.rs, 500, ShockBank.for_settings(self.rs, 500, 3))
+        self.assertEqual(response["result"]["ruin_probability"],
+                         result.ruin_probability())
+        self.assertEqual(response["result"]["tail_value"], result.tail_value(0.05))
+        self.assertFalse(path.exists(self.address))
+
+    def test_optimize(self):
+        async def client(daemon):
+            return await send(self.address, {
+                "analysis": "optimize", "scenario": self.rs.to_structured(),
+                "n": 500, "rsetting": "EXPENDITURE", "maximize": True})
+        [response] = self.run_daemon(client)
+        expected = optimize_r_var(self.rs, RValue(RSetting.EXPENDITURE), True, 0.05,
+                                  ShockBank.for_settings(self.rs, 500, 0), n=500)
+        self.assertEqual(response["result"]["value"], expected)
+
+    def test_coalesces_identical_requests(self):
+        other = self.rs.copy()
+        other.expenditure = 45000
+
+        async def client(daemon):
+            # Defaults spelled out or left implicit are the same request
+            responses = await asyncio.gather(
+                *(send(self.address, simulate_request(self.rs, id=i))
+                  for i in range(5)),
+                send(self.address, simulate_request(self.rs.copy(), seed=0)),
+                send(self.address, simulate_request(other)))
+            return responses, daemon.computed, daemon.coalesced
+        responses, computed, coalesced = self.run_daemon(client)
+        self.assertEqual((computed, coalesced), (2, 5))
+        results = [response["result"] for [response] in responses]
+        self.assertTrue(all(result == results[0] for result in results[:6]))
+        self.assertNotEqual(results[6], results[0])
+
+    def test_coalesces_identical_optimizations(self):
+        request = {"analysis": "optimize", "scenario": self.rs.to_structured(),
+                   "n": 300, "rsetting": "EXPENDITURE"}
+
+        async def client(daemon):
+            responses = await asyncio.gather(send(self.address, request),
+                                             send(self.address, request))
+            return responses, daemon.computed, daemon.coalesced, daemon._in_flight
+        responses, computed, coalesced, in_flight = self.run_daemon(client)
+        self.assertEqual((computed, coalesced), (1, 1))
+        self.assertEqual(in_flight, {})
+        [[first], [second]] = responses
+        self.assertEqual(first["result"], second["result"])
+
+    def test_reduction_frac_not_coalesced(self):
+        other = self.rs.copy()
+        other.expenditure_reduction_frac = 0.5
+
+        async def client(daemon):
+            responses = await asyncio.gather(
+                send(self.address, simulate_request(self.rs)),
+                send(self.address, simulate_request(other)))
+            return responses, daemon.computed
+        responses, computed = self.run_daemon(client)
+        self.assertEqual(computed, 2)
+        [[first], [second]] = responses
+        self.assertNotEqual(first["result"], second["result"])
+
+    def test_fraction_optimize_rejected(self):
+        async def client(daemon):
+            return await asyncio.wait_for(send(self.address, {
+                "analysis": "optimize", "scenario": self.rs.to_structured(),
+                "n": 100, "rsetting": "EXPENDITURE_REDUCTION_FRAC"}), 60)
+        [response] = self.run_daemon(client)
+        self.assertIn("cannot optimize", response["error"])
+
+    def test_pipelined_requests_and_errors(self):
+        async def client(daemon):
+            responses = await send(
+                self.address,
+                {"id": 1, "analysis": "tornado", "scenario": {}},
+                simulate_request(self.rs, id=2, trials=5),
+                {"id": 3, "analysis": "simulate", "scenario": {}},
+                {"id": 4, "analysis": "optimize", "scenario": self.rs.to_structured(),
+                 "rsetting": "T", "n": 100},
+                simulate_request(self.rs, id=5))
+            # Still serving after the errors
+            responses += await send(self.address, simulate_request(self.rs, id=6))
+            return responses
+        responses = {r["id"]: r for r in self.run_daemon(client)}
+        self.assertEqual(sorted(responses), [1, 2, 3, 4, 5, 6])
+        for request_id in (1, 2, 3, 4):
+            self.assertIn("error", responses[request_id])
+        self.assertEqual(responses[5]["result"], responses[6]["result"])
+
+    def test_worker_process_and_client(self):
+        started = threading.Event()
+        stop = threading.Event()
+        daemon = Daemon(("localhost", 0), processes=1)
+
+        def serve():
+            async def run():
+                await daemon.start()
+                started.set()
+                while not stop.is_set():
+                    await asyncio.sleep(0.01)
+                await daemon.close()
+            asyncio.run(run())
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        self.assertTrue(started.wait(120))
+        try:
+            result = request(daemon.address, "simulate", self.rs, n=500, seed=3)
+            self.assertEqual(result, request(daemon.address, "simulate", self.rs,
+                                             n=500, seed=3))
+            with self.assertRaises(RuntimeError):
+                request(daemon.address, "simulate", self.rs, n=500, spam=1)
+        finally:
+            stop.set()
+            thread.join(60)
+        expected = simulate_values(self.rs, 500,
+                                   ShockBank.for_settings(self.rs, 500, 3))
+        self.assertEqual(result["tail_value"], expected.tail_value(0.05))
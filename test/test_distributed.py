@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+from multiprocessing.connection import Client
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from distributed import *
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+AUTHKEY = b"test-only key"
+
+
+def create_sweep() -> List[RetirementSettings]:
+    return sweep(create_waterfall_settings(), RValue(RSetting.EXPENDITURE),
+                 [30000, 40000, 50000])
+
+
+def expected_values(coordinator: Coordinator, scenario: int,
+                    field: str = "values") -> np.ndarray:
+    return np.concatenate([
+        getattr(simulate_chunk(coordinator.scenarios[c.scenario], c.start, c.stop,
+                               c.seed, coordinator.shape), field)
+        for c in coordinator.chunks if c.scenario == scenario])
+
+
+def take_chunk_and(address, action) -> threading.Thread:
+    """A misbehaving node: accepts one chunk, then runs action(conn)"""
+    def node():
+        conn = Client(address, authkey=AUTHKEY)
+        conn.send(("ready",))
+        conn.recv()
+        action(conn)
+    thread = threading.Thread(target=node, daemon=True)
+    thread.start()
+    return thread
+
+
+class DistributedTest(unittest.TestCase):
+    def test_local_worker_processes(self):
+        coordinator = Coordinator(create_sweep(), 300, AUTHKEY, chunk_size=100, seed=1)
+        ctx = multiprocessing.get_context("spawn")
+        workers = [ctx.Process(target=run_worker, args=(coordinator.address, AUTHKEY))
+                   for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        results = coordinator.run(timeout=120)
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+
+        self.assertEqual(len(results), 3)
+        for scenario, result in enumerate(results):
+            self.assertEqual(result.n, 300)
+            self.assertTrue(np.array_equal(result.values,
+                                           expected_values(coordinator, scenario)))
+            self.assertTrue(np.array_equal(
+                result.price_index,
+                expected_values(coordinator, scenario, "price_index")))
+            result.in_terms(Terms.REAL)
+        tail_values = [result.tail_value(0.1) for result in results]
+        self.assertEqual(tail_values, sorted(tail_values, reverse=True))
+
+    def test_matches_simulate_batch(self):
+        """Every scenario runs on the same shocks, so the merged results equal
+        simulate_batch over one bank holding each chunk's shocks in trial order"""
+        scenarios = create_sweep()
+        scenarios[2].t = 40
+        for chunk_size in (200, 70):
+            coordinator = Coordinator(scenarios, 200, AUTHKEY, chunk_size=chunk_size,
+                                      seed=2)
+            threading.Thread(target=run_worker,
+                             args=(coordinator.address, AUTHKEY),
+                             daemon=True).start()
+            results = coordinator.run(timeout=60)
+            self.assertEqual(coordinator.shape, (40, 3))
+            banks = [ShockBank.generate(c.stop - c.start, *coordinator.shape, c.seed)
+                     for c in coordinator.chunks if c.scenario == 0]
+            shocks = ShockBank(*(
+                np.concatenate([getattr(bank, field) for bank in banks])
+                for field in ("inflation", "returns", "longevity", "regimes")))
+            batch = simulate_batch(scenarios, 200, shocks)
+            for scenario, result in enumerate(results):
+                expected = batch.result(scenario)
+                self.assertTrue(np.array_equal(result.values, expected.values))
+                self.assertTrue(np.array_equal(result.ruin_years,
+                                               expected.ruin_years))
+
+    def test_retry_dropped_worker(self):
+        coordinator = Coordinator(create_sweep()[:1], 200, AUTHKEY, chunk_size=100,
+                                  steal=False)
+        take_chunk_and(coordinator.address, lambda conn: conn.close()).join()
+        threading.Thread(target=run_worker, args=(coordinator.address, AUTHKEY),
+                         daemon=True).start()
+        results = coordinator.run(timeout=60)
+        self.assertEqual(coordinator.retried, 1)
+        self.assertTrue(np.array_equal(results[0].values,
+                                       expected_values(coordinator, 0)))
+
+    def test_steal_from_slow_worker(self):
+        coordinator = Coordinator(create_sweep()[:1], 200, AUTHKEY, chunk_size=100)
+        release = threading.Event()
+        take_chunk_and(coordinator.address, lambda conn: release.wait())
+        while not any(c.running for c in coordinator.chunks):
+            time.sleep(0.01)
+        threading.Thread(target=run_worker, args=(coordinator.address, AUTHKEY),
+                         daemon=True).start()
+        # Only finishes because the fast worker duplicates the slow node's chunk
+        results = coordinator.run(timeout=60)
+        release.set()
+        self.assertEqual(coordinator.stolen, 1)
+        self.assertTrue(np.array_equal(results[0].values,
+                                       expected_values(coordinator, 0)))
+
+    def test_gives_up_after_max_attempts(self):
+        coordinator = Coordinator(create_sweep()[:1], 100, AUTHKEY, chunk_size=100,
+                                  max_attempts=2)
+        for _ in range(2):
+            take_chunk_and(coordinator.address, lambda conn: conn.close()).join()
+        with self.assertRaises(RuntimeError):
+            coordinator.run(timeout=60)
+
+    def test_needs_authkey(self):
+        with self.assertRaises(ValueError):
+            Coordinator(create_sweep(), 100, b"")
+        os.environ.pop("RETCALC_AUTHKEY", None)
+        with self.assertRaises(ValueError):
+            authkey_from_env()
+        os.environ["RETCALC_AUTHKEY"] = "secret"
+        try:
+            self.assertEqual(authkey_from_env(), b"secret")
+        finally:
+            del os.environ["RETCALC_AUTHKEY"]
@@ -0,0 +1,458 @@
+from typing import List
+import unittest
+
+import numpy as np
+
+import engine
+from engine import allocate_proportional, compile_cash_flows
+from mortality import Lifespan, Sex
+from retcalc import *
+from test.test_retcalc import COMPLEX_ASSET_ALLOCATIONS, SIMPLE_ASSET_ALLOCATIONS
+from withdrawal import WithdrawalPolicy
+
+
+def create_waterfall_settings(
+    expenditure_reduction_frac: Optional[float] = None,
+) -> RetirementSettings:
+    return RetirementSettings(
+        40000,
+        (0.03, 0.01),
+        30,
+        0,
+        AssetDistribution(
+            [
+                AssetAllocation(Asset("Cash", 20000, 0.01, 0.001), 0, 20000, 0),
+                AssetAllocation(Asset("Bonds", 200000, 0.04, 0.05), 1, 0, 0.3),
+                AssetAllocation(Asset("Stocks", 600000, 0.08, 0.15), 2, 0, 0.7),
+            ]
+        ),
+        expenditure_reduction_frac,
+    )
+
+
+def create_complex_settings() -> RetirementSettings:
+    return RetirementSettings(
+        1.5,
+        (0.02, 0.02),
+        20,
+        0,
+        AssetDistribution(
+            [
+                AssetAllocation(Asset(aa.asset.name, aa.asset.value, 0.05, 0.1),
+                                aa.priority, aa.minimum_value,
+                                aa.desired_fraction_of_total_assets)
+                for aa in COMPLEX_ASSET_ALLOCATIONS
+            ]
+        ),
+        0.2,
+    )
+
+
+def assert_backends_equal(case: unittest.TestCase, rs: RetirementSettings,
+                          n: int = 200) -> None:
+    shocks = ShockBank.for_settings(rs, n, seed=7)
+    compiled = simulate_values(rs, n, shocks, Backend.COMPILED)
+    python = simulate_values(rs, n, shocks, Backend.PYTHON)
+    # Bit-for-bit, not almost equal
+    case.assertTrue(np.array_equal(compiled.values, python.values))
+    case.assertTrue(np.array_equal(compiled.ruin_years, python.ruin_years))
+
+
+def rebalance_flat(asset_allocations: List[AssetAllocation]) -> np.ndarray:
+    flat = FlatScenario.from_retirement_settings(
+        RetirementSettings(0, (0, 0), 0, 0,
+                           AssetDistribution([aa.copy() for aa in asset_allocations]),
+                           None))
+    values = flat.values.copy()
+    engine._rebalance(values, flat.priorities, flat.minimum_values, flat.fractions)
+    return values
+
+
+class EngineTest(unittest.TestCase):
+    def test_rebalance_matches_reference(self):
+        for allocs in [SIMPLE_ASSET_ALLOCATIONS, COMPLEX_ASSET_ALLOCATIONS]:
+            reference = [aa.copy() for aa in allocs]
+            rebalance_assets(reference)
+            self.assertEqual(list(rebalance_flat(allocs)),
+                             [aa.asset.value for aa in reference])
+
+    def test_waterfall_backends_equal(self):
+        assert_backends_equal(self, create_waterfall_settings())
+
+    def test_reduction_backends_equal(self):
+        assert_backends_equal(self, create_waterfall_settings(0.1))
+
+    def test_complex_backends_equal(self):
+        assert_backends_equal(self, create_complex_settings())
+
+    def test_contributions_backends_equal(self):
+        rs = create_waterfall_settings(0.1)
+        rs.expenditure = -10000
+        assert_backends_equal(self, rs)
+
+    def test_simulate_values_matches_simulate(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 50, seed=3)
+        runs = simulate(rs, 50, shocks)
+        result = simulate_values(rs, 50, shocks)
+        self.assertEqual(list(result.current_values()),
+                         [run.current_value() for run in runs])
+        self.assertEqual(result.tail_value(0.1),
+                         worst_case(runs, 0.1).current_value())
+
+    def test_ruin_years(self):
+        rs = create_waterfall_settings()
+        rs.expenditure = 200000
+        result = simulate_values(rs, 20, ShockBank.for_settings(rs, 20, seed=1))
+        self.assertTrue((result.ruin_years >= 0).all())
+        self.assertEqual(result.ruin_probability(), 1.0)
+
+    def test_optimize_backends_equal(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 200, seed=11)
+        compiled = optimize_r_var(rs.copy(), RValue(RSetting.EXPENDITURE), True,
+                                  0.05, shocks, Backend.COMPILED, 200)
+        python = optimize_r_var(rs.copy(), RValue(RSetting.EXPENDITURE), True,
+                                0.05, shocks, Backend.PYTHON, 200)
+        self.assertGreater(compiled, 0)
+        self.assertEqual(compiled, python)
+
+    @unittest.skipIf(engine.HAVE_NUMBA, "numba is installed")
+    def test_auto_falls_back_to_python(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 10, seed=5)
+        self.assertTrue(np.array_equal(
+            simulate_values(rs, 10, shocks).values,
+            simulate_values(rs, 10, shocks, Backend.PYTHON).values))
+
+
+def with_frequency(rs: RetirementSettings, step_frequency: Frequency,
+                   rebalance_frequency: Frequency) -> RetirementSettings:
+    rs = rs.copy()
+    rs.step_frequency = step_frequency
+    rs.rebalance_frequency = rebalance_frequency
+    return rs
+
+
+class StepFrequencyTest(unittest.TestCase):
+    def test_backends_equal(self):
+        for step_frequency, rebalance_frequency in [
+            (Frequency.MONTHLY, Frequency.ANNUAL),
+            (Frequency.MONTHLY, Frequency.QUARTERLY),
+            (Frequency.QUARTERLY, Frequency.QUARTERLY),
+        ]:
+            assert_backends_equal(self, with_frequency(
+                create_waterfall_settings(0.1), step_frequency, rebalance_frequency))
+        rs = with_frequency(create_complex_settings(), Frequency.MONTHLY,
+                            Frequency.ANNUAL)
+        rs.expenditure = 5
+        assert_backends_equal(self, rs)
+
+    def test_annual_unchanged(self):
+        rs = create_waterfall_settings()
+        flat = FlatScenario.from_retirement_settings(rs)
+        self.assertEqual(list(flat.mean_returns), [0.01, 0.04, 0.08])
+        self.assertEqual(flat.inflation, (0.03, 0.01))
+
+    def test_step_moments_compound_to_annual(self):
+        rng = np.random.default_rng(1)
+        for mean, stdev in [(0.08, 0.15), (0.03, 0.01)]:
+            step_mean, step_stdev = engine.step_moments(mean, stdev, 12)
+            steps = 1 + step_mean + step_stdev * rng.standard_normal((200_000, 12))
+            annual = steps.prod(axis=1) - 1
+            self.assertAlmostEqual(annual.mean(), mean, delta=0.002)
+            self.assertAlmostEqual(annual.std(), stdev, delta=0.002)
+
+    def test_ruin_years_are_years(self):
+        rs = with_frequency(create_waterfall_settings(), Frequency.MONTHLY,
+                            Frequency.ANNUAL)
+        rs.expenditure = 200000
+        result = simulate_values(rs, 20, ShockBank.for_settings(rs, 20, seed=1))
+        self.assertTrue((result.ruin_years >= 0).all())
+        self.assertTrue((result.ruin_years < rs.t).all())
+
+    def test_reduction_cuts_next_step(self):
+        """A below mean step cuts the next step, so a bad month cuts one month and a
+        year of bad months cuts as much as one bad year"""
+        # Returns too small to matter, but below or above the mean by their shocks
+        rs = RetirementSettings(
+            12000, (0, 0), 2, 0,
+            AssetDistribution([AssetAllocation(Asset("Cash", 1000000, 0, 1e-6),
+                                               0, 0, 1)]),
+            0.5)
+        monthly = with_frequency(rs, Frequency.MONTHLY, Frequency.ANNUAL)
+        for settings, bad_steps, spent in [(rs, 1, 18000), (monthly, 1, 23500),
+                                           (monthly, 12, 18000)]:
+            returns = np.ones((1, settings.steps, 1))
+            returns[0, :bad_steps] = -1
+            shocks = ShockBank(np.zeros((1, settings.steps)), returns)
+            for backend in (Backend.PYTHON, Backend.AUTO):
+                value = simulate_values(settings, 1, shocks, backend).current_values()
+                self.assertAlmostEqual(value[0], 1000000 - spent, delta=10)
+
+    def test_structured(self):
+        rs = with_frequency(create_waterfall_settings(), Frequency.MONTHLY,
+                            Frequency.QUARTERLY)
+        self.assertEqual(RetirementSettings.from_structured(rs.to_structured()), rs)
+        legacy = rs.to_structured()
+        del legacy["step_frequency"], legacy["rebalance_frequency"]
+        self.assertEqual(RetirementSettings.from_structured(legacy).step_frequency,
+                         Frequency.ANNUAL)
+
+
+class RebalancePolicyTest(unittest.TestCase):
+    def test_backends_equal(self):
+        for policy in [RebalancePolicy.BAND, RebalancePolicy.NEVER]:
+            for rs in [create_waterfall_settings(0.1), create_complex_settings()]:
+                rs.rebalance_policy = policy
+                assert_backends_equal(self, rs)
+            rs = with_frequency(create_waterfall_settings(), Frequency.MONTHLY,
+                                Frequency.QUARTERLY)
+            rs.rebalance_policy = policy
+            assert_backends_equal(self, rs)
+
+    def test_in_band(self):
+        allocs = [aa.copy() for aa in
+                  create_waterfall_settings().asset_distribution.asset_allocations]
+        rebalance_assets(allocs)
+        self.assertTrue(in_band(allocs, 0.05))
+        allocs[2].asset.value *= 1.5
+        self.assertFalse(in_band(allocs, 0.05))
+        self.assertTrue(in_band(allocs, 0.2))
+        allocs[0].asset.value = 10000
+        self.assertFalse(in_band(allocs, 0.2))
+
+    def test_never_keeps_drift(self):
+        rs = create_waterfall_settings()
+        rs.expenditure = 0
+        rs.rebalance_policy = RebalancePolicy.NEVER
+        result = simulate_values(rs, 50, ShockBank.for_settings(rs, 50, seed=1))
+        shares = result.values[:, 2] / result.current_values()
+        self.assertGreater(np.abs(shares - 0.7).max(), 0.05)
+
+    def test_structured(self):
+        rs = create_waterfall_settings()
+        rs.rebalance_policy = RebalancePolicy.BAND
+        rs.rebalance_band = 0.1
+        self.assertEqual(RetirementSettings.from_structured(rs.to_structured()), rs)
+
+
+def create_cash_flows() -> List[CashFlow]:
+    return [CashFlow("Pension", 15000, 5),
+            CashFlow("Mortgage", -12000, 0, 10, False),
+            CashFlow("College", -30000, 3, 5)]
+
+
+class CashFlowTest(unittest.TestCase):
+    def test_compile(self):
+        indexed, nominal = compile_cash_flows(create_cash_flows())
+        self.assertEqual(list(indexed), [0, 0, 0, -30000, -30000, 15000, 15000,
+                                         15000, 15000, 15000, 15000])
+        self.assertEqual(list(nominal), [-12000] * 10 + [0])
+        indexed, nominal = compile_cash_flows([])
+        self.assertEqual(list(indexed), [0])
+
+    def test_backends_equal(self):
+        for rs in [create_waterfall_settings(0.1), create_complex_settings(),
+                   with_frequency(create_waterfall_settings(), Frequency.MONTHLY,
+                                  Frequency.ANNUAL)]:
+            rs.cash_flows = create_cash_flows()
+            assert_backends_equal(self, rs)
+
+    def test_indexed_pension_offsets_expenditure(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 200, seed=2)
+        pension = rs.copy()
+        pension.cash_flows = [CashFlow("Pension", 15000)]
+        rs.expenditure -= 15000
+        self.assertTrue(np.allclose(simulate_values(pension, 200, shocks).values,
+                                    simulate_values(rs, 200, shocks).values))
+
+    def test_one_off(self):
+        rs = create_waterfall_settings()
+        rs.inflation = (0, 0)
+        rs.t = 1
+        for aa in rs.asset_distribution.asset_allocations:
+            aa.asset.return_stdev = 0
+        shocks = ShockBank.for_settings(rs, 1)
+        base = simulate_values(rs, 1, shocks).current_values()[0]
+        rs.cash_flows = [CashFlow("Car", -20000, 0, 1, False)]
+        with_car = simulate_values(rs, 1, shocks).current_values()[0]
+        # Spent from stocks, the lowest priority asset
+        self.assertAlmostEqual(base - with_car, 20000 * 1.08)
+
+    def test_batch_and_policy(self):
+        rs = create_waterfall_settings()
+        rs.cash_flows = create_cash_flows()
+        shocks = ShockBank.for_settings(rs, 200, seed=2)
+        expected = simulate_values(rs, 200, shocks)
+        batch = simulate_batch([create_waterfall_settings(), rs], 200, shocks)
+        self.assertTrue(np.array_equal(batch.result(1).values, expected.values))
+        rs.withdrawal_policy = WithdrawalPolicy()
+        self.assertTrue(np.array_equal(simulate_values(rs, 200, shocks).values,
+                                       expected.values))
+
+    def test_structured(self):
+        rs = create_waterfall_settings()
+        rs.cash_flows = create_cash_flows()
+        self.assertEqual(RetirementSettings.from_structured(rs.to_structured()), rs)
+
+
+def real_terms_scenarios() -> List[RetirementSettings]:
+    ruinous = create_waterfall_settings(0.1)
+    ruinous.expenditure = 60000
+    band = with_frequency(create_waterfall_settings(0.1), Frequency.MONTHLY,
+                          Frequency.QUARTERLY)
+    band.rebalance_policy = RebalancePolicy.BAND
+    flows = create_waterfall_settings()
+    flows.cash_flows = create_cash_flows()
+    lifespan = create_waterfall_settings(0.1)
+    lifespan.lifespan = Lifespan([65], [Sex.FEMALE])
+    return [ruinous, band, flows, lifespan, create_complex_settings()]
+
+
+class RealTermsTest(unittest.TestCase):
+    def assertEquivalent(self, nominal: SimulationResult, real: SimulationResult):
+        self.assertTrue(np.array_equal(nominal.ruin_years, real.ruin_years))
+        self.assertTrue(np.allclose(nominal.values, real.values, rtol=1e-9,
+                                    atol=1e-6))
+        self.assertTrue(np.allclose(nominal.price_index, real.price_index,
+                                    rtol=1e-12))
+
+    def test_matches_nominal(self):
+        for rs in real_terms_scenarios():
+            shocks = ShockBank.for_settings(rs, 300, seed=4)
+            nominal = simulate_values(rs, 300, shocks)
+            real = simulate_values(rs, 300, shocks, accounting=Terms.REAL)
+            self.assertEquivalent(nominal, real)
+            if rs.expenditure == 60000:
+                self.assertTrue((nominal.ruin_years >= 0).any())
+            python = simulate_values(rs, 300, shocks, Backend.PYTHON,
+                                     accounting=Terms.REAL)
+            self.assertTrue(np.array_equal(python.values, real.values))
+
+    def test_continued_paths(self):
+        rs = create_waterfall_settings(0.1)
+        shocks = ShockBank.for_settings(rs, 300, seed=5)
+        rs.t = 10
+        states = []
+        for accounting in (Terms.NOMINAL, Terms.REAL, Terms.NOMINAL):
+            state = PathState.initial(FlatScenario.from_retirement_settings(rs), 300)
+            for _ in range(3):
+                advance_paths(rs, state, shocks, accounting=accounting)
+                # Mixing accountings between phases is fine: state stays nominal
+                accounting = Terms.REAL
+            states.append(state)
+        for state in states[1:]:
+            self.assertEquivalent(states[0].result(), state.result())
+            self.assertTrue(np.allclose(states[0].minimum_values, state.minimum_values,
+                                        rtol=1e-12))
+            self.assertTrue(np.allclose(states[0].expenditure, state.expenditure,
+                                        rtol=1e-12))
+
+    def test_reported_in_real_terms(self):
+        rs = create_waterfall_settings()
+        rs.expenditure = 20000
+        shocks = ShockBank.for_settings(rs, 100, seed=6)
+        result = simulate_values(rs, 100, shocks)
+        self.assertIs(result.in_terms(Terms.NOMINAL), result)
+        inflation = 1 + (rs.inflation[0] + shocks.inflation[:, :rs.t] * rs.inflation[1])
+        self.assertTrue(np.allclose(result.price_index, inflation.prod(axis=1)))
+        real = result.in_terms(Terms.REAL)
+        self.assertTrue(np.allclose(real.current_values() * result.price_index,
+                                    result.current_values()))
+        self.assertLess(0, real.tail_value(0.05))
+        self.assertLess(real.tail_value(0.05), result.tail_value(0.05))
+        with self.assertRaises(ValueError):
+            SimulationResult(result.values, result.ruin_years).in_terms(Terms.REAL)
+
+    def test_policy_unsupported(self):
+        rs = create_waterfall_settings()
+        rs.withdrawal_policy = WithdrawalPolicy()
+        with self.assertRaises(ValueError):
+            simulate_values(rs, 10, accounting=Terms.REAL)
+
+
+def proportional(rs: RetirementSettings) -> RetirementSettings:
+    rs = rs.copy()
+    rs.asset_distribution.allocation = AllocationMode.PROPORTIONAL
+    return rs
+
+
+class ProportionalAllocationTest(unittest.TestCase):
+    def test_closed_form(self):
+        values = np.array([[100.0, 0, 0], [10, 10, 0], [60, 0, 0], [0, 0, 0]])
+        minimum_values = np.array([[20.0, 0, 0], [20, 20, 0], [20, 40, 0],
+                                   [20, 0, 0]])
+        fractions = np.array([0, 0.2, 0.6])
+        allocated = allocate_proportional(values, minimum_values, fractions)
+        # Floors, then the rest by normalized fractions
+        self.assertTrue(np.allclose(allocated[0], [20, 20, 60]))
+        # Floors pro rata when they cannot all be met
+        self.assertTrue(np.allclose(allocated[1], [10, 10, 0]))
+        self.assertTrue(np.allclose(allocated[2], [20, 40, 0]))
+        self.assertEqual(list(allocated[3]), [0, 0, 0])
+        equal = allocate_proportional(values[:1], minimum_values[:1], np.zeros(3))
+        # Equally when no fractions are set
+        self.assertTrue(np.allclose(equal, [[20 + 80 / 3, 80 / 3, 80 / 3]]))
+        for trial in range(4):
+            row = values[trial].copy()
+            engine._allocate_proportional(row, minimum_values[trial], fractions)
+            self.assertEqual(list(row), list(allocated[trial]))
+
+    def test_rebalance_assets(self):
+        allocs = [aa.copy() for aa in
+                  create_waterfall_settings().asset_distribution.asset_allocations]
+        rebalance_assets(allocs, AllocationMode.PROPORTIONAL)
+        # 20000 of cash, then 800000 split 30 / 70
+        self.assertEqual([aa.asset.value for aa in allocs],
+                         [20000, 0.3 * 800000, 0.7 * 800000])
+        self.assertTrue(in_band(allocs, 0.01, AllocationMode.PROPORTIONAL))
+        allocs[2].asset.value *= 1.5
+        self.assertFalse(in_band(allocs, 0.05, AllocationMode.PROPORTIONAL))
+        self.assertTrue(in_band(allocs, 0.1, AllocationMode.PROPORTIONAL))
+
+    def test_backends_equal(self):
+        for rs in [create_waterfall_settings(0.1), create_complex_settings()]:
+            assert_backends_equal(self, proportional(rs))
+            band = proportional(with_frequency(rs, Frequency.MONTHLY,
+                                               Frequency.QUARTERLY))
+            band.rebalance_policy = RebalancePolicy.BAND
+            assert_backends_equal(self, band)
+        flows = proportional(create_waterfall_settings())
+        flows.cash_flows = create_cash_flows()
+        assert_backends_equal(self, flows)
+
+    def test_differs_from_waterfall(self):
+        rs = create_waterfall_settings()
+        rs.expenditure = 0
+        shocks = ShockBank.for_settings(rs, 200, seed=3)
+        result = simulate_values(proportional(rs), 200, shocks)
+        # Cash keeps its (inflated) floor and the rest stays 30 / 70
+        shares = result.values[:, 2] / (result.values[:, 1] + result.values[:, 2])
+        self.assertTrue(np.allclose(shares, 0.7))
+        self.assertFalse(np.array_equal(result.values,
+                                        simulate_values(rs, 200, shocks).values))
+
+    def test_batch_and_policy(self):
+        rs = proportional(create_waterfall_settings(0.1))
+        shocks = ShockBank.for_settings(rs, 200, seed=2)
+        expected = simulate_values(rs, 200, shocks)
+        batch = simulate_batch([create_waterfall_settings(0.1), rs], 200, shocks)
+        self.assertTrue(np.array_equal(batch.result(1).values, expected.values))
+        self.assertFalse(np.array_equal(batch.result(0).values, expected.values))
+        rs.expenditure_reduction_frac = None
+        expected = simulate_values(rs, 200, shocks)
+        rs.withdrawal_policy = WithdrawalPolicy()
+        self.assertTrue(np.array_equal(simulate_values(rs, 200, shocks).values,
+                                       expected.values))
+
+    def test_structured(self):
+        rs = proportional(create_waterfall_settings())
+        structured = rs.to_structured()
+        self.assertEqual(structured["asset_distribution"]["allocation"], "PROPORTIONAL")
+        self.assertEqual(RetirementSettings.from_structured(structured), rs)
+        self.assertNotEqual(rs, create_waterfall_settings())
+        del structured["asset_distribution"]["allocation"]
+        self.assertEqual(RetirementSettings.from_structured(structured),
+                         create_waterfall_settings())
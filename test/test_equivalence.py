@@ -0,0 +1,139 @@
+from typing import Dict
+import unittest
+
+import numpy as np
+
+import engine
+from equivalence import *
+from retcalc import *
+from test.test_engine import (create_cash_flows, create_complex_settings,
+                              create_waterfall_settings, with_frequency)
+from test.test_retcalc import SIMPLE_ASSET_ALLOCATIONS
+
+
+def create_simple_settings() -> RetirementSettings:
+    return RetirementSettings(
+        0.004,
+        (0.02, 0.01),
+        25,
+        0,
+        AssetDistribution(
+            [
+                AssetAllocation(Asset(aa.asset.name, aa.asset.value, 0.04, 0.08),
+                                aa.priority, aa.minimum_value,
+                                aa.desired_fraction_of_total_assets)
+                for aa in SIMPLE_ASSET_ALLOCATIONS
+            ]
+        ),
+        None,
+    )
+
+
+def create_priorities_settings() -> RetirementSettings:
+    """A four level waterfall spending down cash, then bonds, then two equity funds"""
+    return RetirementSettings(
+        42000,
+        (0.025, 0.01),
+        35,
+        0,
+        AssetDistribution(
+            [
+                AssetAllocation(Asset("Cash", 30000, 0.01, 0.002), 0, 30000, 0),
+                AssetAllocation(Asset("Bonds", 250000, 0.035, 0.06), 1, 100000, 0.3),
+                AssetAllocation(Asset("Index", 500000, 0.07, 0.16), 2, 0, 0.5),
+                AssetAllocation(Asset("Small cap", 150000, 0.09, 0.24), 3, 0, 0.2),
+            ]
+        ),
+        0.15,
+    )
+
+
+def scenario_library() -> Dict[str, RetirementSettings]:
+    ruinous = create_waterfall_settings(0.1)
+    ruinous.expenditure = 60000
+    band = with_frequency(create_waterfall_settings(0.1), Frequency.MONTHLY,
+                          Frequency.QUARTERLY)
+    band.rebalance_policy = RebalancePolicy.BAND
+    flows = create_waterfall_settings(0.1)
+    flows.cash_flows = create_cash_flows()
+    return {
+        "waterfall": create_waterfall_settings(),
+        "reduction": create_waterfall_settings(0.1),
+        "ruinous reduction": ruinous,
+        "simple": create_simple_settings(),
+        "complex": create_complex_settings(),
+        "priorities": create_priorities_settings(),
+        "monthly band": band,
+        "cash flows": flows,
+    }
+
+
+def _ignore_reduction(rs: RetirementSettings, n: int,
+                      shocks: Optional[ShockBank]) -> SimulationResult:
+    rs = rs.copy()
+    rs.expenditure_reduction_frac = None
+    return simulate_values(rs, n, shocks)
+
+
+class StatisticsTest(unittest.TestCase):
+    def test_ks(self):
+        rng = np.random.default_rng(1)
+        a = rng.standard_normal(2000)
+        self.assertEqual(ks_statistic(a, a), 0)
+        self.assertLess(ks_statistic(a, rng.standard_normal(3000)),
+                        ks_critical(2000, 3000))
+        self.assertGreater(ks_statistic(a, rng.standard_normal(3000) + 0.2),
+                           ks_critical(2000, 3000))
+        self.assertEqual(ks_statistic(np.array([0.0, 1]), np.array([2.0, 3])), 1)
+        self.assertAlmostEqual(ks_critical(1000, 1000, 0.05), 1.358 * np.sqrt(0.002))
+
+
+class CompareEnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.scenarios = scenario_library()
+
+    def test_reference_matches_retirement_value(self):
+        rs = self.scenarios["reduction"]
+        shocks = ShockBank.for_settings(rs, 20, 1)
+        result = reference_result(rs, 20, shocks)
+        for trial in (0, 19):
+            self.assertEqual(result.values[trial].sum(),
+                             retirement_value(rs, shocks, trial).current_value())
+
+    def test_shared_engines_exact(self):
+        comparisons = compare_engines(
+            self.scenarios, [ENGINES["compiled"], ENGINES["batch"]], n=500)
+        self.assertEqual(len(comparisons), 2 * len(self.scenarios))
+        for c in comparisons:
+            self.assertTrue(c.exact, (c.scenario, c.engine_name))
+            self.assertEqual(c.ks, 0)
+            self.assertTrue(c.passed)
+            if engine.HAVE_NUMBA:
+                self.assertGreater(c.speedup, 1, (c.scenario, c.engine_name))
+        report = format_report(comparisons)
+        self.assertEqual(len(report.splitlines()), len(comparisons) + 1)
+        self.assertNotIn("FAIL", report)
+
+    def test_sobol_agrees_in_distribution(self):
+        comparisons = compare_engines(
+            {k: self.scenarios[k] for k in ("reduction", "priorities", "monthly band")},
+            [ENGINES["sobol"]], n=2048)
+        for c in comparisons:
+            self.assertIsNone(c.exact)
+            self.assertGreater(c.ks, 0)
+            self.assertTrue(c.passed, (c.scenario, c.ks, c.ks_critical))
+            self.assertEqual(len(c.quantiles), len(QUANTILES))
+
+    def test_detects_wrong_engine(self):
+        wrong = Engine("wrong", _ignore_reduction)
+        unshared = Engine("wrong", _ignore_reduction, shared=False)
+        scenarios = {"ruinous reduction": self.scenarios["ruinous reduction"]}
+        for c in compare_engines(scenarios, [wrong, unshared], n=2000):
+            self.assertFalse(c.passed, c.engine_name)
+            self.assertGreater(c.ks, c.ks_critical)
+        self.assertIn("FAIL", format_report(
+            compare_engines(scenarios, [wrong], n=200)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+
+from frontier import *
+from mortality import Lifespan, Sex
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+class SpendingFrontierTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.shocks = ShockBank.for_settings(self.rs, 2000, 1)
+        self.expenditures = np.linspace(20000, 80000, 31)
+
+    def test_matches_separate_simulations(self):
+        frontier = spending_frontier(self.rs, self.expenditures, 0.1, 2000,
+                                     self.shocks)
+        self.assertEqual(len(frontier), 31)
+        for i in (0, 12, 30):
+            rs = self.rs.copy()
+            rs.expenditure = self.expenditures[i]
+            result = simulate_values(rs, 2000, self.shocks)
+            self.assertEqual(frontier.ruin_probabilities[i], result.ruin_probability())
+            self.assertEqual(frontier.tail_values[i], result.tail_value(0.1))
+            self.assertEqual(frontier.median_bequests[i],
+                             np.median(np.maximum(result.current_values(), 0)))
+        # Left unchanged
+        self.assertEqual(self.rs, create_waterfall_settings(0.1))
+
+    def test_trade_off(self):
+        frontier = spending_frontier(self.rs, self.expenditures, n=2000,
+                                     shocks=self.shocks)
+        # The same paths for every candidate, so the frontier is monotone
+        self.assertTrue((np.diff(frontier.ruin_probabilities) >= 0).all())
+        self.assertTrue((np.diff(frontier.tail_values) <= 0).all())
+        self.assertTrue((np.diff(frontier.median_bequests) <= 0).all())
+        self.assertLess(frontier.ruin_probabilities[0], 0.05)
+        self.assertGreater(frontier.ruin_probabilities[-1], 0.5)
+        self.assertTrue(frontier.efficient().all())
+
+    def test_max_expenditure_brackets_bisection(self):
+        frontier = spending_frontier(self.rs, self.expenditures, 0.05, 2000,
+                                     self.shocks)
+        crossing = optimize_r_var(self.rs.copy(), RValue(RSetting.EXPENDITURE), True,
+                                  0.05, self.shocks, n=2000)
+        best = frontier.max_expenditure(emergency_min=self.rs.emergency_min)
+        self.assertLessEqual(best, crossing)
+        self.assertGreater(best, crossing - 2000)
+        safe = frontier.max_expenditure(max_ruin=0.1)
+        self.assertLessEqual(frontier.ruin_probabilities[
+            list(frontier.expenditures).index(safe)], 0.1)
+        self.assertIsNone(frontier.max_expenditure(max_ruin=-1))
+
+    def test_efficient(self):
+        frontier = Frontier(np.array([10.0, 20, 20, 30]),
+                            np.array([0.1, 0.2, 0.1, 0.3]), np.zeros(4),
+                            np.array([6.0, 5, 5, 1]), 0.05)
+        # Row 1 spends the same as row 2 at more risk
+        self.assertEqual(list(frontier.efficient()), [True, False, True, True])
+
+    def test_stepwise_scenarios(self):
+        rs = create_waterfall_settings(0.1)
+        rs.lifespan = Lifespan([65], [Sex.FEMALE])
+        shocks = ShockBank.for_settings(rs, 300, 2)
+        frontier = spending_frontier(rs, [30000, 50000], n=300, shocks=shocks)
+        rs.expenditure = 50000
+        self.assertEqual(frontier.tail_values[1],
+                         simulate_values(rs, 300, shocks).tail_value(0.05))
+
+    def test_table(self):
+        frontier = spending_frontier(self.rs, [30000, 40000], n=500, seed=3)
+        structured = frontier.to_structured()
+        self.assertEqual(list(structured), ["pmin"] + list(COLUMNS))
+        self.assertEqual(structured["expenditure"], [30000, 40000])
+        self.assertEqual(frontier.rows()[1][0], 40000)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            frontier_print(frontier)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
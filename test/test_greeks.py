@@ -0,0 +1,128 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from greeks import *
+import retcalc
+from retcalc import Backend, Frequency, optimize_r_var, simulate_values
+from test.test_engine import create_complex_settings, create_waterfall_settings
+
+
+def create_smooth_settings() -> RetirementSettings:
+    # Zero minimum values sit on kinks of the waterfall
+    rs = create_waterfall_settings(0.1)
+    allocs = rs.asset_distribution.asset_allocations
+    allocs[1].minimum_value = 50000
+    allocs[2].minimum_value = 1000
+    return rs
+
+
+def finite_difference(rs: RetirementSettings, sensitivity: Sensitivity,
+                      shocks: ShockBank, n: int) -> np.ndarray:
+    value = sensitivity.get_val(rs)
+    h = max(abs(value), 1) * 1e-6
+
+    def current_values(x: float) -> np.ndarray:
+        bumped = rs.copy()
+        if sensitivity.rvalue.rsetting == RSetting.INFLATION:
+            inflation = list(bumped.inflation)
+            inflation[sensitivity.component] = x
+            bumped.inflation = tuple(inflation)
+        else:
+            bumped.update_val(sensitivity.rvalue, lambda _: x)
+        # The reference engine's rebalance asserts trip on some bumped paths
+        return simulate_values(bumped, n, shocks,
+                               Backend.COMPILED).current_values()
+
+    return (current_values(value + h) - current_values(value - h)) / (2 * h)
+
+
+class GreeksTest(unittest.TestCase):
+    def test_values_match_simulate_values(self):
+        for rs in [create_waterfall_settings(0.1), create_complex_settings()]:
+            shocks = ShockBank.for_settings(rs, 200, seed=1)
+            result = simulate_sensitivities(rs, 200, shocks=shocks)
+            reference = simulate_values(rs, 200, shocks)
+            self.assertTrue(np.array_equal(result.values, reference.values))
+            self.assertTrue(np.array_equal(result.ruin_years, reference.ruin_years))
+
+    def test_gradients_match_finite_differences(self):
+        rs = create_smooth_settings()
+        shocks = ShockBank.for_settings(rs, 200, seed=1)
+        sensitivities = Sensitivity.all(rs)
+        gradients = simulate_sensitivities(
+            rs, 200, sensitivities, shocks).current_value_gradients()
+        for q, sensitivity in enumerate(sensitivities):
+            expected = finite_difference(rs, sensitivity, shocks, 200)
+            close = np.isclose(gradients[:, q], expected, rtol=1e-3, atol=1e-3)
+            # Allow the odd path within h of a kink
+            self.assertGreater(close.mean(), 0.97, sensitivity.label(rs))
+
+    def test_monthly_gradients_match_finite_differences(self):
+        rs = create_smooth_settings()
+        rs.step_frequency = Frequency.MONTHLY
+        shocks = ShockBank.for_settings(rs, 100, seed=1)
+        sensitivities = Sensitivity.all(rs)
+        result = simulate_sensitivities(rs, 100, sensitivities, shocks)
+        self.assertTrue(np.array_equal(
+            result.values,
+            simulate_values(rs, 100, shocks, Backend.COMPILED).values))
+        gradients = result.current_value_gradients()
+        for q, sensitivity in enumerate(sensitivities):
+            expected = finite_difference(rs, sensitivity, shocks, 100)
+            close = np.isclose(gradients[:, q], expected, rtol=1e-3, atol=1e-3)
+            self.assertGreater(close.mean(), 0.97, sensitivity.label(rs))
+
+    def test_tail_gradient(self):
+        rs = create_waterfall_settings()
+        result = simulate_sensitivities(rs, 1000, [
+            Sensitivity(RValue(RSetting.EXPENDITURE)),
+            Sensitivity.asset(2, ASSET_SETTINGS[1]),
+        ], seed=2)
+        expenditure, stocks_mean_return = result.tail_gradient(0.05)
+        self.assertLess(expenditure, 0)
+        self.assertGreater(stocks_mean_return, 0)
+
+    def test_newton_matches_bisection(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 500, seed=3)
+        for rvalue, maximize in [
+            (RValue(RSetting.EXPENDITURE), True),
+            (Sensitivity.asset(2, ASSET_SETTINGS[0]).rvalue, False),
+        ]:
+            newton = newton_optimize_r_var(rs.copy(), rvalue, maximize, 0.05, 500,
+                                           shocks)
+            bisection = optimize_r_var(rs.copy(), rvalue, maximize, 0.05, shocks,
+                                       n=500)
+            self.assertAlmostEqual(newton, bisection, delta=200)
+
+    def test_tornado(self):
+        rs = create_waterfall_settings()
+        report = tornado(rs, 0.05, 500, seed=4)
+        self.assertEqual(len(report), 3 + 4 * 3)
+        effects = [abs(effect) for _, effect in report]
+        self.assertEqual(effects, sorted(effects, reverse=True))
+        self.assertIn(report[0][0], ["Expenditure", "Stocks value"])
+
+    def test_not_differentiable(self):
+        rs = create_waterfall_settings()
+        with self.assertRaises(ValueError):
+            simulate_sensitivities(rs, 10, [Sensitivity(RValue(RSetting.T))])
+        rs.asset_distribution.allocation = AllocationMode.PROPORTIONAL
+        with self.assertRaises(ValueError):
+            simulate_sensitivities(rs, 10)
+
+    def test_report_prompt_unsupported(self):
+        rs = create_waterfall_settings()
+        rs.asset_distribution.allocation = AllocationMode.PROPORTIONAL
+        out = io.StringIO()
+        with mock.patch.object(retcalc, "select_and_load_retirement_settings",
+                               return_value=rs), \
+                mock.patch.object(retcalc, "takefloat", return_value=0.05), \
+                contextlib.redirect_stdout(out):
+            retcalc.sensitivity_report_prompt()
+        self.assertIn("No sensitivity report: Sensitivities need the priority",
+                      out.getvalue())
@@ -0,0 +1,96 @@
+import unittest
+
+import numpy as np
+
+from mortality import *
+from retcalc import *
+from test.test_engine import assert_backends_equal, create_waterfall_settings
+from withdrawal import WithdrawalPolicy
+
+
+def with_lifespan(rs: RetirementSettings, lifespan: Lifespan) -> RetirementSettings:
+    rs = rs.copy()
+    rs.t = 45
+    rs.lifespan = lifespan
+    return rs
+
+
+class LifeTableTest(unittest.TestCase):
+    def test_bundled_table(self):
+        table = default_life_table()
+        self.assertEqual(table.max_age, 119)
+        self.assertAlmostEqual(table.life_expectancy(Sex.MALE, 65), 18.0, delta=0.05)
+        self.assertAlmostEqual(table.life_expectancy(Sex.FEMALE, 65), 20.6, delta=0.05)
+        survival = table.survival(Sex.FEMALE, 100)
+        self.assertEqual(survival[0], 1)
+        self.assertEqual(survival[-1], 0)
+        self.assertTrue((np.diff(survival) <= 0).all())
+
+    def test_sampled_years(self):
+        longevity = np.random.default_rng(1).random((100000, MAX_LIVES))
+        single = Lifespan([65], [Sex.MALE]).years(longevity)
+        # Years include the year of death
+        self.assertAlmostEqual(single.mean(),
+                               default_life_table().life_expectancy(Sex.MALE, 65) + 0.5,
+                               delta=0.1)
+        joint = Lifespan([65, 63], [Sex.MALE, Sex.FEMALE]).years(longevity)
+        self.assertTrue((joint >= single).all())
+        self.assertGreater(joint.mean(), single.mean() + 3)
+        self.assertLessEqual(joint.max(), 120 - 63)
+
+    def test_structured(self):
+        rs = with_lifespan(create_waterfall_settings(),
+                           Lifespan([65, 63], [Sex.MALE, Sex.FEMALE]))
+        restored = RetirementSettings.from_structured(rs.to_structured())
+        self.assertEqual(restored.lifespan, rs.lifespan)
+        self.assertEqual(restored, rs)
+
+
+class LifespanSimulationTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = with_lifespan(create_waterfall_settings(0.1),
+                                Lifespan([65], [Sex.FEMALE]))
+        self.rs.expenditure = 55000
+        self.shocks = ShockBank.for_settings(self.rs, 500, seed=2)
+
+    def test_backends_equal(self):
+        assert_backends_equal(self, self.rs)
+
+    def test_ruin_before_death(self):
+        result = simulate_values(self.rs, 500, self.shocks)
+        state = PathState.initial(FlatScenario.from_retirement_settings(self.rs), 500)
+        advance_paths(self.rs, state, self.shocks)
+        ruined = result.ruin_years >= 0
+        self.assertTrue(ruined.any())
+        self.assertTrue((result.ruin_years[ruined] < state.end_years[ruined]).all())
+        fixed = self.rs.copy()
+        fixed.lifespan = None
+        self.assertLess(result.ruin_probability(),
+                        simulate_values(fixed, 500, self.shocks).ruin_probability())
+
+    def test_paths_stop_at_death(self):
+        whole = simulate_values(self.rs, 500, self.shocks)
+        state = PathState.initial(FlatScenario.from_retirement_settings(self.rs), 500)
+        rs = self.rs.copy()
+        rs.t = 1
+        for year in range(self.rs.t):
+            before = state.values.copy()
+            advance_paths(rs, state, self.shocks)
+            dead = state.end_years <= year
+            self.assertTrue(np.array_equal(state.values[dead], before[dead]))
+        self.assertTrue(np.array_equal(state.values, whole.values))
+
+    def test_withdrawal_policy(self):
+        rs = self.rs.copy()
+        rs.withdrawal_policy = WithdrawalPolicy()
+        rs.expenditure_reduction_frac = None
+        expected = self.rs.copy()
+        expected.expenditure_reduction_frac = None
+        self.assertTrue(np.array_equal(
+            simulate_values(rs, 500, self.shocks).values,
+            simulate_values(expected, 500, self.shocks).values))
+
+    def test_needs_longevity_draws(self):
+        shocks = ShockBank(self.shocks.inflation, self.shocks.returns)
+        with self.assertRaises(ValueError):
+            simulate_values(self.rs, 500, shocks)
@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from test.test_engine import create_waterfall_settings
+
+
+def create_phased_scenario() -> PhasedScenario:
+    rs = create_waterfall_settings(0.1)
+    rs.t = 10
+    return PhasedScenario(rs, [Phase(10, -20000), Phase(20, 45000, 0.1)])
+
+
+class PhasesTest(unittest.TestCase):
+    def test_single_phase_matches_simulate_values(self):
+        rs = create_waterfall_settings(0.1)
+        scenario = PhasedScenario(rs, [Phase(rs.t, rs.expenditure, 0.1)])
+        shocks = ShockBank.for_settings(rs, 100, seed=1)
+        phased = simulate_phases(scenario, 100, shocks).result()
+        plain = simulate_values(rs, 100, shocks)
+        self.assertTrue(np.array_equal(phased.values, plain.values))
+        self.assertTrue(np.array_equal(phased.ruin_years, plain.ruin_years))
+
+    def test_backends_equal(self):
+        scenario = create_phased_scenario()
+        shocks = phase_shocks(scenario, 200, seed=2)
+        compiled = simulate_phases(scenario, 200, shocks, Backend.COMPILED)
+        python = simulate_phases(scenario, 200, shocks, Backend.PYTHON)
+        self.assertEqual(compiled.year, 30)
+        for name in ["values", "expenditure", "price_index", "ruin_years"]:
+            self.assertTrue(np.array_equal(getattr(compiled, name),
+                                           getattr(python, name)), name)
+
+    def test_continuation_matches_full_run(self):
+        scenario = create_phased_scenario()
+        shocks = phase_shocks(scenario, 100, seed=3)
+        full = simulate_phases(scenario, 100, shocks).result()
+        state = simulate_phases(scenario, 100, shocks, last=1)
+        continuation = PhaseContinuation(scenario, 1, state, shocks)
+        continued = continuation.simulate_values(scenario.phase_settings(1), 100)
+        self.assertTrue(np.array_equal(continued.values, full.values))
+        # The saved state is reused by every probe, never advanced
+        self.assertEqual(state.year, 10)
+
+    def test_optimize_phase_var_backends_equal(self):
+        scenario = create_phased_scenario()
+        shocks = phase_shocks(scenario, 200, seed=4)
+        results = [optimize_phase_var(scenario, 1, RValue(RSetting.EXPENDITURE),
+                                      True, 0.05, 200, shocks, backend)
+                   for backend in [Backend.COMPILED, Backend.PYTHON]]
+        self.assertGreater(results[0], 0)
+        self.assertEqual(results[0], results[1])
+
+    def test_tail_index(self):
+        scenario = create_phased_scenario()
+        result = simulate_phases(scenario, 100, last=1).result()
+        index = result.tail_index(0.05)
+        self.assertEqual(result.current_values()[index], result.tail_value(0.05))
+
+    def test_structured(self):
+        scenario = create_phased_scenario()
+        restored = PhasedScenario.from_structured(scenario.to_structured())
+        self.assertEqual(restored, scenario)
+        self.assertEqual(restored.t, 30)
+        self.assertEqual(restored.phase_settings(1).expenditure, 45000)
@@ -0,0 +1,219 @@
+import unittest
+
+import numpy as np
+from scipy import stats
+
+import engine
+from greeks import simulate_sensitivities
+from retcalc import *
+from returnmodels import *
+from test.test_engine import create_waterfall_settings, with_frequency
+
+
+def with_models(rs: RetirementSettings, *models: Optional[ReturnModel],
+                regimes: Optional[RegimeSwitching] = None) -> RetirementSettings:
+    rs = rs.copy()
+    for aa, model in zip(rs.asset_distribution.asset_allocations, models):
+        aa.asset.return_model = model
+    rs.regimes = regimes
+    return rs
+
+
+BULL_BEAR = RegimeSwitching([[0.85, 0.15], [0.45, 0.55]])
+
+
+def annual_moments(mean: float, stdev: float):
+    return mean, stdev
+
+
+class ReturnModelTest(unittest.TestCase):
+    def setUp(self):
+        self.shocks = np.random.default_rng(1).standard_normal((200000, 1))
+
+    def test_student_t(self):
+        model = StudentT(4)
+        standardized = model.standardize(self.shocks, 0.08, 0.15, annual_moments)
+        self.assertAlmostEqual(standardized.mean(), 0, delta=0.01)
+        self.assertAlmostEqual(standardized.std(), 1, delta=0.02)
+        self.assertGreater(stats.kurtosis(standardized.ravel()), 1)
+        # The same probabilities as the normal shocks
+        order = np.argsort(self.shocks.ravel())
+        self.assertTrue((np.diff(standardized.ravel()[order]) >= 0).all())
+        exact = stats.t.ppf(stats.norm.cdf(self.shocks), 4) * np.sqrt(0.5)
+        floor = (-1 - 0.08) / 0.15
+        self.assertTrue(np.allclose(standardized, np.maximum(exact, floor),
+                                    rtol=1e-5, atol=1e-8))
+        with self.assertRaises(ValueError):
+            StudentT(2)
+
+    def test_extreme_shocks_stay_finite(self):
+        shocks = np.array([[-30.0], [-9], [-1e-3], [0], [1e-3], [9], [30]])
+        standardized = StudentT(3).standardize(shocks, 0.05, 0, annual_moments)
+        self.assertTrue(np.isfinite(standardized).all())
+        self.assertTrue((np.diff(standardized.ravel()) > 0).all())
+
+    def test_lognormal(self):
+        for mean, stdev in [(0.08, 0.15), (0.03, 0.4)]:
+            standardized = Lognormal().standardize(self.shocks, mean, stdev,
+                                                   annual_moments)
+            returns = mean + standardized * stdev
+            self.assertGreater(returns.min(), -1)
+            self.assertAlmostEqual(returns.mean(), mean, delta=stdev * 0.01)
+            self.assertAlmostEqual(returns.std(), stdev, delta=stdev * 0.02)
+            # Skewed to the right
+            self.assertGreater(stats.skew(returns.ravel()), 0)
+        self.assertTrue(np.array_equal(
+            Lognormal().standardize(self.shocks, 0.01, 0, annual_moments),
+            np.zeros_like(self.shocks)))
+
+    def test_regime_paths(self):
+        uniforms = np.random.default_rng(2).random((20000, 40 * 12))
+        regimes = BULL_BEAR.paths(uniforms, 12)
+        self.assertEqual(regimes.shape, uniforms.shape)
+        # Regimes only change at year starts
+        yearly = regimes.reshape(20000, 40, 12)
+        self.assertTrue((yearly == yearly[:, :, :1]).all())
+        stationary = BULL_BEAR.stationary()
+        self.assertTrue(np.allclose(stationary, [0.75, 0.25]))
+        for year in (0, 39):
+            self.assertAlmostEqual((yearly[:, year, 0] == 1).mean(), 0.25, delta=0.015)
+        # Bear years cluster
+        bear = yearly[:, :-1, 0] == 1
+        self.assertAlmostEqual((yearly[:, 1:, 0][bear] == 1).mean(), 0.55, delta=0.01)
+
+        three = RegimeSwitching([[0.8, 0.15, 0.05], [0.5, 0.4, 0.1], [0.3, 0.3, 0.4]],
+                                [1, 0, 0])
+        regimes = three.paths(uniforms[:, :40], 1)
+        self.assertTrue((regimes[:, 0] == 0).all())
+        self.assertEqual(set(np.unique(regimes)), {0, 1, 2})
+        for transition in ([[1]], [[0.5, 0.6], [0.5, 0.5]], [[0.5, 0.5]]):
+            with self.assertRaises(ValueError):
+                RegimeSwitching(transition)
+
+    def test_regime_returns(self):
+        regimes = np.repeat([[0], [1]], 100000, axis=0)
+        shocks = np.random.default_rng(3).standard_normal((200000, 1))
+        model = Regime([0.12, -0.06], [0.12, 0.25])
+        returns = 0.08 + model.standardize(shocks, 0.08, 0.15, annual_moments,
+                                           regimes) * 0.15
+        for regime, (mean, stdev) in enumerate(zip(model.means, model.stdevs)):
+            in_regime = returns[regimes == regime]
+            self.assertAlmostEqual(in_regime.mean(), mean, delta=0.003)
+            self.assertAlmostEqual(in_regime.std(), stdev, delta=0.003)
+        with self.assertRaises(ValueError):
+            model.standardize(shocks, 0.08, 0.15, annual_moments)
+        with self.assertRaises(ValueError):
+            Regime([0.1, 0], [0.1])
+
+    def test_structured(self):
+        rs = with_models(create_waterfall_settings(0.1), None, Lognormal(),
+                         Regime([0.12, -0.06], [0.12, 0.25]), regimes=BULL_BEAR)
+        structured = rs.to_structured()
+        self.assertEqual(structured["regimes"],
+                         {"transition": [[0.85, 0.15], [0.45, 0.55]]})
+        assets = [aa["asset"]
+                  for aa in structured["asset_distribution"]["asset_allocations"]]
+        self.assertNotIn("return_model", assets[0])
+        self.assertEqual(assets[2]["return_model"], {
+            "type": "REGIME", "means": [0.12, -0.06], "stdevs": [0.12, 0.25]})
+        loaded = RetirementSettings.from_structured(structured)
+        self.assertEqual(loaded, rs)
+        self.assertEqual(hash(loaded), hash(rs))
+        self.assertNotEqual(loaded, with_models(rs, None, StudentT(5), None))
+        self.assertEqual(ReturnModel.from_structured({"type": "STUDENT_T", "dof": 5}),
+                         StudentT(5))
+
+
+class ModelShocksTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.rs.expenditure = 45000
+        self.models = with_models(self.rs, None, Lognormal(), StudentT(3))
+        self.regimes = with_models(self.rs, None, StudentT(5),
+                                   Regime([0.12, -0.06], [0.12, 0.25]),
+                                   regimes=BULL_BEAR)
+
+    def test_normal_uses_bank_as_is(self):
+        shocks = ShockBank.for_settings(self.rs, 100, 1)
+        self.assertIs(engine.model_shocks(self.rs, shocks), shocks)
+        explicit = with_models(self.rs, ReturnModel(), ReturnModel(), ReturnModel())
+        self.assertIs(engine.model_shocks(explicit, shocks), shocks)
+
+    def test_derived_bank_is_cached(self):
+        shocks = ShockBank.for_settings(self.rs, 100, 1)
+        modelled = engine.model_shocks(self.models, shocks)
+        self.assertIs(engine.model_shocks(self.models.copy(), shocks), modelled)
+        self.assertTrue(np.array_equal(modelled.returns[:, :, 0],
+                                       shocks.returns[:, :, 0]))
+        self.assertFalse(np.array_equal(modelled.returns[:, :, 2],
+                                        shocks.returns[:, :, 2]))
+        changed = self.models.copy()
+        changed.asset_distribution.asset_allocations[1].asset.return_stdev = 0.1
+        self.assertIsNot(engine.model_shocks(changed, shocks), modelled)
+
+    def test_backends_agree(self):
+        for rs in (self.models, self.regimes):
+            for frequency in (Frequency.ANNUAL, Frequency.MONTHLY):
+                rs = with_frequency(rs, frequency, Frequency.ANNUAL)
+                shocks = ShockBank.for_settings(rs, 200, 5)
+                compiled = simulate_values(rs, 200, shocks, Backend.COMPILED)
+                python = simulate_values(rs, 200, shocks, Backend.PYTHON)
+                self.assertTrue(np.array_equal(compiled.values, python.values))
+                self.assertTrue(np.array_equal(compiled.ruin_years, python.ruin_years))
+                self.assertEqual(retirement_value(rs, shocks, 7).current_value(),
+                                 compiled.values[7].sum())
+
+    def test_fat_tails(self):
+        shocks = ShockBank.for_settings(self.rs, 5000, 6)
+        student = with_models(self.rs, None, StudentT(3), StudentT(3))
+        # Crash years are several times as frequent at the same stdev
+        crashes = (engine.model_shocks(student, shocks).returns[:, :, 2] < -3).mean()
+        self.assertGreater(crashes, 3 * (shocks.returns[:, :, 2] < -3).mean())
+        self.assertLess(simulate_values(student, 5000, shocks).tail_value(0.01),
+                        simulate_values(self.rs, 5000, shocks).tail_value(0.01))
+
+    def test_regimes_shared_across_assets(self):
+        rs = with_models(self.rs, None, Regime([0.06, 0.0], [0.05, 0.08]),
+                         Regime([0.12, -0.06], [0.12, 0.25]), regimes=BULL_BEAR)
+        rs.t = 1
+        shocks = ShockBank.for_settings(rs, 20000, 7)
+        returns = engine.model_shocks(rs, shocks).returns[:, 0]
+        bear = BULL_BEAR.paths(shocks.regimes, 1)[:, 0] == 1
+        # Both assets are below their long run means in bear years
+        for asset in (1, 2):
+            self.assertLess(returns[bear, asset].mean(), -0.3)
+            self.assertGreater(returns[~bear, asset].mean(), 0.1)
+
+    def test_needs_regimes(self):
+        rs = with_models(self.rs, None, None, Regime([0.1, 0], [0.1, 0.2]))
+        with self.assertRaises(ValueError):
+            simulate_values(rs, 10, ShockBank.for_settings(rs, 10, 1))
+        rs.regimes = BULL_BEAR
+        shocks = ShockBank.for_settings(rs, 10, 1)
+        with self.assertRaises(ValueError):
+            simulate_values(rs, 10, ShockBank(shocks.inflation, shocks.returns))
+        simulate_values(rs, 10, shocks)
+
+    def test_trajectory_continues_regimes(self):
+        trajectory = Trajectory.simulate(self.regimes, 200, seed=8)
+        extended = trajectory.result(40)
+        rs = self.regimes.copy()
+        rs.t = 40
+        expected = simulate_values(rs, 200, trajectory.shocks)
+        self.assertTrue(np.array_equal(extended.values, expected.values))
+
+    def test_batch_and_sensitivities(self):
+        shocks = ShockBank.generate(300, 30, 3, seed=9)
+        batch = simulate_batch([self.rs, self.models], 300, shocks)
+        expected = simulate_values(self.models, 300, shocks)
+        self.assertTrue(np.array_equal(batch.values[1], expected.values))
+        student = with_models(self.rs, None, None, StudentT(5))
+        result = simulate_sensitivities(student, 300, shocks=shocks)
+        self.assertTrue(np.array_equal(result.values,
+                                       simulate_values(student, 300, shocks).values))
+        with self.assertRaises(ValueError):
+            simulate_sensitivities(self.models, 300, shocks=shocks)
+
+
+if __name__ == "__main__":
+    unittest.main()
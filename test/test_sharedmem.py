@@ -0,0 +1,132 @@
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+import os
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from sharedmem import ParallelSimulator, SharedArray
+from test.test_engine import create_waterfall_settings
+
+
+class SharedMemTest(unittest.TestCase):
+    def assertUnlinked(self, names):
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
+
+    def test_shared_array_roundtrip(self):
+        array = np.arange(12.0).reshape(3, 4)
+        shared = SharedArray.copy_of(array)
+        try:
+            attached = SharedArray.attach(shared.spec, readonly=True)
+            self.assertTrue(np.array_equal(attached.array, array))
+            self.assertFalse(attached.array.flags.writeable)
+            attached.close()
+        finally:
+            shared.shm.unlink()
+            shared.close()
+        self.assertUnlinked([shared.shm.name])
+
+    def test_parallel_matches_local(self):
+        rs = create_waterfall_settings(0.1)
+        shocks = ShockBank.for_settings(rs, 300, seed=2)
+        local = simulate_values(rs, 300, shocks)
+        with ParallelSimulator(shocks, processes=2) as simulator:
+            names = simulator.segment_names()
+            parallel = simulator.simulate_values(rs, 300)
+            # Fewer trials and assets than the bank was sized for
+            rs.asset_distribution.asset_allocations.pop()
+            partial = simulator.simulate_values(rs, 100)
+        self.assertTrue(np.array_equal(local.values, parallel.values))
+        self.assertTrue(np.array_equal(local.ruin_years, parallel.ruin_years))
+        self.assertTrue(np.array_equal(local.price_index, parallel.price_index))
+        self.assertTrue(
+            np.array_equal(simulate_values(rs, 100, shocks).values, partial.values)
+        )
+        self.assertUnlinked(names)
+
+    def test_optimize_with_simulator(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 200, seed=4)
+        local = optimize_r_var(rs.copy(), RValue(RSetting.EXPENDITURE), True, 0.05,
+                               shocks, n=200)
+        with ParallelSimulator(shocks, processes=2) as simulator:
+            parallel = optimize_r_var(rs.copy(), RValue(RSetting.EXPENDITURE), True,
+                                      0.05, n=200, simulator=simulator)
+        self.assertEqual(local, parallel)
+
+    def test_cleanup_after_worker_crash(self):
+        rs = create_waterfall_settings()
+        shocks = ShockBank.for_settings(rs, 100, seed=1)
+        with self.assertRaises(BrokenProcessPool):
+            with ParallelSimulator(shocks, processes=2) as simulator:
+                names = simulator.segment_names()
+                simulator._executor.submit(os._exit, 1)  # type: ignore
+                simulator.simulate_values(rs, 100)
+        self.assertUnlinked(names)
+
+
+class LocalSimulator:
+    """simulate_many without worker processes, counting rounds"""
+
+    def __init__(self, shocks: ShockBank, processes: int):
+        self.shocks = shocks
+        self.processes = processes
+        self.rounds = 0
+
+    def simulate_many(self, settings: List[RetirementSettings],
+                      n: int) -> List[SimulationResult]:
+        self.rounds += 1
+        return [simulate_values(rs, n, self.shocks) for rs in settings]
+
+
+class ParallelSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings()
+        self.shocks = ShockBank.for_settings(self.rs, 200, seed=4)
+        self.serial_state = SearchState()
+        self.serial = optimize_r_var(self.rs.copy(), RValue(RSetting.EXPENDITURE),
+                                     True, 0.05, self.shocks, n=200,
+                                     state=self.serial_state)
+
+    def test_fewer_rounds(self):
+        for processes in [1, 3, 7]:
+            simulator = LocalSimulator(self.shocks, processes)
+            value = parallel_optimize_r_var(self.rs, RValue(RSetting.EXPENDITURE),
+                                            True, 0.05, simulator, n=200)
+            self.assertLessEqual(abs(value - self.serial), 100)
+            if processes > 1:
+                self.assertLess(simulator.rounds, len(self.serial_state.probes) / 2)
+
+    def test_minimize(self):
+        rs = self.rs.copy()
+        rs.emergency_min = 500000
+        stocks_value = RValue(RSetting.ASSET_DISTRIBUTION,
+                              DistributionValue(DistributionSetting.ASSET_ALLOCATIONS,
+                                                (2, AllocationValue(
+                                                    AllocationSetting.ASSET,
+                                                    AssetSetting.VALUE))))
+        serial = optimize_r_var(rs.copy(), stocks_value, False, 0.05, self.shocks,
+                                n=200)
+        parallel = parallel_optimize_r_var(rs, stocks_value, False, 0.05,
+                                           LocalSimulator(self.shocks, 4), n=200)
+        self.assertLessEqual(abs(parallel - serial), 100)
+
+    def test_workers(self):
+        with ParallelSimulator(self.shocks, processes=2) as simulator:
+            cheaper = self.rs.copy()
+            cheaper.expenditure = 20000
+            many = simulator.simulate_many([self.rs, cheaper, self.rs], 200)
+            value = parallel_optimize_r_var(self.rs, RValue(RSetting.EXPENDITURE),
+                                            True, 0.05, simulator, n=200)
+            names = simulator.segment_names()
+        local = simulate_values(cheaper, 200, self.shocks)
+        self.assertTrue(np.array_equal(many[1].values, local.values))
+        self.assertTrue(np.array_equal(many[1].price_index, local.price_index))
+        self.assertTrue(np.array_equal(many[0].values, many[2].values))
+        self.assertLessEqual(abs(value - self.serial), 100)
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+
+import shocks
+from retcalc import *
+from shocks import Sampling
+from test.test_engine import create_waterfall_settings
+
+
+class ShocksTest(unittest.TestCase):
+    def test_generate(self):
+        bank = ShockBank.generate(100, 30, 3, seed=1)
+        self.assertEqual(bank.inflation.shape, (100, 30))
+        self.assertEqual(bank.returns.shape, (100, 30, 3))
+        self.assertTrue(np.array_equal(bank.returns,
+                                       ShockBank.generate(100, 30, 3, 1).returns))
+
+    def test_fits(self):
+        rs = create_waterfall_settings()
+        bank = ShockBank.for_settings(rs, 10)
+        self.assertTrue(bank.fits(rs, 10))
+        self.assertFalse(bank.fits(rs, 11))
+        rs.t += 1
+        self.assertFalse(bank.fits(rs, 10))
+
+
+@unittest.skipIf(shocks.qmc is None, "scipy is not installed")
+class SobolTest(unittest.TestCase):
+    def test_sobol_shape_and_moments(self):
+        bank = ShockBank.sobol(1024, 30, 3, seed=1)
+        self.assertEqual(bank.inflation.shape, (1024, 30))
+        self.assertEqual(bank.returns.shape, (1024, 30, 3))
+        self.assertTrue(np.isfinite(bank.returns).all())
+        # Each dimension is stratified, so moments are close to exact
+        self.assertLess(np.abs(bank.returns.mean(axis=0)).max(), 0.01)
+        self.assertLess(np.abs(bank.inflation.std(axis=0) - 1).max(), 0.05)
+
+    def test_sobol_not_power_of_two(self):
+        bank = ShockBank.sobol(1000, 5, 2, seed=1)
+        self.assertEqual(bank.n, 1000)
+
+    def test_replicates_are_independent(self):
+        rs = create_waterfall_settings()
+        banks = ShockBank.replicates(rs, 64, 2, seed=1)
+        self.assertFalse(np.array_equal(banks[0].returns, banks[1].returns))
+
+    def test_sobol_converges_faster(self):
+        rs = create_waterfall_settings()
+        spread = {}
+        for sampling in [Sampling.PSEUDO_RANDOM, Sampling.SOBOL]:
+            tail_values = [
+                simulate_values(rs, 512, bank).tail_value(0.05)
+                for bank in ShockBank.replicates(rs, 512, 20, 2, sampling)]
+            spread[sampling] = np.std(tail_values)
+        self.assertLess(spread[Sampling.SOBOL], spread[Sampling.PSEUDO_RANDOM])
+
+    def test_tail_value_estimate(self):
+        rs = create_waterfall_settings()
+        banks = ShockBank.replicates(rs, 256, 8, seed=3)
+        estimate, stderr = tail_value_estimate(rs, banks, 256, 0.05)
+        self.assertGreater(stderr, 0)
+        self.assertLess(stderr, abs(estimate))
+
+    def test_optimize_with_sobol(self):
+        rs = create_waterfall_settings()
+        value = optimize_r_var(rs, RValue(RSetting.EXPENDITURE), True, 0.05,
+                               n=256, seed=1, sampling=Sampling.SOBOL)
+        self.assertGreater(value, 0)
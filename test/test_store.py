@@ -0,0 +1,132 @@
+import os
+from os import path
+import tempfile
+import unittest
+from unittest import mock
+
+import store
+from retcalc import *
+from store import STORE_DIRNAME, ScenarioStore
+from test.test_batch import create_scenarios
+
+
+class ScenarioStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = self.tempdir.name
+        self.scenarios = create_scenarios()
+        for i, rs in enumerate(self.scenarios):
+            save_retirement_settings(rs, path.join(self.dirpath, f"s{i}.yaml"))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def count_parses(self):
+        return mock.patch.object(store, "parse_yaml", side_effect=store.parse_yaml)
+
+    def test_matches_direct_load(self):
+        loaded = ScenarioStore(self.dirpath).load_all()
+        self.assertEqual(loaded, [
+            load_retirement_settings(path.join(self.dirpath, f"s{i}.yaml"))
+            for i in range(len(self.scenarios))])
+        self.assertEqual(load_retirement_settings_dir(self.dirpath), loaded)
+
+    def test_index(self):
+        entries = list(ScenarioStore(self.dirpath).entries.values())
+        self.assertEqual([entry.name for entry in entries], ["s0", "s1", "s2", "s3"])
+        self.assertEqual([entry.t for entry in entries],
+                         [rs.t for rs in self.scenarios])
+        self.assertEqual([entry.num_assets for entry in entries],
+                         [len(rs.asset_distribution.asset_allocations)
+                          for rs in self.scenarios])
+
+    def test_unchanged_files_not_parsed(self):
+        ScenarioStore(self.dirpath)
+        with self.count_parses() as load_yaml:
+            scenarios = ScenarioStore(self.dirpath).load_all()
+        load_yaml.assert_not_called()
+        self.assertEqual(scenarios, load_retirement_settings_dir(self.dirpath))
+
+    def test_touched_files_not_parsed(self):
+        ScenarioStore(self.dirpath)
+        filepath = path.join(self.dirpath, "s1.yaml")
+        os.utime(filepath, (0, 12345))
+        with self.count_parses() as load_yaml:
+            scenarios = ScenarioStore(self.dirpath)
+        load_yaml.assert_not_called()
+        self.assertEqual(scenarios.entries["s1.yaml"].mtime, 12345)
+
+    def test_sync(self):
+        ScenarioStore(self.dirpath)
+        changed = self.scenarios[1].copy()
+        changed.expenditure += 1000
+        save_retirement_settings(changed, path.join(self.dirpath, "s1.yaml"))
+        os.remove(path.join(self.dirpath, "s2.yaml"))
+        save_retirement_settings(changed, path.join(self.dirpath, "s4.yaml"))
+        with self.count_parses() as load_yaml:
+            scenarios = ScenarioStore(self.dirpath)
+        self.assertEqual(load_yaml.call_count, 2)
+        self.assertEqual(list(scenarios.entries), ["s0.yaml", "s1.yaml", "s3.yaml",
+                                                   "s4.yaml"])
+        self.assertEqual(scenarios.load("s1"), changed)
+        self.assertEqual(scenarios.load("s4"), changed)
+        # The stale cache file is collected; the duplicates share one
+        self.assertEqual(
+            len([filename for filename in
+                 os.listdir(path.join(self.dirpath, STORE_DIRNAME))
+                 if filename.endswith(".pickle")]),
+            3)
+
+    def test_hash_matches_parsed_content(self):
+        scenarios = ScenarioStore(self.dirpath)
+        filepath = path.join(self.dirpath, "s1.yaml")
+        changed = self.scenarios[1].copy()
+        changed.expenditure += 1000
+        save_retirement_settings(changed, filepath)
+        with open(filepath, "rb") as stream:
+            content = stream.read()
+        # The file is rewritten between being read and being compiled
+        save_retirement_settings(self.scenarios[0], filepath)
+        scenarios._compile("s1.yaml", content, os.stat(filepath))
+        self.assertEqual(scenarios.entries["s1.yaml"].content_hash,
+                         store.content_hash(content))
+        self.assertEqual(scenarios.load("s1"), changed)
+
+    def test_broken_files_skipped(self):
+        scenarios = ScenarioStore(self.dirpath)
+        with open(path.join(self.dirpath, "s1.yaml"), "w") as stream:
+            stream.write("expenditure: [unclosed\n")
+        with open(path.join(self.dirpath, "s5.yaml"), "w") as stream:
+            stream.write("expenditure: 1000\n")
+        scenarios.refresh()
+        self.assertEqual(list(scenarios.entries), ["s0.yaml", "s2.yaml", "s3.yaml"])
+        self.assertEqual(list(scenarios.errors), ["s1.yaml", "s5.yaml"])
+        self.assertIn("ParserError", scenarios.errors["s1.yaml"])
+        self.assertEqual(len(ScenarioStore(self.dirpath).load_all()), 3)
+        save_retirement_settings(self.scenarios[1], path.join(self.dirpath, "s1.yaml"))
+        scenarios.refresh()
+        self.assertEqual(list(scenarios.errors), ["s5.yaml"])
+        self.assertEqual(scenarios.load("s1"), self.scenarios[1])
+
+    def test_tags_and_hashes(self):
+        scenarios = ScenarioStore(self.dirpath)
+        entry = scenarios.save("tagged", self.scenarios[2], ["monthly", "complex"])
+        self.assertEqual(entry.tags, ["monthly", "complex"])
+        self.assertEqual([e.filename for e in scenarios.with_tag("complex")],
+                         ["tagged.yaml"])
+        self.assertEqual(scenarios.load("tagged"), self.scenarios[2])
+        self.assertEqual(
+            load_retirement_settings(path.join(self.dirpath, "tagged.yaml")),
+            self.scenarios[2])
+        reopened = ScenarioStore(self.dirpath)
+        self.assertEqual(reopened.with_tag("yearly"), [])
+        self.assertEqual(len(reopened.with_tag("monthly")), 1)
+        self.assertEqual(
+            [e.filename for e in
+             reopened.with_hash(reopened.entries["s0.yaml"].content_hash)],
+            ["s0.yaml"])
+
+    def test_load_is_a_fresh_copy(self):
+        scenarios = ScenarioStore(self.dirpath)
+        scenarios.load("s0").expenditure = 0
+        self.assertEqual(scenarios.load("s0"), self.scenarios[0])
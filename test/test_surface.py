@@ -0,0 +1,76 @@
+from os import path
+import tempfile
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from surface import *
+from test.test_engine import create_waterfall_settings
+
+
+class SurfaceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rs = create_waterfall_settings(0.1)
+        cls.shocks = ShockBank.generate(200, 35, 3, seed=1)
+        cls.surface = ResponseSurface.build(
+            cls.rs, [0, 20000, 40000, 60000], [400000, 820000, 1200000], 35,
+            n=200, shocks=cls.shocks, seed=1, validation_points=5)
+
+    def test_grid_matches_direct_simulation(self):
+        for t in [1, 17, 35]:
+            rs = scaled_settings(self.rs, 40000, t, 820000)
+            direct = simulate_values(rs, 200, self.shocks)
+            self.assertEqual(self.surface.ruin_probability(40000, t, 820000),
+                             direct.ruin_probability())
+            self.assertAlmostEqual(self.surface.tail_value(40000, t, 820000),
+                                   direct.tail_value(0.05), delta=1e-6)
+
+    def test_monotone(self):
+        tail_values = [self.surface.tail_value(e, 30, 700000)
+                       for e in range(0, 60001, 5000)]
+        self.assertEqual(tail_values, sorted(tail_values, reverse=True))
+        ruin = self.surface.ruin_probabilities
+        self.assertTrue((np.diff(ruin, axis=0) >= 0).all())
+        self.assertTrue((np.diff(ruin, axis=1) >= 0).all())
+        self.assertTrue((np.diff(ruin, axis=2) <= 0).all())
+        self.assertGreaterEqual(self.surface.error_bound, 0)
+
+    def test_max_expenditure(self):
+        expenditure = self.surface.max_expenditure(30, 820000, 100000)
+        self.assertGreater(expenditure, 0)
+        self.assertAlmostEqual(self.surface.tail_value(expenditure, 30, 820000),
+                               100000, delta=1e-6)
+
+    def test_no_starting_value(self):
+        saver = self.rs.copy()
+        for aa in saver.asset_distribution.asset_allocations:
+            aa.asset.value = 0
+        self.assertFalse(self.surface.matches(saver))
+        self.assertEqual(scaled_settings(saver, 1000, 5, 0).current_value(), 0)
+        with self.assertRaises(ValueError):
+            scaled_settings(saver, 1000, 5, 100000)
+        with self.assertRaises(ValueError):
+            ResponseSurface.build(saver, [0, 1000], [0, 100000], 5, n=50)
+
+    def test_outside_grid(self):
+        with self.assertRaises(ValueError):
+            self.surface.tail_value(80000, 30, 820000)
+        with self.assertRaises(ValueError):
+            self.surface.tail_value(40000, 36, 820000)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = surface_path(path.join(dirpath, "client.yaml"))
+            self.assertTrue(filepath.endswith("client.surface.npz"))
+            self.surface.save(filepath)
+            loaded = ResponseSurface.load(filepath)
+        self.assertAlmostEqual(loaded.tail_value(30000, 20, 600000),
+                               self.surface.tail_value(30000, 20, 600000), delta=1)
+        self.assertEqual(loaded.error_bound, self.surface.error_bound)
+        richer = scaled_settings(self.rs, 10000, 5, 2000000)
+        self.assertTrue(loaded.matches(richer))
+        riskier = self.rs.copy()
+        riskier.asset_distribution.asset_allocations[2].asset.return_stdev = 0.2
+        self.assertFalse(loaded.matches(riskier))
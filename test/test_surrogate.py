@@ -0,0 +1,100 @@
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from surrogate import *
+from test.test_engine import create_waterfall_settings
+
+
+def expenditure(low: float = 0, high: float = 100000) -> Variable:
+    return Variable(RValue(RSetting.EXPENDITURE), low, high)
+
+
+def with_t(rs: RetirementSettings, t: int) -> RetirementSettings:
+    rs = rs.copy()
+    rs.t = t
+    return rs
+
+
+class GaussianProcessTest(unittest.TestCase):
+    def test_interpolates_smooth_function(self):
+        rng = np.random.default_rng(1)
+        x = rng.random((30, 2))
+        f = lambda x: np.sin(3 * x[:, 0]) + x[:, 1] ** 2
+        gp = GaussianProcess(x, f(x), np.full(30, 1e-6))
+        test = rng.random((200, 2))
+        mean, stdev = gp.predict(test)
+        self.assertLess(np.abs(mean - f(test)).max(), 0.05)
+        # Sure where it has data, unsure far away
+        _, at_data = gp.predict(x[:5])
+        self.assertLess(at_data.max(), 0.01)
+        _, far = gp.predict(np.array([[3.0, 3.0]]))
+        self.assertGreater(far[0], 0.5)
+
+    def test_noise_smooths(self):
+        x = np.linspace(0, 1, 20)[:, None]
+        y = 2 * x[:, 0] + np.where(np.arange(20) % 2, 0.3, -0.3)
+        mean, _ = GaussianProcess(x, y, np.full(20, 0.09)).predict(x)
+        self.assertLess(np.abs(mean - 2 * x[:, 0]).max(), 0.25)
+
+
+class SurrogateOptimizeTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.shocks = ShockBank.for_settings(with_t(self.rs, 45), 10000, 1)
+
+    def test_one_variable_matches_bisection(self):
+        evaluations = []
+        result = surrogate_optimize(self.rs, [expenditure()], lambda v: v[0], 0.05,
+                                    self.shocks, seed=1,
+                                    on_evaluation=evaluations.append)
+        crossing = optimize_r_var(self.rs.copy(), RValue(RSetting.EXPENDITURE), True,
+                                  0.05, self.shocks)
+        self.assertTrue(result.converged)
+        self.assertEqual(evaluations, result.evaluations)
+        self.assertLessEqual(len(result.evaluations), 20)
+        self.assertTrue(result.best.safe)
+        # Safe with confidence is a little below where the tail value crosses
+        self.assertLess(result.best.values[0], crossing)
+        self.assertGreater(result.best.values[0], 0.97 * crossing)
+        self.assertEqual(result.settings.expenditure, result.best.values[0])
+        tail = simulate_values(result.settings, 10000, self.shocks).tail_value(0.05)
+        self.assertEqual(tail - self.rs.emergency_min, result.best.margin)
+        # Left unchanged
+        self.assertEqual(self.rs, create_waterfall_settings(0.1))
+
+    def test_two_variables_near_brute_force(self):
+        variables = [expenditure(), Variable(RValue(RSetting.T), 15, 45, integer=True)]
+        objective = lambda v: v[0] + 1000 * v[1]
+        result = surrogate_optimize(self.rs, variables, objective, 0.05, self.shocks,
+                                    seed=2)
+        self.assertLessEqual(len(result.evaluations), 30)
+        self.assertTrue(all(e.values[1] == round(e.values[1])
+                            for e in result.evaluations))
+        self.assertEqual(result.settings.t, result.best.values[1])
+        best = max(
+            optimize_r_var(with_t(self.rs, t), RValue(RSetting.EXPENDITURE), True, 0.05,
+                           self.shocks) + 1000 * t
+            for t in range(15, 46, 5))
+        self.assertGreater(result.best.objective, 0.97 * best)
+
+    def test_nothing_safe(self):
+        result = surrogate_optimize(self.rs, [expenditure(200000, 300000)],
+                                    lambda v: v[0], 0.05, self.shocks, n=1000,
+                                    max_evaluations=6, seed=3)
+        self.assertIsNone(result.best)
+        self.assertIsNone(result.settings)
+        self.assertFalse(result.converged)
+        self.assertEqual(len(result.evaluations), 6)
+
+    def test_draws_bank_for_longest_horizon(self):
+        variables = [expenditure(), Variable(RValue(RSetting.T), 20, 40, integer=True)]
+        result = surrogate_optimize(self.rs, variables, lambda v: v[0], 0.05, n=500,
+                                    max_evaluations=8, seed=4)
+        self.assertLessEqual(len(result.evaluations), 8)
+        self.assertGreater(max(e.values[1] for e in result.evaluations), 35)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import retcalc
+from mortality import Lifespan, Sex
+from retcalc import *
+from test.test_engine import create_cash_flows, create_waterfall_settings
+from withdrawal import Guardrails
+
+
+def with_t(rs: RetirementSettings, t: int) -> RetirementSettings:
+    rs = rs.copy()
+    rs.t = t
+    return rs
+
+
+class TrajectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings(0.1)
+        self.rs.expenditure = 50000
+
+    def assertResultsEqual(self, a: SimulationResult, b: SimulationResult):
+        self.assertTrue(np.array_equal(a.values, b.values))
+        self.assertTrue(np.array_equal(a.ruin_years, b.ruin_years))
+        self.assertTrue(np.array_equal(a.price_index, b.price_index))
+
+    def assertMatchesFromScratch(self, trajectory: Trajectory, rs: RetirementSettings,
+                                 t: int, backend: Backend = Backend.AUTO):
+        self.assertResultsEqual(
+            trajectory.result(t),
+            simulate_values(with_t(rs, t), 200, trajectory.shocks, backend))
+
+    def count_years_simulated(self):
+        years = []
+
+        def advance(rs, *args):
+            years.append(rs.t)
+            return advance_paths(rs, *args)
+        return mock.patch.object(retcalc, "advance_paths", advance), years
+
+    def test_shorten_reads_snapshot(self):
+        trajectory = Trajectory.simulate(self.rs, 200, seed=1)
+        self.assertEqual(trajectory.t, 30)
+        self.assertEqual(trajectory.shocks.t, 30)
+        self.assertMatchesFromScratch(trajectory, self.rs, 30)
+        patch, years = self.count_years_simulated()
+        with patch:
+            shortened = trajectory.result(20)
+        self.assertEqual(years, [])
+        self.assertResultsEqual(
+            shortened, simulate_values(with_t(self.rs, 20), 200, trajectory.shocks))
+
+    def test_extend_continues_paths(self):
+        trajectory = Trajectory.simulate(self.rs, 200, seed=1)
+        shocks = trajectory.shocks
+        patch, years = self.count_years_simulated()
+        with patch:
+            extended = trajectory.result(35)
+        self.assertEqual(sum(years), 5)
+        self.assertEqual(trajectory.t, 35)
+        # The first 30 years of shocks are kept
+        self.assertEqual(trajectory.shocks.t, 35)
+        self.assertTrue(np.array_equal(trajectory.shocks.returns[:, :30],
+                                       shocks.returns))
+        self.assertResultsEqual(
+            extended, simulate_values(with_t(self.rs, 35), 200, trajectory.shocks))
+        self.assertGreaterEqual(
+            extended.ruin_probability(), trajectory.result(30).ruin_probability())
+
+    def test_sparse_snapshots(self):
+        trajectory = Trajectory.simulate(self.rs, 200, seed=2, every=10)
+        self.assertEqual(sorted(trajectory.snapshots), [0, 10, 20, 30])
+        patch, years = self.count_years_simulated()
+        with patch:
+            self.assertMatchesFromScratch(trajectory, self.rs, 23)
+        self.assertEqual(years[0], 3)
+        self.assertMatchesFromScratch(trajectory, self.rs, 41)
+        self.assertEqual(sorted(trajectory.snapshots), [0, 10, 20, 30, 40])
+
+    def test_state_is_a_copy(self):
+        trajectory = Trajectory.simulate(self.rs, 200, seed=3, every=1)
+        trajectory.state(10).values[:] = 0
+        self.assertMatchesFromScratch(trajectory, self.rs, 10)
+
+    def test_monthly_features_and_backends(self):
+        rs = self.rs.copy()
+        rs.step_frequency = Frequency.MONTHLY
+        rs.cash_flows = create_cash_flows()
+        rs.lifespan = Lifespan([60, 58], [Sex.MALE, Sex.FEMALE])
+        for backend in (Backend.COMPILED, Backend.PYTHON):
+            trajectory = Trajectory.simulate(rs, 200, seed=4, backend=backend)
+            self.assertEqual(trajectory.shocks.t, 360)
+            self.assertMatchesFromScratch(trajectory, rs, 40, backend)
+            self.assertMatchesFromScratch(trajectory, rs, 12, backend)
+        rs.withdrawal_policy = Guardrails()
+        rs.expenditure_reduction_frac = None
+        trajectory = Trajectory.simulate(rs, 200, seed=5)
+        self.assertMatchesFromScratch(trajectory, rs, 33)
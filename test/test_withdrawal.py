@@ -0,0 +1,157 @@
+import unittest
+
+import numpy as np
+
+from retcalc import *
+from test.test_engine import create_waterfall_settings, with_frequency
+from withdrawal import *
+
+
+def with_policy(rs: RetirementSettings,
+                policy: Optional[WithdrawalPolicy]) -> RetirementSettings:
+    rs = rs.copy()
+    rs.withdrawal_policy = policy
+    return rs
+
+
+def create_steady_settings(mean_return: float) -> RetirementSettings:
+    """One asset with a certain return and no inflation"""
+    return RetirementSettings(
+        40000, (0, 0), 10, 0,
+        AssetDistribution([AssetAllocation(Asset("Stocks", 1000000, mean_return, 0),
+                                           0, 0, 1)]),
+        None)
+
+
+class CountingPolicy(WithdrawalPolicy):
+    def __init__(self):
+        self.calls = 0
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        self.calls += 1
+        return super().spending(step, state)
+
+
+class ReductionRuleTest(unittest.TestCase):
+    def test_any_asset_below_mean_reduces(self):
+        rs = create_waterfall_settings(0.1)
+        rs.t = 1
+        for returns, reduced in [([-1, 1, 1], True), ([1, 1, -1], True),
+                                 ([1, 1, 1], False)]:
+            shocks = ShockBank(np.zeros((1, 1)), np.array([[returns]], dtype=float))
+            for backend in [Backend.PYTHON, Backend.COMPILED]:
+                state = PathState.initial(FlatScenario.from_retirement_settings(rs), 1)
+                advance_paths(rs, state, shocks, backend)
+                self.assertEqual(bool(state.reduce_expenditure[0]), reduced)
+
+    def test_policy_matches_reduction_frac(self):
+        rs = create_waterfall_settings(0.1)
+        for frequency in [Frequency.ANNUAL, Frequency.MONTHLY]:
+            legacy = with_frequency(rs, frequency, Frequency.ANNUAL)
+            policy = with_policy(legacy, ReductionRule(0.1))
+            policy.expenditure_reduction_frac = None
+            shocks = ShockBank.for_settings(legacy, 300, seed=4)
+            expected = simulate_values(legacy, 300, shocks, Backend.COMPILED)
+            result = simulate_values(policy, 300, shocks)
+            self.assertTrue(np.array_equal(result.values, expected.values))
+            self.assertTrue(np.array_equal(result.ruin_years, expected.ruin_years))
+
+
+class WithdrawalPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.rs = create_waterfall_settings()
+        self.shocks = ShockBank.for_settings(self.rs, 300, seed=5)
+
+    def simulate(self, policy: Optional[WithdrawalPolicy]) -> SimulationResult:
+        return simulate_values(with_policy(self.rs, policy), 300, self.shocks)
+
+    def test_fixed_matches_no_policy(self):
+        expected = self.simulate(None)
+        for policy in [WithdrawalPolicy(), FloorCeiling(1, 1)]:
+            result = self.simulate(policy)
+            self.assertTrue(np.array_equal(result.values, expected.values))
+            self.assertTrue(np.array_equal(result.ruin_years, expected.ruin_years))
+
+    def test_called_once_per_step(self):
+        policy = CountingPolicy()
+        simulate_values(with_policy(self.rs, policy), 300, self.shocks)
+        self.assertEqual(policy.calls, self.rs.t)
+
+    def test_constant_percentage_never_ruins(self):
+        self.rs.expenditure = 10000000
+        result = self.simulate(ConstantPercentage(0.05))
+        self.assertEqual(result.ruin_probability(), 0)
+        self.assertTrue((result.current_values() > 0).all())
+
+    def test_constant_percentage_spends_rate(self):
+        rs = with_policy(create_steady_settings(0.1), ConstantPercentage(0.04))
+        rs.t = 2
+        value = simulate_values(rs, 1).current_values()[0]
+        self.assertAlmostEqual(value, 1000000 * (0.96 * 1.1) ** 2)
+
+    def test_floor_ceiling_bounds_spending(self):
+        rs = create_steady_settings(0.3)
+        rs.t = 1
+        rs.withdrawal_policy = FloorCeiling(0.9, 1.1, 0.2)
+        value = simulate_values(rs, 1).current_values()[0]
+        self.assertAlmostEqual(value, (1000000 - 44000) * 1.3)
+        rs.withdrawal_policy = FloorCeiling(0.9, 1.1, 0.01)
+        value = simulate_values(rs, 1).current_values()[0]
+        self.assertAlmostEqual(value, (1000000 - 36000) * 1.3)
+
+    def test_guardrails(self):
+        for mean_return, raised in [(0.2, True), (-0.2, False)]:
+            rs = with_policy(create_steady_settings(mean_return), Guardrails())
+            state = PathState.initial(FlatScenario.from_retirement_settings(rs), 1)
+            advance_paths(rs, state, ShockBank.for_settings(rs, 1))
+            withdrawal = state.policy_state["withdrawal"][0]
+            self.assertEqual(withdrawal > rs.expenditure, raised)
+            self.assertEqual(withdrawal < rs.expenditure, not raised)
+
+    def test_no_starting_portfolio(self):
+        start = PolicyStep(0, 1, np.array([40000.0, 40000]), np.array([0.0, 1000000]))
+        later = PolicyStep(1, 1, np.array([40800.0, 40800]), np.array([1000000.0] * 2))
+        policy = FloorCeiling(0.9, 1.1)
+        state = policy.start(start)
+        self.assertEqual(list(state["rate"]), [0, 0.04])
+        # The floor for the empty trial, 4% of the portfolio for the other
+        self.assertEqual(list(policy.spending(later, state)), [36720, 40000])
+        policy = Guardrails()
+        state = policy.start(start)
+        # Kept up with inflation, not raised by the prosperity rule every year
+        self.assertEqual(list(policy.spending(later, state)), [40800, 40800])
+
+    def test_continuation(self):
+        rs = with_policy(self.rs, Guardrails())
+        whole = simulate_values(rs, 300, self.shocks)
+        state = PathState.initial(FlatScenario.from_retirement_settings(rs), 300)
+        rs.t = 10
+        advance_paths(rs, state, self.shocks)
+        rs.t = 20
+        advance_paths(rs, state, self.shocks)
+        self.assertTrue(np.array_equal(state.values, whole.values))
+
+    def test_guardrails_protect_tail(self):
+        fixed = self.simulate(None)
+        guarded = self.simulate(Guardrails())
+        self.assertLess(guarded.ruin_probability(), fixed.ruin_probability() + 1e-9)
+
+    def test_structured(self):
+        for policy in [ReductionRule(0.1), ConstantPercentage(0.04),
+                       FloorCeiling(0.9, 1.5), Guardrails(0.25, 0.2, 0.1)]:
+            rs = with_policy(self.rs, policy)
+            restored = RetirementSettings.from_structured(rs.to_structured())
+            self.assertEqual(restored.withdrawal_policy, policy)
+            self.assertEqual(restored, rs)
+        self.assertNotEqual(ReductionRule(0.1), ReductionRule(0.2))
+
+    def test_no_sensitivities(self):
+        from greeks import simulate_sensitivities
+        with self.assertRaises(ValueError):
+            simulate_sensitivities(with_policy(self.rs, Guardrails()), 10)
+
+    def test_batch(self):
+        scenarios = [self.rs, with_policy(self.rs, Guardrails())]
+        result = simulate_batch(scenarios, 300, self.shocks)
+        self.assertTrue(np.array_equal(result.result(1).values,
+                                       self.simulate(Guardrails()).values))
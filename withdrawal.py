@@ -0,0 +1,252 @@
+"""Withdrawal policies decide how much every trial spends at each step.
+
+A policy works on whole trial arrays: the engine advances all trials one step in a
+compiled kernel, then calls the policy once per step (never once per path) to
+choose the next step's spending. Policies keep their per-trial state in the dict
+returned by start, which is carried along with the paths so a policy continues
+correctly when paths are advanced in several parts.
+
+New policies subclass WithdrawalPolicy and register themselves with
+register_policy to become selectable from scenario YAML as
+withdrawal_policy: {type: <name>, <parameter>: <value>, ...}"""
+
+from typing import Any, Dict, Optional, Type
+
+import numpy as np
+
+PolicyState = Dict[str, Any]
+
+
+class PolicyStep:
+    """What a policy sees of every trial at one step; arrays have one entry per
+    trial.
+
+    expenditure is the annual base expenditure of the settings, inflated along each
+    path to this step. totals are portfolio values: at the start of the step in
+    spending, after returns in observe. below_mean, growth and ruined describe the
+    step just simulated and are only set for observe: below_mean is whether any
+    asset returned less than its mean, growth the portfolio return factor over the
+    step after spending and ruined whether spending could not be covered. The
+    arrays are reused between steps, so copy anything kept in policy state."""
+
+    def __init__(
+        self,
+        step: int,
+        steps_per_year: int,
+        expenditure: np.ndarray,
+        totals: np.ndarray,
+        below_mean: Optional[np.ndarray] = None,
+        growth: Optional[np.ndarray] = None,
+        ruined: Optional[np.ndarray] = None,
+    ):
+        self.step = step
+        self.steps_per_year = steps_per_year
+        self.expenditure = expenditure
+        self.totals = totals
+        self.below_mean = below_mean
+        self.growth = growth
+        self.ruined = ruined
+
+    @property
+    def year_start(self) -> bool:
+        return self.step % self.steps_per_year == 0
+
+
+class WithdrawalPolicy:
+    """Spends expenditure in steps_per_year equal parts, like settings without a
+    policy. Subclasses override spending and observe; params lists the constructor
+    arguments that are saved to YAML."""
+
+    name = "FIXED"
+    params: tuple = ()
+
+    def start(self, step: PolicyStep) -> PolicyState:
+        """Per-trial state at the first step the policy runs"""
+        return {}
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        """Nominal amount every trial spends this step"""
+        return step.expenditure / step.steps_per_year
+
+    def observe(self, step: PolicyStep, state: PolicyState) -> None:
+        """Update state from the step's outcome"""
+
+    def to_structured(self) -> dict:
+        policy_obj = {"type": self.name}
+        for param in self.params:
+            policy_obj[param] = getattr(self, param)
+        return policy_obj
+
+    @staticmethod
+    def from_structured(policy_obj: dict) -> "WithdrawalPolicy":
+        policy_obj = dict(policy_obj)
+        return POLICIES[policy_obj.pop("type")](**policy_obj)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            type(other) is type(self)
+            and self.to_structured() == other.to_structured()  # type: ignore
+        )
+
+    def __hash__(self) -> int:
+        return hash(tuple(self.to_structured().items()))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_structured()})"
+
+
+POLICIES: Dict[str, Type[WithdrawalPolicy]] = {}
+
+
+def register_policy(cls: Type[WithdrawalPolicy]) -> Type[WithdrawalPolicy]:
+    """Class decorator making a policy selectable by its name"""
+    POLICIES[cls.name] = cls
+    return cls
+
+
+register_policy(WithdrawalPolicy)
+
+
+@register_policy
+class ReductionRule(WithdrawalPolicy):
+    """Reduce the next step's spending by frac after a step where any asset
+    returned less than its mean. Equivalent to expenditure_reduction_frac. Only one
+    step is cut, so with monthly steps a bad month cuts the next month."""
+
+    name = "REDUCTION"
+    params = ("frac",)
+
+    def __init__(self, frac: float):
+        self.frac = frac
+
+    def start(self, step: PolicyStep) -> PolicyState:
+        return {"reduce": np.zeros(len(step.totals), dtype=np.bool_)}
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        to_spend = step.expenditure / step.steps_per_year
+        to_spend = np.where(state["reduce"], to_spend * (1 - self.frac), to_spend)
+        state["reduce"][:] = False
+        return to_spend
+
+    def observe(self, step: PolicyStep, state: PolicyState) -> None:
+        # If expenditure is negative, we are earning not spending
+        state["reduce"] = (step.expenditure > 0) & step.below_mean & ~step.ruined
+
+
+@register_policy
+class ConstantPercentage(WithdrawalPolicy):
+    """Spend rate of the current portfolio every year, ignoring expenditure"""
+
+    name = "CONSTANT_PERCENTAGE"
+    params = ("rate",)
+
+    def __init__(self, rate: float):
+        self.rate = rate
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        return self.rate * np.maximum(step.totals, 0) / step.steps_per_year
+
+
+def _starting_rate(step: PolicyStep) -> np.ndarray:
+    """expenditure / totals, or 0 where there is no portfolio to withdraw from"""
+    return np.divide(
+        step.expenditure,
+        step.totals,
+        out=np.zeros(len(step.totals)),
+        where=step.totals > 0,
+    )
+
+
+@register_policy
+class FloorCeiling(WithdrawalPolicy):
+    """Spend rate of the current portfolio, but no less than floor and no more
+    than ceiling times expenditure.
+    @rate: The starting withdrawal rate (expenditure / portfolio) if None. Trials
+    with nothing in the portfolio at the start get a rate of 0, spending the floor."""
+
+    name = "FLOOR_CEILING"
+    params = ("floor", "ceiling", "rate")
+
+    def __init__(self, floor: float, ceiling: float, rate: Optional[float] = None):
+        assert floor <= ceiling
+        self.floor = floor
+        self.ceiling = ceiling
+        self.rate = rate
+
+    def start(self, step: PolicyStep) -> PolicyState:
+        if self.rate is not None:
+            return {"rate": np.full(len(step.totals), float(self.rate))}
+        return {"rate": _starting_rate(step)}
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        annual = np.clip(
+            state["rate"] * np.maximum(step.totals, 0),
+            self.floor * step.expenditure,
+            self.ceiling * step.expenditure,
+        )
+        return annual / step.steps_per_year
+
+
+@register_policy
+class Guardrails(WithdrawalPolicy):
+    """Guyton-Klinger decision rules, applied at the start of every year after the
+    first to an annual withdrawal that starts at expenditure:
+    - Inflation rule: the withdrawal keeps up with inflation, except after a year
+      with a negative portfolio return while the withdrawal rate is above its
+      starting rate.
+    - Capital preservation: cut the withdrawal by adjustment when the withdrawal
+      rate rises above (1 + upper) times the starting rate.
+    - Prosperity: raise it by adjustment when the rate falls below (1 - lower)
+      times the starting rate.
+    Trials with nothing in the portfolio at the start have no starting rate, so only
+    the inflation rule applies to them."""
+
+    name = "GUARDRAILS"
+    params = ("upper", "lower", "adjustment")
+
+    def __init__(self, upper: float = 0.2, lower: float = 0.2, adjustment: float = 0.1):
+        self.upper = upper
+        self.lower = lower
+        self.adjustment = adjustment
+
+    def start(self, step: PolicyStep) -> PolicyState:
+        return {
+            "withdrawal": step.expenditure.copy(),
+            "initial_rate": _starting_rate(step),
+            "guarded": step.totals > 0,
+            "base": step.expenditure.copy(),
+            "growth": np.ones(len(step.totals)),
+            "first_year": step.step // step.steps_per_year,
+        }
+
+    def spending(self, step: PolicyStep, state: PolicyState) -> np.ndarray:
+        if step.year_start and step.step // step.steps_per_year > state["first_year"]:
+            self.adjust(step, state)
+        return state["withdrawal"] / step.steps_per_year
+
+    def adjust(self, step: PolicyStep, state: PolicyState) -> None:
+        withdrawal = state["withdrawal"]
+        initial_rate = state["initial_rate"]
+        # Withdrawals only; contributions are left alone
+        spending = withdrawal > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.where(step.totals > 0, withdrawal / step.totals, np.inf)
+        guarded = spending & state["guarded"]
+        freeze = guarded & (state["growth"] < 1) & (rate > initial_rate)
+        inflated = np.where(
+            freeze,
+            withdrawal,
+            withdrawal * (step.expenditure / state["base"]),
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.where(step.totals > 0, inflated / step.totals, np.inf)
+        cut = guarded & (rate > initial_rate * (1 + self.upper))
+        raise_ = guarded & (rate < initial_rate * (1 - self.lower))
+        inflated = np.where(cut, inflated * (1 - self.adjustment), inflated)
+        inflated = np.where(raise_, inflated * (1 + self.adjustment), inflated)
+        state["withdrawal"] = inflated
+        state["base"] = step.expenditure.copy()
+        state["growth"] = np.ones(len(step.totals))
+
+    def observe(self, step: PolicyStep, state: PolicyState) -> None:
+        state["growth"] = state["growth"] * step.growth
@@ -11,6 +11,10 @@ def load_yaml(filepath: str) -> dict:
         return load(stream, Loader=Loader)
 
 
+def parse_yaml(content: bytes) -> dict:
+    return load(content, Loader=Loader)
+
+
 def dump_yaml(data: dict, filepath: str):
     makedirs(path.dirname(filepath), exist_ok=True)
     with open(filepath, 'w') as stream: